@@ -26,91 +26,14 @@ the images.
 # this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
+import sys
 import numpy as np
 import nibabel as nb
 
-# ------------------------------------------------------------------------------
-# ### Function definitions
-
-
-def load_nii(strPathIn, varSzeThr=5000.0):
-    """
-    Load nii file.
-
-    Parameters
-    ----------
-    strPathIn : str
-        Path to nii file to load.
-    varSzeThr : float
-        If the nii file is larger than this threshold (in MB), the file is
-        loaded volume-by-volume in order to prevent memory overflow. Default
-        threshold is 1000 MB.
-
-    Returns
-    -------
-    aryNii : np.array
-        Array containing nii data. 32 bit floating point precision.
-    objHdr : header object
-        Header of nii file.
-    aryAff : np.array
-        Array containing 'affine', i.e. information about spatial positioning
-        of nii data.
-
-    Notes
-    -----
-    If the nii file is larger than the specified threshold (`varSzeThr`), the
-    file is loaded volume-by-volume in order to prevent memory overflow. The
-    reason for this is that nibabel imports data at float64 precision, which
-    can lead to a memory overflow even for relatively small files.
-    """
-    # Load nii file (this does not load the data into memory yet):
-    objNii = nb.load(strPathIn)
-
-    # Get size of nii file:
-    varNiiSze = os.path.getsize(strPathIn)
-
-    # Convert to MB:
-    varNiiSze = np.divide(float(varNiiSze), 1000000.0)
-
-    # Load volume-by-volume or all at once, depending on file size:
-    if np.greater(varNiiSze, float(varSzeThr)):
-
-        # Load large nii file
-
-        print(('---------Large file size ('
-              + str(np.around(varNiiSze))
-              + ' MB), reading volume-by-volume'))
-
-        # Get image dimensions:
-        tplSze = objNii.shape
-
-        # Create empty array for nii data:
-        aryNii = np.zeros(tplSze, dtype=np.float32)
-
-        # Loop through volumes:
-        for idxVol in range(tplSze[3]):
-            aryNii[..., idxVol] = np.asarray(
-                  objNii.dataobj[..., idxVol]).astype(np.float32)
-
-    else:
-
-        # Load small nii file
-
-        # Load nii file (this doesn't load the data into memory yet):
-        objNii = nb.load(strPathIn)
-
-        # Load data into array:
-        aryNii = np.asarray(objNii.dataobj).astype(np.float32)
-
-    # Get headers:
-    objHdr = objNii.header
-
-    # Get 'affine':
-    aryAff = objNii.affine
-
-    # Output nii data (as numpy array), header, and 'affine':
-    return aryNii, objHdr, aryAff
-
+# Shared modules of the analysis pipeline:
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'lib'))
+from utilities_nii import fncLoadNii  # noqa: E402
 
 # ------------------------------------------------------------------------------
 # ### Deface MP2RAGE images
@@ -144,7 +67,7 @@ for strImage in lstIn:
     print(('---Defacing: ' + strPthTmp))
 
     # Load image:
-    aryNiiTmp, objHdrTmp, aryAffTmp = load_nii(strPthTmp)
+    aryNiiTmp, objHdrTmp, aryAffTmp = fncLoadNii(strPthTmp)
 
     # Set anterior voxels to zero:
     aryNiiTmp[:, 250:, :] = 0.0
@@ -187,8 +110,8 @@ strPthT1 = (strPathIn + 'mp2rage_t1.nii.gz')
 strPthPdw = (strPathIn + 'mp2rage_pdw.nii.gz')
 
 # Load images:
-aryNiiT1, objHdrT1, aryAffT1 = load_nii(strPthT1)
-aryNiiPwd, _, _ = load_nii(strPthPdw)
+aryNiiT1, objHdrT1, aryAffT1 = fncLoadNii(strPthT1)
+aryNiiPwd, _, _ = fncLoadNii(strPthPdw)
 
 # Minimum and maximum in T1 image:
 varMin = np.amin(aryNiiT1)
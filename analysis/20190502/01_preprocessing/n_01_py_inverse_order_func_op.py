@@ -17,8 +17,14 @@ workaround.
 # *** Import modules
 
 import os
+import sys
 import numpy as np  #noqa
 import nibabel as nib
+
+# Shared modules of the analysis pipeline:
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'lib'))
+from utilities_nii import fncLoadNii  # noqa: E402
 # *****************************************************************************
 
 
@@ -41,30 +47,6 @@ lstPathOt = [(pacman_data_path
 # *****************************************************************************
 
 
-# *****************************************************************************
-# ***  Define functions
-
-def fncLoadNii(strPathIn):
-    """Load nii files."""
-    print(('------Loading: ' + strPathIn))
-
-    # Load nii file (this doesn't load the data into memory yet):
-    niiTmp = nib.load(strPathIn)
-
-    # Load data into array:
-    aryTmp = niiTmp.get_data()
-
-    # Get headers:
-    hdrTmp = niiTmp.header
-
-    # Get 'affine':
-    aryAff = niiTmp.affine
-
-    # Output nii data as numpy array and header:
-    return aryTmp, hdrTmp, aryAff
-# *****************************************************************************
-
-
 # *****************************************************************************
 # *** Perform correction
 
@@ -79,7 +61,7 @@ for idxIn in range(0, len(lstPathIn)):
     # print('------File: ' + lstPathIn[idxIn])
 
     # Load the nii file:
-    aryData, hdrNii, aryAff = fncLoadNii(lstPathIn[idxIn])
+    aryData, hdrNii, aryAff = fncLoadNii(lstPathIn[idxIn], dtype=None)
 
     # Reverse the order of the array elements along the fourth dimenstion
     # (i.e. time):
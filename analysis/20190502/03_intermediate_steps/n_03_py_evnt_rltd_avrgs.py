@@ -0,0 +1,343 @@
+"""
+Create event related averages from 4D nii files.
+
+Create average time courses from 4D nii files. The input to this script is a
+manifest (text file) listing 4D nii files, corresponding design matrices in
+FSL's 'custom 3 column' EV format (describing the occurence of a condition of
+interest in the nii files), and condition names. The averages of all
+conditions are calculated in a single pass over the nii files. All nii files
+need to have the same image dimensions, and in order for the averaging to be
+sensible, all condition blocks need to be of the same length.
+
+For each condition, the across-trial variance ('ERA_<condition>_var.nii.gz'),
+the standard error of the average ('ERA_<condition>_sem.nii.gz'), and the
+number of valid trials per voxel ('ERA_<condition>_count.nii.gz') are saved
+alongside the average.
+
+Usage:
+    python n_03_py_evnt_rltd_avrgs.py [-manifest /path/to/manifest.csv]
+
+By default, the manifest `n_03_era_manifest.csv` next to this script is used.
+
+(C) Ingo Marquardt, 2017
+"""
+
+import os
+import sys
+import copy
+import time
+import argparse
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import nibabel as nb
+from utilities_era import fncLoadEv, fncLoadMnf, fncSegDur, fncEra
+from utilities_segstore import fncStoreInit, fncStoreWrt
+
+# Shared modules of the analysis pipeline:
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'lib'))
+from utilities_nii import fncSaveNii  # noqa: E402
+from utilities_cache import (fncCacheInit, fncCacheGet,  # noqa: E402
+                             fncCacheSet)
+
+# -----------------------------------------------------------------------------
+# *** Check time
+varTme_01 = time.time()
+
+# -----------------------------------------------------------------------------
+# *** Define parameters
+
+# Load environmental variables defining the input data path:
+pacman_data_path = str(os.environ['pacman_data_path'])
+pacman_sub_id = str(os.environ['pacman_sub_id'])
+pacman_anly_path = str(os.environ['pacman_anly_path'])
+
+# Command line arguments (path of manifest):
+objParser = argparse.ArgumentParser()
+objParser.add_argument('-manifest',
+                       default=os.path.join(
+                           os.path.dirname(os.path.abspath(__file__)),
+                           'n_03_era_manifest.csv'),
+                       metavar='/path/to/manifest.csv',
+                       help='Manifest of 4D nii files, design matrices (EV '
+                            + 'files), and conditions.')
+objNspc = objParser.parse_args()
+
+# Parent directory (4D nii files in the manifest are relative to this
+# directory):
+strPathParent = (pacman_data_path
+                 + pacman_sub_id
+                 + '/nii/feat_level_1_comb/')
+
+# Directory containing design matrices (EV files in the manifest are relative
+# to this directory):
+strPathEV = (pacman_anly_path + 'FSL_MRI_Metadata/version_01/')
+
+# Output directory:
+strPathOut = (pacman_data_path
+              + pacman_sub_id
+              + '/nii/func_reg_averages/')
+
+# Output file names ('ERA_<condition>.nii.gz'; variance, standard error, and
+# number of trials are saved as 'ERA_<condition>_var.nii.gz' etc.):
+strOutFileName = 'ERA_{}.nii.gz'
+
+# Volume TR of input nii files:
+varTR = 2.079
+
+# Number of volumes that will be included in the average segment before the
+# onset of the condition block. NOTE: We get the start time and the duration
+# of each block from the design matrices (EV files). In order for the averaging
+# to work (and in order for it to be sensible in a conceptual sense), all
+# blocks that are included in the average need to have the same duration.
+varVolsPre = 5.0
+
+# Number of volumes that will be included in the average segment after the
+# end of the condition block:
+varVolsPst = 9.0
+
+# Normalise time segments? If True, segments are normalised trial-by-trial;
+# i.e. each time-course segment is divided by its own pre-stimulus baseline
+# before averaging across trials.
+lgcNorm = True
+
+# If normalisation is performed, which time points to use as baseline, relative
+# to the stimulus condition onset. (I.e., if you specify -3 and 0, the three
+# volumes preceeding the onset of the stimulus are used - the interval is
+# non-inclusive at the end.)
+tplBase = (-3, 0)
+
+# Whether or not to also produces individual event-related segments for each
+# trial (not needed for across-trial variance & standard error, which are
+# always calculated). The segments are saved in a single chunked store
+# (runs x trials x X x Y x Z x T per condition, see `utilities_segstore`).
+lgcSegs = False
+if lgcSegs:
+    # Basename for segments:
+    strSegs = 'NA'
+    # Number of threads for compressing & writing segments:
+    varParSegs = 4
+    # zlib compression level:
+    varLvlSegs = 1
+
+# Memory budget for reading the segments of each block [MB]. If the segment of
+# a block (i.e. the volumes within the block window) does not fit into this
+# budget, it is read in slabs along the third image dimension. (The
+# accumulators for the average, of the size of the output, come on top of
+# this.)
+varMemBdgt = 1000.0
+
+# The output nii files are compressed in BGZF format (i.e. in independent
+# blocks, which can be compressed & decompressed in parallel; the files can be
+# read as usual gzip files). Compression level (zlib, 1 to 9):
+varLvlNii = 6
+# Number of threads for compression & decompression of nii files (None: one
+# per CPU).
+varParNii = None
+# Compressed input files are decompressed once per run into a temporary file
+# in this scratch directory (default: the system's temporary directory, which
+# can be set with the environmental variable TMPDIR).
+strPathTmp = tempfile.gettempdir()
+
+# -----------------------------------------------------------------------------
+# *** Preparations
+
+print('-Create average time courses')
+
+print('---Manifest: ' + objNspc.manifest)
+
+# Load manifest, and design matrices (EV files):
+lstMnf = []
+lstIn = [objNspc.manifest]
+for strTmp01, strTmp02, strCnd in fncLoadMnf(objNspc.manifest):
+    print('---Loading: ' + strTmp02)
+    lstMnf.append(((strPathParent + strTmp01),
+                   fncLoadEv(strPathEV + strTmp02),
+                   strCnd))
+    lstIn += [(strPathParent + strTmp01), (strPathEV + strTmp02)]
+
+# Skip the averaging if the inputs (4D nii files, EV files, manifest, and the
+# code) & parameters have not changed since the last run (the outputs are
+# restored from the cache). Parameters that do not affect the outputs (memory
+# budget, number of threads) are not part of the key.
+strPathCode = os.path.dirname(os.path.abspath(__file__))
+dicCache = fncCacheInit(
+    'n_03_py_evnt_rltd_avrgs',
+    (sorted(set(lstIn), key=lstIn.index)
+     + [os.path.join(strPathCode, strTmp)
+        for strTmp in [os.path.basename(__file__), 'utilities_era.py',
+                       'utilities_segstore.py',
+                       os.path.join(os.pardir, 'lib', 'utilities_nii.py')]]),
+    {'varTR': varTR,
+     'varVolsPre': varVolsPre,
+     'varVolsPst': varVolsPst,
+     'lgcNorm': lgcNorm,
+     'tplBase': tplBase,
+     'lgcSegs': lgcSegs,
+     'strSegs': (strSegs if lgcSegs else None),
+     'varLvlSegs': (varLvlSegs if lgcSegs else None),
+     'varLvlNii': varLvlNii,
+     'strOut': (strPathOut + strOutFileName)})
+if fncCacheGet(dicCache):
+    print('-Done.')
+    sys.exit(0)
+
+# Prepare store for segments of each trial:
+if lgcSegs:
+
+    # Target directory for segments:
+    strPathSegs = (strPathOut + 'segs')
+
+    # Check whether target directory for segments exists:
+    lgcDir = os.path.isdir(strPathSegs)
+
+    # If directory does exist, delete it:
+    if not(lgcDir):
+
+        # Create direcotry for segments:
+        os.mkdir(strPathSegs)
+
+    # Path of segment store:
+    strPathSegs = (strPathSegs + '/' + strSegs + '.zarr')
+
+    print('---Trial segments will be saved at: ' + strPathSegs)
+
+    # Shape of the store (for each condition: number of runs, maximum number
+    # of trials per run, number of volumes per segment), and attributes (paths
+    # of runs & number of trials per run):
+    dicSegsShp = {}
+    dicSegsAttr = {}
+    for strTmp, aryTmp, strCnd in lstMnf:
+        if strCnd not in dicSegsShp:
+            dicSegsShp[strCnd] = [0, 0, fncSegDur(aryTmp, varTR, varVolsPre,
+                                                  varVolsPst)]
+            dicSegsAttr[strCnd] = {'runs': [], 'trials': [], 'TR': varTR,
+                                   'vols_pre': varVolsPre,
+                                   'normalised': lgcNorm}
+        dicSegsShp[strCnd][0] += 1
+        dicSegsShp[strCnd][1] = max(dicSegsShp[strCnd][1], aryTmp.shape[0])
+        dicSegsAttr[strCnd]['runs'].append(strTmp)
+        dicSegsAttr[strCnd]['trials'].append(int(aryTmp.shape[0]))
+
+    # The segments of each trial are passed to the following function slab by
+    # slab (directly after each slab has been read). Each slab is compressed
+    # and written to the store in parallel (the chunks of the store have the
+    # same size as the slabs). The store is created when the first slab is
+    # passed (because the slab size is determined by the averaging function).
+    dicSegs = {'chnk': None, 'ftr': []}
+    objPoolSegs = ThreadPoolExecutor(max_workers=varParSegs)
+
+    def fncSeg(strCnd, idxRun, idxBlck, idxSlc, idxSlcStp, arySeg):
+        """Compress & save slab of trial segment (asynchronously)."""
+        # Create store:
+        if dicSegs['chnk'] is None:
+            dicSegs['chnk'] = idxSlcStp - idxSlc
+            niiTmp = nb.load(lstMnf[0][0])
+            for strTmp in dicSegsAttr:
+                dicSegsAttr[strTmp]['affine'] = niiTmp.affine.tolist()
+            fncStoreInit(strPathSegs, dicSegsShp, niiTmp.shape[:3],
+                         dicSegs['chnk'], dicAttr=dicSegsAttr,
+                         varLvl=varLvlSegs)
+
+        # Limit the number of slabs held in memory (waiting to be written);
+        # this also raises exceptions from the threads:
+        while len(dicSegs['ftr']) >= (2 * varParSegs):
+            dicSegs['ftr'].pop(0).result()
+
+        # The segment is modified after this function returns, therefore a
+        # copy is passed to the thread:
+        dicSegs['ftr'].append(
+            objPoolSegs.submit(fncStoreWrt, strPathSegs, strCnd, idxRun,
+                               idxBlck, idxSlc, arySeg.copy(),
+                               dicSegs['chnk'], varLvlSegs))
+
+else:
+
+    fncSeg = None
+
+# -----------------------------------------------------------------------------
+# *** Create averages
+
+# The nii data are not loaded into memory; segments are read block by block
+# and accumulated (weighted by the number of blocks per run and the number of
+# runs), so that the result is the average across runs of the within-run
+# averages. Each nii file is read once for all conditions.
+dicRes, hdr_01, aryAff = fncEra(lstMnf,
+                                varTR,
+                                varVolsPre,
+                                varVolsPst,
+                                lgcNorm=lgcNorm,
+                                tplBase=tplBase,
+                                varMemBdgt=varMemBdgt,
+                                fncSeg=fncSeg,
+                                strPathTmp=strPathTmp,
+                                varPar=varParNii)
+
+if lgcSegs:
+    # Wait until all segments have been written:
+    for objFtr in dicSegs['ftr']:
+        objFtr.result()
+    objPoolSegs.shutdown()
+
+# -----------------------------------------------------------------------------
+# *** Save results
+
+# Since the resulting 4D nii files that contain the average time series differ
+# from the input image in the time dimension, we have to adjust the header
+# before saving the result.
+
+print('---Adjusting header for output nii files')
+
+print('------Original image dimensions: ' + str(hdr_01['dim']))
+
+for strCnd in dicRes:
+
+    aryAvrg, aryVar, arySem, aryCnt = dicRes[strCnd]
+
+    # Replace time dimension in header with respective dimension of average
+    # time course:
+    hdrTmp = copy.deepcopy(hdr_01)
+    hdrTmp['dim'][4] = aryAvrg.shape[3]
+    hdrTmp.set_data_dtype(np.float32)
+
+    print('---Saving resulting 4D nii file (average across runs): '
+          + strOutFileName.format(strCnd))
+    print('------Adjusted image dimensions: ' + str(hdrTmp['dim']))
+
+    # Save average, variance, and standard error:
+    for strTmp, aryTmp in zip(['', '_var', '_sem'],
+                              [aryAvrg, aryVar, arySem]):
+
+        # Save nii image:
+        fncSaveNii(aryTmp, aryAff, hdrTmp,
+                   (strPathOut + strOutFileName.format(strCnd + strTmp)),
+                   varLvl=varLvlNii, varPar=varParNii)
+
+    print('------Number of valid trials per voxel, range: '
+          + str(np.min(aryCnt)) + ' to ' + str(np.max(aryCnt)))
+
+    # Number of valid trials (3D):
+    hdrTmp = copy.deepcopy(hdr_01)
+    hdrTmp.set_data_dtype(np.int32)
+    fncSaveNii(aryCnt, aryAff, hdrTmp,
+               (strPathOut + strOutFileName.format(strCnd + '_count')),
+               varLvl=varLvlNii, varPar=varParNii)
+
+# Add outputs to cache:
+lstOt = [(strPathOut + strOutFileName.format(strCnd + strTmp))
+         for strCnd in dicRes for strTmp in ['', '_var', '_sem', '_count']]
+if lgcSegs:
+    for strTmp01, _, lstTmp in sorted(os.walk(strPathSegs)):
+        lstOt += [os.path.join(strTmp01, strTmp02)
+                  for strTmp02 in sorted(lstTmp)]
+fncCacheSet(dicCache, lstOt)
+
+# -----------------------------------------------------------------------------
+# *** Check time
+
+varTme_02 = time.time()
+varTme_03 = varTme_02 - varTme_01
+print('-Elapsed time: ' + str(varTme_03) + ' s')
+print('-Done.')
+# -----------------------------------------------------------------------------
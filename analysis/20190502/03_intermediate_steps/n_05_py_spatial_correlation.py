@@ -20,11 +20,11 @@ motion correction can be assessed.
 
 import os
 import numpy as np
-import nibabel as nb
 import matplotlib
 # Configure matplotlib for use in docker container (i.e. without display):
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
+from utilities_qc import fncCorrSchd, fncCorrTbl
 
 
 # *** Define parameters
@@ -76,131 +76,77 @@ if lgcMsk:
                   + '{}'
                   + '_spm_refweight.nii.gz')
 
-# *** Loop through subjects:
+# Output path of table with correlation coefficients of all subjects, runs,
+# and volumes (next to the plot of the current subject):
+strPathTbl = (pacman_data_path
+              + '{}/nii/spm_reg_moco_params/{}_correlation_refweight.csv')
+strPathTbl = strPathTbl.format(pacman_sub_id, pacman_sub_id)
 
-print('-Spatial correlation')
+# Number of parallel processes (runs are processed in parallel, also across
+# subjects):
+varPar = 4
 
-for strSub, lstRun in dicSubId.items():  #noqa
-
-    print('--Subject: ' + strSub)
+# Memory budget [MB]. Runs are only loaded in parallel as long as their
+# (estimated) memory usage stays within this budget.
+varMemBdgt = 8000.0
 
-    # Get number of input files:
-    varNumInRef = len(lstRun)
+# *** Calculate correlations
 
-    # Reference image for current subject:
-    strPathRefTmp = strPathRef.format(strSub)
+print('-Spatial correlation')
 
-    for idxRun in range(0, varNumInRef):
+# List of jobs (one per run, across subjects):
+lstJob = []
+for strSub, lstRun in dicSubId.items():  #noqa
 
-        print('---Reference image:')
-        print('------' + strPathRefTmp)
+    # Reference image (and mask) for current subject. The reference is loaded
+    # once per subject (and process), and reused for all runs (see
+    # `fncLoadRef`).
+    strPathRefTmp = strPathRef.format(strSub)
+    if lgcMsk:
+        strPathMskTmp = strPathMsk.format(strSub, strSub)
+    else:
+        strPathMskTmp = None
+
+    for strRun in lstRun:
+        lstJob.append((strSub,
+                       strRun,
+                       strPathRefTmp,
+                       strPathMskTmp,
+                       strPathIn.format(strSub, strRun)))
+
+# Correlation coefficients of all volumes of all runs (for each run, voxels
+# that are zero in both the reference image and the respective volume are
+# excluded, see `fncSpatCorr`):
+dicCorr = fncCorrSchd(lstJob, varPar, varMemBdgt)
+
+# Save table with correlation coefficients (subject, run, volume, r):
+print('---Saving table: ' + strPathTbl)
+fncCorrTbl(strPathTbl, lstJob, dicCorr)
 
-        # *** Load reference image
+# *** Loop through subjects:
 
-        # Load reference nii file (this doesn't load the data into memory yet):
-        niiTmpRef = nb.load(strPathRefTmp)
+for strSub, lstRun in dicSubId.items():  #noqa
 
-        # Load the data into memory:
-        aryTmpRef = niiTmpRef.get_data()
-        aryTmpRef = np.array(aryTmpRef)
+    print('--Subject: ' + strSub)
 
-        # Use reference mask?
-        if lgcMsk:
-            strPathMskTmp = strPathMsk.format(strSub, strSub)
-            print('---Applying mask:')
-            print('------' + strPathMskTmp)
-            niiTmpMsk = nb.load(strPathMskTmp)
-            # Load data into memory:
-            aryTmpMsk = niiTmpMsk.get_data()
-            aryTmpMsk = np.array(aryTmpMsk)
-            # Flatten the array into a vector:
-            vecTmpMsk = aryTmpMsk.flatten(order='C')
+    # Get number of input files:
+    varNumInRef = len(lstRun)
 
-        # In order to use the np.corrcoef function, the data have to be
-        # arranged in columns. I.e. we rearrange the data so that there is
-        # one column, with one row per voxel:
-        aryTmpRef = aryTmpRef.flatten(order='C')
+    print('---Reference image:')
+    print('------' + strPathRef.format(strSub))
+    if lgcMsk:
+        print('---Mask:')
+        print('------' + strPathMsk.format(strSub, strSub))
 
-        # *** Load time series:
+    # List with the correlation coefficients of all volumes of each run:
+    lstCorr = [dicCorr[(strSub, strRun)] for strRun in lstRun]
 
-        # Path of timeseries of current run:
-        strPathInTmp = strPathIn.format(strSub, lstRun[idxRun])
+    for idxRun in range(0, varNumInRef):
 
         print('---Time series image:')
-        print('------' + strPathInTmp)
-
-        # Load 4D nii file (this doesn't load the data into memory yet):
-        niiTmpSrc = nb.load(strPathInTmp)
-        # Load the data into memory:
-        aryTmpSrc = niiTmpSrc.get_data()
-        aryTmpSrc = np.array(aryTmpSrc)
-        # Get the shape of the 4D file:
-        vecTmpShape = aryTmpSrc.shape
-
-        # Get the number of volumes in the 4D file (assuming that the 4th
-        # image dimension corresponds to time):
-        varTmpNumVols = vecTmpShape[3]
-        if idxRun == 0:
-            # On the first iteration of the loop, we create a list that will
-            # be filled with the correlation coefficients of all volumes:
-            lstCorr = [None] * varNumInRef
-
-        # Array for correlation coefficients of all volumes of current run:
-        aryTmpCorr = np.zeros(varTmpNumVols)
-
-        # *** Secondary loop (volumes in 4D file)
-
-        for idxVol in range(0, varTmpNumVols):
-
-            # Get 3D file:
-            aryTmpSrc_3D = aryTmpSrc[:, :, :, idxVol]
-            # Flatten the array into a vector:
-            aryTmpSrc_3D = aryTmpSrc_3D.flatten(order='C')
-
-            # *** Replace NaNs with zeros
-
-            # Replace NaNs with zeros in the reference image:
-            aryTmpRef = np.nan_to_num(aryTmpRef)
-            # Replace NaNs with zeros in the source image:
-            aryTmpSrc_3D = np.nan_to_num(aryTmpSrc_3D)
-
-            # *** Exclude zero-elements
-
-            # We have to exclude all datapoints that have a zero as a value in
-            # both of the images. We first add both vectors. In the resulting
-            # vector, datapoints that are zero in both images remain zero. All
-            # other datapoints are non-zero.
-            vecTmpSum = np.absolute(aryTmpRef) + np.absolute(aryTmpSrc_3D)
-
-            # Use mask?
-            if lgcMsk:
-                # Apply mask:
-                vecTmpSum = np.multiply(vecTmpSum,
-                                        vecTmpMsk)
-            # We create an array with the indices of the non-zero elements:
-            vecTmpIdxNonzero = np.array(np.nonzero(vecTmpSum))
-
-            # print('---------Volume: ' +
-            #       str(idxVol) +
-            #       ' Number of nonzero voxels: ' +
-            #       str(vecTmpIdxNonzero.size))
-
-            # We create a temporary vector with the non-zero elements for each
-            # of the images:
-            vecTmpNonzeroRef = aryTmpRef[vecTmpIdxNonzero]
-            vecTmpNonzeroSrc = aryTmpSrc_3D[vecTmpIdxNonzero]
-
-            # *** Calculate correlations
-
-            # Calculate correlation coefficient. The output is a covariance
-            # matrix:
-            aryTmpCov = np.corrcoef(vecTmpNonzeroRef,
-                                    vecTmpNonzeroSrc)
-            # Access correlation between reference image and source image:
-            aryTmpCorr[idxVol] = aryTmpCov[0][1]
-
-        # Put correlation values of current run into list:
-        lstCorr[idxRun] = aryTmpCorr
+        print('------' + strPathIn.format(strSub, lstRun[idxRun]))
+
+        aryTmpCorr = lstCorr[idxRun]
 
         # *** Print results
 
@@ -0,0 +1,510 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming event-related averaging.
+
+Event-related averages are accumulated block by block into (x, y, z, time)
+accumulators. Only the volumes within each block window are read from disk,
+and - if a block window does not fit into the memory budget - the window is
+read in slabs along the third image dimension. Therefore, peak memory usage is
+determined by the memory budget (and by the size of the accumulators), not by
+the length of the runs or the number of blocks.
+
+Besides the average, the across-trial variance, the standard error of the
+mean, and the number of valid trials are accumulated in the same pass (online
+weighted update, see `fncWlfrd`), so that per-trial segments do not need to be
+saved for this purpose.
+"""
+
+# Part of texture analysis pipeline.
+# Copyright (C) 2019  Ingo Marquardt
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import tempfile
+import numpy as np
+import nibabel as nb
+
+# Shared modules of the analysis pipeline:
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'lib'))
+from utilities_nii import fncNiiUnzip  # noqa: E402
+
+
+def fncLoadEv(strPthEv):
+    """Load design matrix in FSL's 'custom 3 column' EV format."""
+    # At least two dimensions, also in case of a single block:
+    return np.loadtxt(strPthEv, skiprows=0, ndmin=2)
+
+
+def fncSegDur(aryEv, varTR, varVolsPre, varVolsPst):
+    """
+    Length of the event-related segments (in volumes).
+
+    The length is based on the duration of the first block in the design
+    matrix. In order for the averaging to be sensible, all blocks need to have
+    the same duration.
+    """
+    return int(np.around((aryEv[0, 1] / varTR) + varVolsPre + varVolsPst))
+
+
+def fncEvWnd(aryEv, varTR, varVolsPre, varSegDur):
+    """
+    Start and stop indices (in volumes) of the segment of each block.
+
+    Parameters
+    ----------
+    aryEv : np.array
+        Design matrix (onset, duration, and weight of each block, in seconds).
+    varTR : float
+        Volume TR.
+    varVolsPre : float
+        Number of volumes before the onset of the block to include in the
+        segment.
+    varSegDur : int
+        Length of the segments (in volumes, see `fncSegDur`).
+
+    Returns
+    -------
+    lstWnd : list
+        List of tuples (index of block in design matrix, start index, stop
+        index).
+    """
+    lstWnd = []
+    for idxBlck in range(aryEv.shape[0]):
+        # Start of segment (onset of the block minus pre-condition interval),
+        # rounded to the nearest volume:
+        varStr = int(np.around(((aryEv[idxBlck, 0] / varTR) - varVolsPre), 0))
+        lstWnd.append((idxBlck, varStr, (varStr + varSegDur)))
+    return lstWnd
+
+
+def fncLoadMnf(strPthMnf):
+    """
+    Load manifest of event-related averages.
+
+    Parameters
+    ----------
+    strPthMnf : str
+        Path of manifest (text file). Each line contains one entry, consisting
+        of the path of a 4D nii file, the path of the corresponding design
+        matrix (EV file), and the name of the condition, separated by commas.
+        Empty lines and lines starting with '#' are ignored.
+
+    Returns
+    -------
+    lstMnf : list
+        List of tuples (path of nii file, path of EV file, condition).
+    """
+    lstMnf = []
+    with open(strPthMnf, 'r') as objMnf:
+        for strLne in objMnf:
+            strLne = strLne.strip()
+            if (len(strLne) == 0) or strLne.startswith('#'):
+                continue
+            lstTmp = [strTmp.strip() for strTmp in strLne.split(',')]
+            if len(lstTmp) != 3:
+                raise ValueError('Invalid manifest entry: ' + strLne)
+            lstMnf.append(tuple(lstTmp))
+    return lstMnf
+
+
+def fncSlabSze(tplShp, varSegDur, varMemBdgt):
+    """
+    Number of slices per slab, given a memory budget.
+
+    Parameters
+    ----------
+    tplShp : tuple
+        Shape of the 4D nii file.
+    varSegDur : int
+        Length of the segments (in volumes).
+    varMemBdgt : float
+        Memory budget for reading & processing one slab [MB].
+
+    Returns
+    -------
+    varSlab : int
+        Number of slices (along the third image dimension) per slab.
+
+    Notes
+    -----
+    Per slice, the raw data and the float32 copy of the segment, as well as
+    the float64 temporaries of the online update (see `fncWlfrd`) need to be
+    held in memory at the same time (about ten float32 arrays).
+    """
+    varBytSlc = float(tplShp[0] * tplShp[1] * varSegDur * 4 * 10)
+    varSlab = int(np.floor((varMemBdgt * 1000000.0) / varBytSlc))
+    return int(np.clip(varSlab, 1, tplShp[2]))
+
+
+def fncNormSeg(arySeg, varVolsPre, tplBase):
+    """
+    Normalise segment by its pre-stimulus baseline (in place).
+
+    Voxels with a pre-stimulus baseline of zero are not normalised. Returns
+    the normalised segment, and a boolean array (x, y, z) that is True for
+    voxels with a non-zero baseline.
+    """
+    # Mean over pre-stimulus baseline:
+    aryBseMne = np.mean(arySeg[..., int(varVolsPre + tplBase[0]):
+                               int(varVolsPre + tplBase[1])],
+                        axis=3).astype(np.float32)
+
+    # Indices of voxels that have a non-zero prestimulus baseline:
+    aryNonZero = np.not_equal(aryBseMne, 0.0)
+
+    arySeg[aryNonZero] = np.divide(arySeg[aryNonZero],
+                                   aryBseMne[aryNonZero, None])
+    return arySeg, aryNonZero
+
+
+def fncWlfrd(aryMne, aryM2, aryW, aryW2, aryCnt, arySeg, aryWght):
+    """
+    Weighted online update of mean and sum of squared deviations (in place).
+
+    Parameters
+    ----------
+    aryMne : np.array
+        Running weighted mean (x, y, z, time).
+    aryM2 : np.array
+        Running weighted sum of squared deviations from the mean (x, y, z,
+        time).
+    aryW : np.array
+        Running sum of weights (x, y, z).
+    aryW2 : np.array
+        Running sum of squared weights (x, y, z).
+    aryCnt : np.array
+        Running number of trials with non-zero weight (x, y, z).
+    arySeg : np.array
+        New segment (x, y, z, time). Needs to be finite where the weight is
+        non-zero.
+    aryWght : np.array
+        Weight of the segment (x, y, z); zero for voxels where the segment is
+        not valid.
+
+    Notes
+    -----
+    Incremental algorithm for weighted mean & variance (West, 1979), i.e. the
+    weighted generalisation of Welford's algorithm. Avoids the numerical
+    cancellation of the textbook formula var = E[x^2] - E[x]^2.
+    """
+    aryW += aryWght
+    aryW2 += np.square(aryWght)
+    aryCnt += np.greater(aryWght, 0.0)
+
+    # Relative weight of new segment (zero where no valid segment so far):
+    aryRel = np.zeros(aryW.shape, dtype=np.float64)
+    np.divide(aryWght, aryW, out=aryRel, where=np.greater(aryW, 0.0))
+
+    aryDlt = arySeg - aryMne
+    aryMne += aryRel[..., None] * aryDlt
+    aryM2 += aryWght[..., None] * aryDlt * (arySeg - aryMne)
+
+
+def fncWlfrdFin(aryMne, aryM2, aryW, aryW2):
+    """
+    Variance and standard error of the mean from weighted online accumulators.
+
+    Parameters
+    ----------
+    aryMne, aryM2, aryW, aryW2 : np.array
+        Accumulators, see `fncWlfrd`.
+
+    Returns
+    -------
+    aryVar : np.array
+        Unbiased weighted variance across trials (x, y, z, time). The weights
+        are treated as reliability weights, i.e. the variance is
+        M2 / (W - W2 / W).
+    arySem : np.array
+        Standard error of the weighted mean (x, y, z, time), i.e.
+        sqrt(var / n_eff), with the effective number of trials
+        n_eff = W^2 / W2.
+
+    Notes
+    -----
+    Where the variance is not defined (less than two valid trials), variance
+    and standard error are set to zero.
+    """
+    # Denominator of unbiased variance (zero for a single trial):
+    aryDnm = np.zeros(aryW.shape, dtype=np.float64)
+    np.divide(aryW2, aryW, out=aryDnm, where=np.greater(aryW, 0.0))
+    aryDnm = aryW - aryDnm
+    lgcVld = np.greater(aryDnm, (1.0e-9 * aryW))
+
+    aryVar = np.zeros(aryM2.shape, dtype=np.float64)
+    np.divide(aryM2, aryDnm[..., None], out=aryVar,
+              where=lgcVld[..., None])
+    # Rounding errors can lead to small negative values:
+    np.maximum(aryVar, 0.0, out=aryVar)
+
+    # var / n_eff = var * W2 / W^2
+    aryTmp = np.zeros(aryW.shape, dtype=np.float64)
+    np.divide(aryW2, np.square(aryW), out=aryTmp, where=lgcVld)
+    arySem = np.sqrt(aryVar * aryTmp[..., None])
+
+    return aryVar, arySem
+
+
+def fncEraRun(objNii, lstWnd, dicAcc, varVolsPre, tplBase, lgcNorm, varSlab,
+              fncSeg=None):
+    """
+    Accumulate the segments of all blocks of one run.
+
+    Parameters
+    ----------
+    objNii : nibabel image
+        4D nii image of the run (the data are not loaded into memory).
+    lstWnd : list
+        Segment windows of all conditions in this run. List of tuples
+        (condition, index of run within condition, index of block, start
+        index, stop index, weight of segment).
+    dicAcc : dict
+        Accumulators for each condition (updated in place). Each entry is a
+        list with the running mean, the running sum of squared deviations,
+        the sum of weights, the sum of squared weights, and the number of
+        valid trials (see `fncWlfrd`).
+    varVolsPre : float
+        Number of volumes before block onset within the segment.
+    tplBase : tuple
+        Baseline interval relative to block onset (see `fncNormSeg`).
+    lgcNorm : bool
+        Whether to normalise each segment by its pre-stimulus baseline.
+    varSlab : int
+        Number of slices per slab (see `fncSlabSze`).
+    fncSeg : function or None
+        If not None, this function is called with the arguments (condition,
+        index of run within condition, index of block, first slice, last
+        slice, segment) for every slab of every segment.
+
+    Notes
+    -----
+    The windows are processed in temporal order (across conditions), so that
+    the 4D nii file is read sequentially. A segment is only included in the
+    statistics of a voxel if it is finite at all time points, and - if
+    `lgcNorm` is True - if its pre-stimulus baseline is non-zero at that
+    voxel.
+    """
+    varNumSlc = objNii.shape[2]
+    varNumVol = objNii.shape[3]
+
+    for strCnd, idxRun, idxBlck, varStr, varStp, varWght in sorted(
+            lstWnd, key=lambda tplWnd: tplWnd[3]):
+
+        if (varStr < 0) or (varStp > varNumVol):
+            raise ValueError('Segment of block ' + str(idxBlck + 1)
+                             + ' (condition ' + strCnd + ', volumes '
+                             + str(varStr) + ' to ' + str(varStp)
+                             + ') exceeds the run.')
+
+        aryMne, aryM2, aryW, aryW2, aryCnt = dicAcc[strCnd]
+
+        for idxSlc in range(0, varNumSlc, varSlab):
+
+            idxSlcStp = min((idxSlc + varSlab), varNumSlc)
+
+            # Read the volumes within the segment window (only the current
+            # slab). The segment is modified in place, so a (writeable) copy
+            # is needed also if the data are stored as float32:
+            arySeg = np.array(
+                objNii.dataobj[:, :, idxSlc:idxSlcStp, varStr:varStp],
+                dtype=np.float32)
+
+            # Voxels for which the segment is valid:
+            aryVld = np.all(np.isfinite(arySeg), axis=3)
+
+            if lgcNorm:
+                arySeg, aryTmp = fncNormSeg(arySeg, varVolsPre, tplBase)
+                aryVld = np.logical_and(aryVld, aryTmp)
+
+            if fncSeg is not None:
+                fncSeg(strCnd, idxRun, idxBlck, idxSlc, idxSlcStp, arySeg)
+
+            # Invalid voxels enter the update with zero weight:
+            arySeg[np.logical_not(aryVld)] = 0.0
+
+            fncWlfrd(aryMne[:, :, idxSlc:idxSlcStp, :],
+                     aryM2[:, :, idxSlc:idxSlcStp, :],
+                     aryW[:, :, idxSlc:idxSlcStp],
+                     aryW2[:, :, idxSlc:idxSlcStp],
+                     aryCnt[:, :, idxSlc:idxSlcStp],
+                     arySeg,
+                     (varWght * aryVld.astype(np.float64)))
+
+
+def fncEra(lstMnf, varTR, varVolsPre, varVolsPst, lgcNorm=True,
+           tplBase=(-3, 0), varMemBdgt=1000.0, fncSeg=None, strPathTmp=None,
+           varPar=None):
+    """
+    Event-related averages of several conditions across runs.
+
+    Parameters
+    ----------
+    lstMnf : list
+        List of tuples (path of 4D nii file, design matrix, condition), see
+        `fncLoadMnf` and `fncLoadEv`. All nii files need to have the same
+        image dimensions. A run can occur in several entries (e.g. with
+        different conditions).
+    varTR : float
+        Volume TR.
+    varVolsPre : float
+        Number of volumes before block onset to include in the segments.
+    varVolsPst : float
+        Number of volumes after block end to include in the segments.
+    lgcNorm : bool
+        Whether to normalise each segment by its pre-stimulus baseline.
+    tplBase : tuple
+        Baseline interval relative to block onset (see `fncNormSeg`).
+    varMemBdgt : float
+        Memory budget for reading segments [MB].
+    fncSeg : function or None
+        Called for every slab of every segment (see `fncEraRun`).
+    strPathTmp : str or None
+        Directory for temporary files. If not None, compressed nii files
+        (nii.gz) are decompressed into this directory before the segments are
+        read (see notes).
+    varPar : int or None
+        Number of threads for decompression (see `fncNiiUnzip`).
+
+    Returns
+    -------
+    dicRes : dict
+        Results for each condition. Each entry is a tuple with the
+        event-related average (x, y, z, time), the across-trial variance
+        (x, y, z, time), the standard error of the average (x, y, z, time),
+        and the number of valid trials (x, y, z); see `fncWlfrdFin`.
+    hdrNii : nibabel header
+        Header of the first run.
+    aryAff : np.array
+        Affine of the first run.
+
+    Notes
+    -----
+    Each nii file is opened once, and the segments of all conditions are
+    read in the same pass. As in the previous implementation, the average is
+    the mean over runs of the mean over blocks within runs. This is
+    accumulated in a single pass by weighting each segment with one over
+    (number of runs of the condition x number of blocks in run). If segments
+    are excluded at a voxel (see `fncEraRun`), the weights of the remaining
+    segments are renormalised at that voxel.
+
+    The segments are read from the nii files slab by slab. Reading part of a
+    compressed nii file requires decompressing the file up to that part, so
+    that a compressed file is decompressed many times. If `strPathTmp` is
+    specified, each compressed file is therefore decompressed once (in
+    parallel for BGZF files) into a temporary file in that directory, which
+    is deleted after the run has been processed (or if processing fails).
+    """
+    # Conditions (in order of first occurence), with number of runs and length
+    # of segments (based on first design matrix of the condition):
+    lstCnd = []
+    dicNumRun = {}
+    dicSegDur = {}
+    for strPthNii, aryEv, strCnd in lstMnf:
+        if strCnd not in dicNumRun:
+            lstCnd.append(strCnd)
+            dicNumRun[strCnd] = 0
+            dicSegDur[strCnd] = fncSegDur(aryEv, varTR, varVolsPre,
+                                          varVolsPst)
+        dicNumRun[strCnd] += 1
+
+    # Runs (in order of first occurence), with segment windows of all
+    # conditions:
+    lstPthNii = []
+    dicWnd = {}
+    dicIdxRun = dict.fromkeys(lstCnd, 0)
+    for strPthNii, aryEv, strCnd in lstMnf:
+        if strPthNii not in dicWnd:
+            lstPthNii.append(strPthNii)
+            dicWnd[strPthNii] = []
+        lstTmp = fncEvWnd(aryEv, varTR, varVolsPre, dicSegDur[strCnd])
+        # Weight of segments:
+        varWght = 1.0 / (float(dicNumRun[strCnd]) * float(len(lstTmp)))
+        for idxBlck, varStr, varStp in lstTmp:
+            dicWnd[strPthNii].append((strCnd, dicIdxRun[strCnd], idxBlck,
+                                      varStr, varStp, varWght))
+        dicIdxRun[strCnd] += 1
+
+    for idxRun, strPthNii in enumerate(lstPthNii):
+
+        print('---Processing run: ' + strPthNii)
+
+        # Decompress nii file once, into a temporary file in the scratch
+        # directory (removed on every path, including errors):
+        if (strPathTmp is not None) and strPthNii.endswith('.gz'):
+            varFd, strPthTmp = tempfile.mkstemp(prefix='era_tmp_',
+                                                suffix='.nii',
+                                                dir=strPathTmp)
+            os.close(varFd)
+        else:
+            strPthTmp = None
+
+        try:
+
+            if strPthTmp is not None:
+                fncNiiUnzip(strPthNii, strPthTmp, varPar=varPar)
+
+            # Load nii file (this doesn't load the data into memory):
+            objNii = nb.load(strPthNii if strPthTmp is None else strPthTmp)
+
+            if idxRun == 0:
+
+                # Header & affine of first input image (image dimensions are
+                # assumed to be identical across runs):
+                hdrNii = objNii.header
+                aryAff = objNii.affine
+
+                # Accumulators (running mean, sum of squared deviations, sum of
+                # weights, sum of squared weights, number of valid trials):
+                dicAcc = {}
+                for strCnd in lstCnd:
+                    tplShp = objNii.shape[:3] + (dicSegDur[strCnd],)
+                    dicAcc[strCnd] = [np.zeros(tplShp, dtype=np.float64),
+                                      np.zeros(tplShp, dtype=np.float64),
+                                      np.zeros(tplShp[:3], dtype=np.float64),
+                                      np.zeros(tplShp[:3], dtype=np.float64),
+                                      np.zeros(tplShp[:3], dtype=np.int32)]
+
+                # Slab size:
+                varSlab = fncSlabSze(objNii.shape, max(dicSegDur.values()),
+                                     varMemBdgt)
+                print('------Slices per slab: ' + str(varSlab))
+
+            for strCnd in lstCnd:
+                varTmp = len([tplWnd for tplWnd in dicWnd[strPthNii]
+                              if tplWnd[0] == strCnd])
+                if varTmp > 0:
+                    print('------Number of condition blocks (' + strCnd + '): '
+                          + str(varTmp))
+
+            fncEraRun(objNii, dicWnd[strPthNii], dicAcc, varVolsPre, tplBase,
+                      lgcNorm, varSlab, fncSeg=fncSeg)
+
+        finally:
+            if strPthTmp is not None:
+                objNii = None
+                os.remove(strPthTmp)
+
+    dicRes = {}
+    for strCnd in lstCnd:
+        aryMne, aryM2, aryW, aryW2, aryCnt = dicAcc.pop(strCnd)
+        aryVar, arySem = fncWlfrdFin(aryMne, aryM2, aryW, aryW2)
+        dicRes[strCnd] = (aryMne.astype(np.float32),
+                          aryVar.astype(np.float32),
+                          arySem.astype(np.float32),
+                          aryCnt)
+
+    return dicRes, hdrNii, aryAff
@@ -0,0 +1,318 @@
+# -*- coding: utf-8 -*-
+"""Spatial correlation between a reference image and all volumes of a run."""
+
+# Part of texture analysis pipeline.
+# Copyright (C) 2019  Ingo Marquardt
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+from collections import namedtuple
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import numpy as np
+import nibabel as nb
+
+# Shared modules of the analysis pipeline:
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'lib'))
+from utilities_nii import fncLoadNii  # noqa: E402
+
+
+# Reference image, prepared for the correlation with many volumes (see
+# `fncRefPrep`). All arrays are read-only, so that the same reference can be
+# shared by all runs (and by several candidate time series of the same run).
+RefCache = namedtuple('RefCache', ['lgcMsk',     # Mask (x, y, z), bool
+                                   'lgcRef',     # Non-zero reference (vox)
+                                   'vecX',       # Centred non-zero reference
+                                   'varMneRef',  # Mean of non-zero reference
+                                   'varSxx',     # Sum of squares of vecX
+                                   'varNumRef'])  # Number of non-zero voxels
+
+
+def fncRefPrep(aryRef, aryMsk=None):
+    """
+    Prepare reference image for the correlation with time series.
+
+    Parameters
+    ----------
+    aryRef : np.array
+        Reference image (x, y, z). NaNs are treated as zero.
+    aryMsk : np.array or None
+        Mask (x, y, z); only voxels that are non-zero in the mask are
+        considered. If None, all voxels are considered.
+
+    Returns
+    -------
+    objRef : RefCache
+        Masked & centred reference (see `fncSpatCorr`).
+    """
+    if aryMsk is None:
+        lgcMsk = np.ones(aryRef.shape, dtype=bool)
+    else:
+        lgcMsk = np.not_equal(aryMsk, 0.0)
+
+    vecRef = np.nan_to_num(np.asarray(aryRef[lgcMsk], dtype=np.float64))
+
+    # Voxels with non-zero reference (included for all volumes):
+    lgcRef = np.not_equal(vecRef, 0.0)
+    varNumRef = float(np.sum(lgcRef))
+
+    # Centred reference:
+    varMneRef = float(np.mean(vecRef[lgcRef])) if varNumRef > 0.0 else 0.0
+    vecX = vecRef[lgcRef] - varMneRef
+
+    for aryTmp in (lgcMsk, lgcRef, vecX):
+        aryTmp.flags.writeable = False
+
+    return RefCache(lgcMsk, lgcRef, vecX, varMneRef,
+                    float(np.dot(vecX, vecX)), varNumRef)
+
+
+@lru_cache(maxsize=8)
+def fncLoadRef(strPathRef, strPathMsk=None):
+    """
+    Load & prepare reference image (cached).
+
+    Parameters
+    ----------
+    strPathRef : str
+        Path of reference image (3D nii).
+    strPathMsk : str or None
+        Path of mask (3D nii), or None.
+
+    Returns
+    -------
+    objRef : RefCache
+        Masked & centred reference (see `fncRefPrep`).
+
+    Notes
+    -----
+    Each combination of reference & mask is only loaded from disk once per
+    process; subsequent calls (e.g. for further runs of the same subject, or
+    for several candidate motion-correction results) return the same cached,
+    read-only object. The images are loaded with `fncLoadNii` (within its
+    memory budget).
+    """
+    aryRef = fncLoadNii(strPathRef, dtype=None)[0]
+    if strPathMsk is None:
+        aryMsk = None
+    else:
+        aryMsk = fncLoadNii(strPathMsk, dtype=None)[0]
+    return fncRefPrep(aryRef, aryMsk=aryMsk)
+
+
+def fncLoadSrc(objRef, strPathIn):
+    """
+    Load time series, masked with the mask of the reference.
+
+    Returns an array of shape (voxels x volumes). The mask is applied once for
+    all volumes. The file is decompressed in parallel if it is in BGZF format
+    (see `fncLoadNii`).
+    """
+    return fncLoadNii(strPathIn, dtype=None)[0][objRef.lgcMsk]
+
+
+def fncSpatCorr(objRef, arySrc):
+    """
+    Correlation between reference image and each volume of a time series.
+
+    Parameters
+    ----------
+    objRef : RefCache
+        Reference image, see `fncRefPrep`.
+    arySrc : np.array
+        Time series, masked with the mask of the reference (voxels x volumes,
+        see `fncLoadSrc`). NaNs are treated as zero.
+
+    Returns
+    -------
+    vecCorr : np.array
+        Pearson correlation coefficient between the reference image and each
+        volume (volumes).
+
+    Notes
+    -----
+    Voxels that are zero in both the reference and in the respective volume
+    are excluded, i.e. the set of voxels can differ between volumes. Instead
+    of selecting the voxels separately for each volume, the voxels are split
+    into those where the reference is non-zero (included for all volumes),
+    and those where the reference is zero (included only where the volume is
+    non-zero, contributing to the sums of the volume but not to the cross
+    products). The correlation coefficients are then calculated from sums
+    over all voxels, with a single matrix-vector product for the
+    cross products. Both images are centred (by the mean over voxels with
+    non-zero reference) before summation, to avoid numerical cancellation.
+    The reference is centred once (see `fncRefPrep`), the time series is
+    centred for each volume. The result is identical (up to rounding errors)
+    to calling np.corrcoef separately for each volume on the non-zero voxels.
+    """
+    lgcRef = objRef.lgcRef
+    varNumRef = objRef.varNumRef
+    varMneRef = objRef.varMneRef
+    vecX = objRef.vecX
+
+    # Voxels with zero reference:
+    aryTmp = np.nan_to_num(np.asarray(arySrc[~lgcRef, :], dtype=np.float64))
+    # Number of included voxels per volume (non-zero in volume), and sums:
+    vecNumZro = np.sum(np.not_equal(aryTmp, 0.0), axis=0).astype(np.float64)
+    vecSumZro = np.sum(aryTmp, axis=0)
+    vecSqZro = np.einsum('ij,ij->j', aryTmp, aryTmp)
+    del(aryTmp)
+
+    # Voxels with non-zero reference, centred time series:
+    aryY = np.nan_to_num(np.asarray(arySrc[lgcRef, :], dtype=np.float64))
+    if varNumRef > 0.0:
+        vecMneSrc = np.mean(aryY, axis=0)
+    else:
+        vecMneSrc = np.zeros(aryY.shape[1], dtype=np.float64)
+    aryY -= vecMneSrc[None, :]
+
+    # Sums over included voxels (of centred values):
+    vecN = varNumRef + vecNumZro
+    vecSx = -varMneRef * vecNumZro
+    vecSxx = objRef.varSxx + (np.square(varMneRef) * vecNumZro)
+    vecSy = vecSumZro - (vecMneSrc * vecNumZro)
+    vecSyy = (np.einsum('ij,ij->j', aryY, aryY)
+              + vecSqZro
+              - (2.0 * vecMneSrc * vecSumZro)
+              + (np.square(vecMneSrc) * vecNumZro))
+    vecSxy = np.dot(vecX, aryY) - (varMneRef * vecSy)
+
+    # Pearson correlation coefficient:
+    vecCov = (vecN * vecSxy) - (vecSx * vecSy)
+    vecVar = (((vecN * vecSxx) - np.square(vecSx))
+              * ((vecN * vecSyy) - np.square(vecSy)))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        vecCorr = np.divide(vecCov, np.sqrt(vecVar))
+
+    return vecCorr
+
+
+def fncCorrJob(strPathRef, strPathMsk, strPathIn):
+    """
+    Correlation between reference image and all volumes of one run.
+
+    Worker function for `fncCorrSchd`. The reference is cached within each
+    worker process (see `fncLoadRef`), so it is only loaded once per process
+    and subject.
+    """
+    objRef = fncLoadRef(strPathRef, strPathMsk)
+    return fncSpatCorr(objRef, fncLoadSrc(objRef, strPathIn))
+
+
+def fncJobMem(objRef, strPathIn):
+    """
+    Estimated peak memory usage of one correlation job [MB].
+
+    The full 4D array is loaded (on-disk data type, or float64 if the data
+    are scaled), and masked; `fncSpatCorr` creates float64 copies of the
+    masked data.
+    """
+    objNii = nb.load(strPathIn)
+    varNumVox = float(np.prod(objNii.shape[:3]))
+    varNumVol = float(np.prod(objNii.shape[3:]))
+    varItm = float(objNii.get_data_dtype().itemsize)
+    if objNii.dataobj.slope != 1.0 or objNii.dataobj.inter != 0.0:
+        varItm = 8.0
+    varNumMsk = float(np.sum(objRef.lgcMsk))
+    varByt = ((varNumVox * varNumVol * varItm)
+              + (varNumMsk * varNumVol * (varItm + 16.0)))
+    return varByt / 1000000.0
+
+
+def fncCorrSchd(lstJob, varPar, varMemBdgt):
+    """
+    Calculate spatial correlations of several runs in parallel.
+
+    Parameters
+    ----------
+    lstJob : list
+        List of tuples (subject ID, run ID, path of reference image, path of
+        mask or None, path of 4D time series).
+    varPar : int
+        Number of processes.
+    varMemBdgt : float
+        Memory budget [MB]. A job is only started if the estimated memory
+        usage of all running jobs (see `fncJobMem`) stays within the budget.
+        A job that exceeds the budget on its own is run when no other job is
+        running.
+
+    Returns
+    -------
+    dicCorr : dict
+        Correlation coefficients (one per volume) for each (subject ID, run
+        ID).
+
+    Notes
+    -----
+    Jobs are started in the order of `lstJob`, so that the references of
+    subsequent jobs are likely to be cached in the worker processes already.
+    """
+    # Estimated memory usage of each job (references are loaded once per
+    # subject in the main process, to get the size of the mask):
+    lstMem = [fncJobMem(fncLoadRef(strPathRef, strPathMsk), strPathIn)
+              for _, _, strPathRef, strPathMsk, strPathIn in lstJob]
+
+    dicCorr = {}
+    dicRun = {}
+    idxJob = 0
+    varMemRun = 0.0
+
+    with ProcessPoolExecutor(max_workers=varPar) as objPool:
+
+        while (idxJob < len(lstJob)) or (len(dicRun) > 0):
+
+            # Start jobs, as long as the memory budget allows:
+            while ((idxJob < len(lstJob))
+                   and (len(dicRun) < varPar)
+                   and ((len(dicRun) == 0)
+                        or ((varMemRun + lstMem[idxJob]) <= varMemBdgt))):
+                strSub, strRun, strPathRef, strPathMsk, strPathIn = \
+                    lstJob[idxJob]
+                print('---Starting: ' + strSub + ' ' + strRun
+                      + ' (estimated memory: '
+                      + str(int(np.ceil(lstMem[idxJob]))) + ' MB)')
+                objFtr = objPool.submit(fncCorrJob, strPathRef, strPathMsk,
+                                        strPathIn)
+                dicRun[objFtr] = idxJob
+                varMemRun += lstMem[idxJob]
+                idxJob += 1
+
+            # Wait for (at least) one job to finish:
+            setDne, _ = wait(list(dicRun.keys()),
+                             return_when=FIRST_COMPLETED)
+            for objFtr in setDne:
+                idxTmp = dicRun.pop(objFtr)
+                varMemRun -= lstMem[idxTmp]
+                strSub, strRun = lstJob[idxTmp][:2]
+                dicCorr[(strSub, strRun)] = objFtr.result()
+                print('---Finished: ' + strSub + ' ' + strRun)
+
+    return dicCorr
+
+
+def fncCorrTbl(strPathTbl, lstJob, dicCorr):
+    """
+    Save correlation coefficients as table (csv).
+
+    One row per volume, with the columns subject, run, volume, r.
+    """
+    with open(strPathTbl, 'w') as objFle:
+        objFle.write('subject,run,volume,r\n')
+        for strSub, strRun in [tplJob[:2] for tplJob in lstJob]:
+            for idxVol, varCorr in enumerate(dicCorr[(strSub, strRun)]):
+                objFle.write(strSub + ',' + strRun + ',' + str(idxVol) + ','
+                             + repr(float(varCorr)) + '\n')
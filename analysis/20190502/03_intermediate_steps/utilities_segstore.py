@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+"""
+Chunked, compressed store for event-related segments of individual trials.
+
+The segments of all trials of a condition are saved in one array of shape
+(runs, trials, x, y, z, time), split into zlib-compressed chunks of one trial
+and a slab of slices each. The directory layout follows the zarr (version 2)
+specification, so that the store can also be opened with `zarr.open()` if
+zarr is available, but zarr is not needed for reading or writing. Each
+condition is a separate array within the store (because the number of
+volumes per segment can differ between conditions). Trials that do not exist
+(i.e. if the number of blocks differs between runs) are filled with NaN.
+"""
+
+# Part of texture analysis pipeline.
+# Copyright (C) 2019  Ingo Marquardt
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import json
+import zlib
+import shutil
+import numpy as np
+
+
+def fncStoreInit(strPthStr, dicCnd, tplShp, varChnkZ, dicAttr=None,
+                 varLvl=1):
+    """
+    Create (empty) segment store.
+
+    Parameters
+    ----------
+    strPthStr : str
+        Path of the store (directory). An existing store at this location is
+        removed.
+    dicCnd : dict
+        Arrays to create, one per condition. Each entry is a tuple (number of
+        runs, maximum number of trials per run, number of volumes per
+        segment).
+    tplShp : tuple
+        Spatial image dimensions (x, y, z).
+    varChnkZ : int
+        Number of slices (along z) per chunk.
+    dicAttr : dict or None
+        Additional attributes for each condition (saved as json, e.g. paths of
+        runs, number of trials per run).
+    varLvl : int
+        zlib compression level.
+    """
+    if os.path.isdir(strPthStr):
+        shutil.rmtree(strPthStr)
+    os.makedirs(strPthStr)
+
+    with open(os.path.join(strPthStr, '.zgroup'), 'w') as objFle:
+        json.dump({'zarr_format': 2}, objFle)
+
+    for strCnd, (varNumRun, varNumTrl, varSegDur) in dicCnd.items():
+
+        strPthArr = os.path.join(strPthStr, strCnd)
+        os.makedirs(strPthArr)
+
+        dicMeta = {'zarr_format': 2,
+                   'shape': [int(varNumRun), int(varNumTrl)]
+                   + [int(varTmp) for varTmp in tplShp]
+                   + [int(varSegDur)],
+                   'chunks': [1, 1, int(tplShp[0]), int(tplShp[1]),
+                              int(varChnkZ), int(varSegDur)],
+                   'dtype': '<f4',
+                   'compressor': {'id': 'zlib', 'level': int(varLvl)},
+                   'fill_value': 'NaN',
+                   'order': 'C',
+                   'filters': None}
+
+        with open(os.path.join(strPthArr, '.zarray'), 'w') as objFle:
+            json.dump(dicMeta, objFle, indent=1)
+
+        if (dicAttr is not None) and (strCnd in dicAttr):
+            with open(os.path.join(strPthArr, '.zattrs'), 'w') as objFle:
+                json.dump(dicAttr[strCnd], objFle, indent=1)
+
+
+def fncStoreMeta(strPthStr, strCnd):
+    """Load metadata (shape, chunks, ...) of one condition of the store."""
+    with open(os.path.join(strPthStr, strCnd, '.zarray'), 'r') as objFle:
+        return json.load(objFle)
+
+
+def fncChnkKey(idxRun, idxTrl, idxChnkZ):
+    """File name of chunk (zarr chunk key)."""
+    return '.'.join([str(idxRun), str(idxTrl), '0', '0', str(idxChnkZ), '0'])
+
+
+def fncStoreWrt(strPthStr, strCnd, idxRun, idxTrl, idxSlc, arySeg, varChnkZ,
+                varLvl=1):
+    """
+    Compress & save slab of segment of one trial.
+
+    Parameters
+    ----------
+    strPthStr : str
+        Path of the store.
+    strCnd : str
+        Condition (array within the store).
+    idxRun : int
+        Index of run (within condition).
+    idxTrl : int
+        Index of trial (block) within run.
+    idxSlc : int
+        Index of first slice of the slab. Needs to be a multiple of the chunk
+        size.
+    arySeg : np.array
+        Slab of the segment (x, y, slices, time). The number of slices needs to
+        be equal to the chunk size (except for the last chunk).
+    varChnkZ : int
+        Number of slices per chunk.
+    varLvl : int
+        zlib compression level.
+
+    Notes
+    -----
+    zlib releases the GIL, so this function can be called from several
+    threads in parallel. Chunks are written to a temporary file first and
+    renamed afterwards, so that incomplete chunks are never visible to
+    readers.
+    """
+    if ((idxSlc % varChnkZ) != 0) or (arySeg.shape[2] > varChnkZ):
+        raise ValueError('Slab (slices ' + str(idxSlc) + ' to '
+                         + str(idxSlc + arySeg.shape[2])
+                         + ') is not aligned with chunks of '
+                         + str(varChnkZ) + ' slices.')
+
+    # The last chunk along z is padded (chunks always have the full chunk
+    # size):
+    if arySeg.shape[2] < varChnkZ:
+        aryChnk = np.full((arySeg.shape[0], arySeg.shape[1], varChnkZ,
+                           arySeg.shape[3]),
+                          np.nan,
+                          dtype=np.float32)
+        aryChnk[:, :, :arySeg.shape[2], :] = arySeg
+    else:
+        aryChnk = np.ascontiguousarray(arySeg, dtype=np.float32)
+
+    strPthChnk = os.path.join(strPthStr, strCnd,
+                              fncChnkKey(idxRun, idxTrl, (idxSlc // varChnkZ)))
+
+    with open(strPthChnk + '.tmp', 'wb') as objFle:
+        objFle.write(zlib.compress(aryChnk.astype('<f4').tobytes(), varLvl))
+    os.replace((strPthChnk + '.tmp'), strPthChnk)
+
+
+def fncStoreRead(strPthStr, strCnd, idxRun, idxTrl):
+    """
+    Load segment of one trial from store.
+
+    Parameters
+    ----------
+    strPthStr : str
+        Path of the store.
+    strCnd : str
+        Condition (array within the store).
+    idxRun : int
+        Index of run (within condition).
+    idxTrl : int
+        Index of trial (block) within run.
+
+    Returns
+    -------
+    arySeg : np.array
+        Segment (x, y, z, time). NaN if the trial does not exist.
+    """
+    dicMeta = fncStoreMeta(strPthStr, strCnd)
+    tplShp = tuple(dicMeta['shape'][2:])
+    varChnkZ = dicMeta['chunks'][4]
+    tplChnk = tuple(dicMeta['chunks'][2:])
+
+    arySeg = np.full(tplShp, np.nan, dtype=np.float32)
+
+    for idxChnkZ in range(int(np.ceil(float(tplShp[2]) / float(varChnkZ)))):
+
+        strPthChnk = os.path.join(strPthStr, strCnd,
+                                  fncChnkKey(idxRun, idxTrl, idxChnkZ))
+
+        # Missing chunks contain the fill value:
+        if not os.path.isfile(strPthChnk):
+            continue
+
+        with open(strPthChnk, 'rb') as objFle:
+            aryChnk = np.frombuffer(zlib.decompress(objFle.read()),
+                                    dtype='<f4').reshape(tplChnk)
+
+        idxSlc = idxChnkZ * varChnkZ
+        idxSlcStp = min((idxSlc + varChnkZ), tplShp[2])
+        arySeg[:, :, idxSlc:idxSlcStp, :] = \
+            aryChnk[:, :, :(idxSlcStp - idxSlc), :]
+
+    return arySeg
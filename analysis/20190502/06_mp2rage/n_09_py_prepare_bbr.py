@@ -14,11 +14,17 @@ mask is dilated.
 # *** Import modules
 
 import os
+import sys
 import numpy as np
 import nibabel as nib
-from skimage import morphology as skimrp
-from skimage.measure import label
 from shutil import copyfile
+
+# Shared modules of the analysis pipeline:
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'lib'))
+from utilities_cache import (fncCacheInit, fncCacheGet,  # noqa: E402
+                             fncCacheSet)
+from utilities_mask import fncMskRcp  # noqa: E402
 # *****************************************************************************
 
 
@@ -56,6 +62,14 @@ strPthBbr02 = (pacman_data_path
 
 # Cluster size threshold:
 varCluSzeThr = 200
+
+# Recipe for the mask (see `utilities_mask.fncMskRcp`), applied to the
+# binarised FAST WM estimation: opening, cluster size threshold, and dilation
+# by five voxels:
+lstRcp = [('binarise', None),
+          ('open', 1),
+          ('cluster', varCluSzeThr),
+          ('dilate', 5)]
 # *****************************************************************************
 
 
@@ -64,6 +78,23 @@ varCluSzeThr = 200
 
 print('-Prepare BBR')
 
+# Skip this stage if its inputs & parameters have not changed since the last
+# run (the outputs, including those of FSL FAST, are restored from the
+# cache). The options of FSL FAST are part of this script, which is therefore
+# included in the inputs.
+dicCache = fncCacheInit('n_09_py_prepare_bbr',
+                        [(strPthCombMean + strCombMean + '.nii.gz'),
+                         (strPthBbr01 + strT1 + '.nii.gz'),
+                         os.path.abspath(__file__),
+                         os.path.join(os.path.dirname(
+                             os.path.abspath(__file__)),
+                             os.pardir, 'lib', 'utilities_mask.py')],
+                        {'lstRcp': lstRcp,
+                         'strPthBbr01': strPthBbr01,
+                         'strPthBbr02': strPthBbr02})
+if fncCacheGet(dicCache):
+    sys.exit(0)
+
 print('---Copying files')
 
 copyfile((strPthCombMean + strCombMean + '.nii.gz'),
@@ -105,8 +136,8 @@ strBshCmd = ('fslmaths ' + strPthBbr02 + 'ch01_cl03_seg_0' + ' -bin '
              + strPthBbr02 + 'bbrmask')
 os.system(strBshCmd)
 
-# (4) Perform opening operation on WM estimation
-print('------Opening operation')
+# (4) - (6) Opening, cluster size threshold & dilation of WM mask
+print('------Opening, cluster size threshold & dilation')
 
 # Load the nii file (this doesn't load the data into memory though):
 niiIn = nib.load((strPthBbr02 + 'bbrmask.nii.gz'))
@@ -114,37 +145,11 @@ niiIn = nib.load((strPthBbr02 + 'bbrmask.nii.gz'))
 aryData = niiIn.get_data()
 aryData = np.array(aryData)
 
-# Perform opening:
-aryData = skimrp.binary_opening(aryData)
-
-# (5) Apply cluster size threshold
-print('------Apply cluster size threshold')
-
-# Find connected clusters
-
-# Create labelled clusters:
-aryData = label(aryData, connectivity=2)
-
-# Vectors of cluster labels & number of voxels in each cluster:
-vecLbls, vecCnt = np.unique(aryData, return_counts=True)
-
-# Labels and label indicies of same data type:
-aryData = aryData.astype(np.int64)
-vecLbls = vecLbls.astype(np.int64)
-
-# Applying connected clusters threshold:
-for idxClst in vecLbls:
-    if np.less(vecCnt[idxClst], varCluSzeThr):
-        aryData[aryData == idxClst] = 0
-aryData[aryData != 0] = 1
-
-# (6) Dilate WM mask
-print('------Dilating WM mask')
-aryData = skimrp.binary_dilation(aryData)
-aryData = skimrp.binary_dilation(aryData)
-aryData = skimrp.binary_dilation(aryData)
-aryData = skimrp.binary_dilation(aryData)
-aryData = skimrp.binary_dilation(aryData)
+# Apply the recipe in one go (clusters with a connectivity of two, i.e.
+# neighbours across faces & edges; the opening & dilation are computed with a
+# distance transform, with the same result as repeated erosions / dilations
+# with the default structuring element):
+aryData = fncMskRcp(aryData, lstRcp, strMtr='taxicab', varCon=2)
 
 # Save mask:
 
@@ -154,4 +159,12 @@ niiOt = nib.Nifti1Image(aryData,
                         header=niiIn.header)
 # Save image:
 nib.save(niiOt, (strPthBbr02 + 'bbrmask.nii.gz'))
+
+# Add outputs to cache (copied mean image, and all files in the BBR
+# preparation directory):
+fncCacheSet(dicCache,
+            ([(strPthBbr01 + strCombMean + '.nii.gz')]
+             + [os.path.join(strPthBbr02, strTmp)
+                for strTmp in sorted(os.listdir(strPthBbr02))
+                if os.path.isfile(os.path.join(strPthBbr02, strTmp))]))
 # *****************************************************************************
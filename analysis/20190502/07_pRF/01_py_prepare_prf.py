@@ -15,10 +15,16 @@ EPI image followed by a cluster size threshold and morphological operations
 # *** Import modules
 
 import os
+import sys
 import numpy as np
 import nibabel as nib
-from skimage import morphology as skimrp
-from skimage.measure import label
+
+# Shared modules of the analysis pipeline:
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'lib'))
+from utilities_cache import (fncCacheInit, fncCacheGet,  # noqa: E402
+                             fncCacheSet)
+from utilities_mask import fncMskRcp  # noqa: E402
 # *****************************************************************************
 
 
@@ -46,6 +52,14 @@ varIntThr = 5000.0
 
 # Cluster size threshold:
 varCluSzeThr = 100000
+
+# Recipe for the mask (see `utilities_mask.fncMskRcp`): intensity threshold,
+# cluster size threshold, and morphological operations (dilation followed by
+# closing, i.e. dilation by two voxels and erosion by one voxel):
+lstRcp = [('threshold', varIntThr),
+          ('cluster', varCluSzeThr),
+          ('dilate', 2),
+          ('erode', 1)]
 # *****************************************************************************
 
 
@@ -54,6 +68,19 @@ varCluSzeThr = 100000
 
 print('-Preparing pRF fitting')
 
+# Skip this stage if its inputs & parameters have not changed since the last
+# run (the outputs are restored from the cache):
+dicCache = fncCacheInit('01_py_prepare_prf',
+                        [(strPthCombMean + strCombMean),
+                         os.path.abspath(__file__),
+                         os.path.join(os.path.dirname(
+                             os.path.abspath(__file__)),
+                             os.pardir, 'lib', 'utilities_mask.py')],
+                        {'lstRcp': lstRcp,
+                         'strMsk': (strPathOut + strMsk)})
+if fncCacheGet(dicCache):
+    sys.exit(0)
+
 print('---Loading data')
 
 # Load the nii file (this doesn't load the data into memory yet):
@@ -70,31 +97,11 @@ aryData = np.array(aryData).astype(np.float32)
 
 print('---Creating mask')
 
-# Apply intensity threshold:
-aryMsk = np.greater_equal(aryData, float(varIntThr))
-
-# Find connected clusters
-
-# Create labelled clusters:
-aryLbls = label(aryMsk, connectivity=2)
-
-# Vectors of cluster labels & number of voxels in each cluster:
-vecLbls, vecCnt = np.unique(aryLbls, return_counts=True)
-
-# Labels and label indicies of same data type:
-aryLbls = aryLbls.astype(np.int64)
-vecLbls = vecLbls.astype(np.int64)
-
-# Applying connected clusters threshold:
-for idxClst in vecLbls:
-    if np.less(vecCnt[idxClst], varCluSzeThr):
-        aryLbls[aryLbls == idxClst] = 0
-aryLbls[aryLbls != 0] = 1
-
-# Perform morphological operation (dilation followed by closing operation):
-aryLbls = skimrp.binary_dilation(aryLbls)
-aryLbls = skimrp.binary_dilation(aryLbls)
-aryLbls = skimrp.binary_erosion(aryLbls)
+# Apply the recipe in one go (clusters with a connectivity of two, i.e.
+# neighbours across faces & edges; the dilation & erosion by several voxels
+# are computed with a distance transform, with the same result as repeated
+# dilations / erosions with the default structuring element):
+aryLbls = fncMskRcp(aryData, lstRcp, strMtr='taxicab', varCon=2)
 # *****************************************************************************
 
 
@@ -110,4 +117,7 @@ niiOt = nib.Nifti1Image(aryLbls,
 
 # Save image:
 nib.save(niiOt, (strPathOut + strMsk))
+
+# Add output to cache:
+fncCacheSet(dicCache, [(strPathOut + strMsk)])
 # *****************************************************************************
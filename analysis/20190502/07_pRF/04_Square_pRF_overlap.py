@@ -27,10 +27,16 @@ containing information about the overlap of the pRFs and a visual stimulus.
 # *****************************************************************************
 # *** Import modules
 import os
+import sys
 import numpy as np
 import nibabel as nib
 import time
-import multiprocessing as mp
+from utilities_overlap import fncPrfOvrlpPool
+
+# Shared modules of the analysis pipeline:
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'lib'))
+from utilities_nii import fncLoadNii  # noqa: E402
 # *****************************************************************************
 
 
@@ -90,6 +96,15 @@ varSdMin = 0.2
 # overlap):
 varSupSmp = 5.0
 
+# Calculate the overlap of the rectangular ROIs (edge & background) in closed
+# form? The closed form is the continuous limit of the sum over the
+# supersampled model of the visual space, and differs from it by up to several
+# percentage points (e.g. for pRFs close to the limits of the visual field),
+# so that voxels can cross the overlap criteria. If False, all ROIs are
+# calculated on the supersampled model of the visual space (on the same
+# discrete visual field as the pRF centre overlap), as in previous versions.
+lgcRct = False
+
 # -----------------------------------------------------------------------------
 # In the texture/uniform control experiment, the central square has slightly
 # different dimensions than in the previous sessions of the surface experiment,
@@ -122,6 +137,12 @@ varThrR = 0.1
 # this value [percent].
 lstOvrlp = [50, 75, 90, 95]
 
+# The overlap ratio, the pRF centre overlap, and the overlap masks are saved
+# as 4D nii files (with ROIs along the fourth dimension). Additionally save
+# separate 3D files with ratio and centre overlap for each ROI? (These are
+# needed for the CBS depth sampling, see `08_depthsampling/cbs_*_glm_prf`.)
+lgcRoi3D = True
+
 # Number of processes to run in parallel:
 varPar = 11
 # *****************************************************************************
@@ -133,184 +154,6 @@ varTme01 = time.time()
 # *****************************************************************************
 
 
-# *****************************************************************************
-# *** Define functions
-
-
-def fncLoadNii(strPathIn):
-    """Load nii files."""
-    print(('---------Loading: ' + strPathIn))
-    # Load nii file (this doesn't load the data into memory yet):
-    niiTmp = nib.load(strPathIn)
-    # Load data into array:
-    aryTmp = niiTmp.get_data()
-    # Get headers:
-    hdrTmp = niiTmp.header
-    # Get 'affine':
-    niiAff = niiTmp.affine
-    # Output nii data as numpy array and header:
-    return aryTmp, hdrTmp, niiAff
-
-
-def fncPrfOvrlp(idxPrc,
-                aryNiiXChnk,
-                aryNiiYChnk,
-                aryNiiSdChnk,
-                aryNiiR2Chnk,
-                aryLgcStim,
-                varXmin,
-                varXmax,
-                varXstep,
-                varYmin,
-                varYmax,
-                varYstep,
-                varSupSmp,
-                vecXcords,
-                vecYcords,
-                varSdMin,
-                varPar,
-                queOut):
-    """Calculate stimulus-pRF overlap."""
-    # Number of voxels in this chunk of data:
-    varNumVoxChnk = aryNiiXChnk.size
-
-    # Array for result (overlap ratio) for this chunk of data:
-    aryRatioChnk = np.zeros(varNumVoxChnk)
-
-    # Array for result (pRF centre on stimulus?) for this chunk of data:
-    aryCentreChnk = np.zeros(varNumVoxChnk)
-
-    # Prepare status indicator if this is the first of the parallel processes:
-    if idxPrc == 0:
-
-        # Number of steps for the status indicator:
-        varStsStpSze = 20
-
-        # Vector with voxel indicies at which to give status feedback:
-        vecStsStp = np.linspace(0,
-                                varNumVoxChnk,
-                                num=(varStsStpSze+1),
-                                endpoint=True)
-        vecStsStp = np.ceil(vecStsStp)
-        vecStsStp = vecStsStp.astype(int)
-
-        # Vector with corresponding percentage values at which to give status
-        # feedback:
-        vecStatPrc = np.linspace(0,
-                                 100,
-                                 num=(varStsStpSze+1),
-                                 endpoint=True)
-        vecStatPrc = np.ceil(vecStatPrc)
-        vecStatPrc = vecStatPrc.astype(int)
-
-        # Counter for status indicator:
-        varCntSts01 = 0
-        varCntSts02 = 0
-
-    # Loop through voxels in input chunk:
-    for idxVox in range(0, varNumVoxChnk):
-
-        # Status indicator (only used in the first of the parallel processes):
-        if idxPrc == 0:
-
-            # Status indicator:
-            if varCntSts02 == vecStsStp[varCntSts01]:
-
-                # Prepare status message:
-                strStsMsg = ('---------Progress: ' +
-                             str(vecStatPrc[varCntSts01]) +
-                             ' % --- ' +
-                             str(int((vecStsStp[varCntSts01] * varPar))) +
-                             ' voxels out of ' +
-                             str(int(varNumVoxChnk) * varPar))
-
-                print(strStsMsg)
-
-                # Only increment counter if the last value has not been
-                # reached yet:
-                if varCntSts01 < varStsStpSze:
-                    varCntSts01 = varCntSts01 + int(1)
-
-        # Create meshgrid for Gaussian model:
-        [aryTmpX, aryTmpY] = np.meshgrid(
-            np.linspace(varXmin, varXmax, (varXstep * varSupSmp)),
-            np.linspace(varYmin, varYmax, (varYstep * varSupSmp))
-            )
-
-        # Because of interpolation (e.g. during upsampling), it can happen that
-        # some voxel have pRF models with a very small (and implausible) size.
-        # This is expected to happen at the surface of the brain (where
-        # interpolation between positive values within the brain and zeros
-        # outside the brain takes place during upsampling or spatial
-        # transformations). Therefore, we exclude voxels with a too low pRF
-        # size.
-        if varSdMin <= aryNiiSdChnk[idxVox]:
-
-            # Create Gaussian pRF model:
-            aryTmpGaus = np.divide((
-                (aryTmpX - aryNiiXChnk[idxVox]) ** 2.0 +
-                (aryTmpY - aryNiiYChnk[idxVox]) ** 2.0
-                ),
-                (2.0 * (aryNiiSdChnk[idxVox] ** 2.0))
-                )
-
-            aryTmpGaus = np.exp(-aryTmpGaus)
-
-            # We calculate how much of the pRF area of the current voxel is
-            # contained within the stimulus. We start by multipying the matrix
-            # representing the pRF with the matrix representing the annulus:
-            aryTmpOvrlp = aryTmpGaus * aryLgcStim
-
-            # We calculate the ratio:
-            aryRatioChnk[idxVox] = np.divide(np.sum(aryTmpOvrlp),
-                                             np.sum(aryTmpGaus)) * 100.0
-
-        else:
-
-            # In case the size of the pRF model is too small to be plausible,
-            # we set the overlap ratio to zero:
-            aryRatioChnk[idxVox] = 0.0
-
-        # We would like to create a binary map for pRF centre overlap with
-        # stimulus (i.e. whether the pRF centre is on the stimulus). For that
-        # we need to convert the position of the pRF model of the current voxel
-        # from visual space coordinates into matrix indicies of the matrix
-        # representing the stimulus. Start by getting the current voxel's pRF
-        # centre position (in visual space):
-        varTmpXcord = aryNiiXChnk[idxVox]
-        varTmpYcord = aryNiiYChnk[idxVox]
-
-        # The visual space model will likely not contain the exact same values
-        # as the current pRF position (different upsampling may have been used
-        # during pRF model finding than in this script). Therefore, we need to
-        # find the index of the visual space coordinate closest to the current
-        # pRF centre:
-        varTmpXidx = np.argmin(np.absolute(vecXcords - varTmpXcord))
-        varTmpYidx = np.argmin(np.absolute(vecYcords - varTmpYcord))
-
-        # We put the value from the array representing the stimulus into the
-        # binary overlap array. The array representing the stimulus contains
-        # ones and zeros (stimulus at that location - yes/no), so we don't need
-        # any additional logical test. Note that when indexing the stimulus
-        # array the first index is for the y-position and the second index for
-        # the x-position, because the y-positions are from top to bottom.
-        aryCentreChnk[idxVox] = aryLgcStim[varTmpYidx, varTmpXidx]
-
-        # Status indicator (only used in the first of the parallel processes):
-        if idxPrc == 0:
-
-            # Increment status indicator counter:
-            varCntSts02 = varCntSts02 + 1
-
-    # Prepare output list:
-    lstOut = [idxPrc,
-              aryRatioChnk,
-              aryCentreChnk]
-
-    queOut.put(lstOut)
-# *****************************************************************************
-
-
 # *****************************************************************************
 # *** Preparations
 
@@ -318,10 +161,10 @@ print('---Preparations')
 
 # Load nii files:
 print('------Loading nii files')
-aryNiiX, hdrNiiX, aryAffX = fncLoadNii(strNiiX)
-aryNiiY, hdrNiiY, aryAffY = fncLoadNii(strNiiY)
-aryNiiSd, hdrNiiSd, aryAffSd = fncLoadNii(strNiiSd)
-aryNiiR2, hdrNiiR2, aryAffR2 = fncLoadNii(strNiiR2)
+aryNiiX, hdrNiiX, aryAffX = fncLoadNii(strNiiX, dtype=None)
+aryNiiY, hdrNiiY, aryAffY = fncLoadNii(strNiiY, dtype=None)
+aryNiiSd, hdrNiiSd, aryAffSd = fncLoadNii(strNiiSd, dtype=None)
+aryNiiR2, hdrNiiR2, aryAffR2 = fncLoadNii(strNiiR2, dtype=None)
 
 print('------Preparing arrays')
 
@@ -419,8 +262,26 @@ aryLgcBck = np.logical_or(
 
 # Vectors with x- and y-coordinates represented in the super-sampled model of
 # the visual space:
-vecXcords = np.linspace(varXmin, varXmax, (varXstep * varSupSmp))
-vecYcords = np.linspace(varYmin, varYmax, (varYstep * varSupSmp))
+vecXcords = np.linspace(varXmin, varXmax, int(varXstep * varSupSmp))
+vecYcords = np.linspace(varYmin, varYmax, int(varYstep * varSupSmp))
+
+# Rectangular ROIs can be expressed as a weighted sum of rectangles, each
+# defined as (x-min, x-max, y-min, y-max, weight). For these ROIs, the overlap
+# can be calculated in closed form (see `lgcRct` above). The central square
+# and the full screen ROI exclude the fixation dot, so their overlap is always
+# calculated on the supersampled model of the visual space.
+
+# Edge (outer square minus inner square):
+lstRctEdg = [(lstLimEdgX[0][0], lstLimEdgX[1][1],
+              lstLimEdgY[0][0], lstLimEdgY[1][1], 1.0),
+             (lstLimEdgX[0][1], lstLimEdgX[1][0],
+              lstLimEdgY[0][1], lstLimEdgY[1][0], -1.0)]
+
+# Periphery (left and right edges of screen):
+lstRctBck = [(lstLimBckX[0][0], lstLimBckX[0][1],
+              lstLimBckY[0][0], lstLimBckY[0][1], 1.0),
+             (lstLimBckX[1][0], lstLimBckX[1][1],
+              lstLimBckY[1][0], lstLimBckY[1][1], 1.0)]
 
 # Dimensions of nii data:
 vecNiiShp = aryNiiX.shape
@@ -428,257 +289,143 @@ vecNiiShp = aryNiiX.shape
 
 
 # *****************************************************************************
-# *** Loop through ROIs (central square, edge, periphery)
-
-for idxRoi in range(4):  #noqa
-
-    if idxRoi == 0:
-        # Central square
-        aryLgcStim = aryLgcCntr
-    elif idxRoi == 1:
-        # Edge
-        aryLgcStim = aryLgcEdg
-    elif idxRoi == 2:
-        # Periphery (left and right ends of screen)
-        aryLgcStim = aryLgcBck
-    elif idxRoi == 3:
-        # Full screen
-        aryLgcStim = aryLgcFull
-
-    # *************************************************************************
-    # *** Calculation of stimulus-pRF overlap
-
-    print('---Calculating stimulus-pRF overlap')
-
-    # Empty lists for chunks of nii data:
-    lstNiiX = [None] * varPar
-    lstNiiY = [None] * varPar
-    lstNiiSd = [None] * varPar
-    lstNiiR2 = [None] * varPar
-
-    # Empty list for processes:
-    lstPrcs = [None] * varPar
-
-    # Empty list for results (stimulus-pRF overlap):
-    lstRes = [None] * varPar
-
-    # Counter for parallel processes:
-    varCntPar = 0
-
-    # Counter for output of parallel processes:
-    varCntOut = 0
-
-    # Create a queue to put the results in:
-    queOut = mp.Queue()
-
-    # Total number of voxels:
-    varNumVoxTlt = (vecNiiShp[0] * vecNiiShp[1] * vecNiiShp[2])
-
-    # Reshape nii data:
-    aryNiiX = np.reshape(aryNiiX, varNumVoxTlt)
-    aryNiiY = np.reshape(aryNiiY, varNumVoxTlt)
-    aryNiiSd = np.reshape(aryNiiSd, varNumVoxTlt)
-    aryNiiR2 = np.reshape(aryNiiR2, varNumVoxTlt)
-
-    # Logical test for voxel inclusion: is the R2 value larger than the
-    # specified threshold:
-    aryLgcInc = np.greater(aryNiiR2, varThrR)
-
-    # Array nii data for which inclusion condition is fulfilled:
-    aryNiiXinc = aryNiiX[aryLgcInc]
-    aryNiiYinc = aryNiiY[aryLgcInc]
-    aryNiiSdinc = aryNiiSd[aryLgcInc]
-    aryNiiR2inc = aryNiiR2[aryLgcInc]
-
-    # Number of voxels for which stimulus-pRF overlap calculation will be
-    # performed:
-    varNumVoxInc = aryNiiXinc.shape[0]
-
-    print('------Number of voxels on which stimulus-pRF overlap calculation ' +
-          'will be performed: ' + str(varNumVoxInc))
-
-    # Vector with the indicies at which the nii data will be separated in order
-    # to be chunked up for the parallel processes:
-    vecIdxChnks = np.linspace(0,
-                              varNumVoxInc,
-                              num=varPar,
-                              endpoint=False)
-    vecIdxChnks = np.hstack((vecIdxChnks, varNumVoxInc))
-
-    # Put nii data into chunks:
-    for idxChnk in range(0, varPar):
-        # Index of first voxel to be included in current chunk:
-        varTmpChnkSrt = int(vecIdxChnks[idxChnk])
-        # Index of last voxel to be included in current chunk:
-        varTmpChnkEnd = int(vecIdxChnks[(idxChnk+1)])
-        # Put array into list:
-        lstNiiX[idxChnk] = aryNiiXinc[varTmpChnkSrt:varTmpChnkEnd]
-        lstNiiY[idxChnk] = aryNiiYinc[varTmpChnkSrt:varTmpChnkEnd]
-        lstNiiSd[idxChnk] = aryNiiSdinc[varTmpChnkSrt:varTmpChnkEnd]
-        lstNiiR2[idxChnk] = aryNiiR2inc[varTmpChnkSrt:varTmpChnkEnd]
-
-    print('------Creating parallel processes')
-
-    # Create processes:
-    for idxPrc in range(0, varPar):
-        lstPrcs[idxPrc] = mp.Process(target=fncPrfOvrlp,
-                                     args=(idxPrc,
-                                           lstNiiX[idxPrc],
-                                           lstNiiY[idxPrc],
-                                           lstNiiSd[idxPrc],
-                                           lstNiiR2[idxPrc],
-                                           aryLgcStim,
-                                           varXmin,
-                                           varXmax,
-                                           varXstep,
-                                           varYmin,
-                                           varYmax,
-                                           varYstep,
-                                           varSupSmp,
-                                           vecXcords,
-                                           vecYcords,
-                                           varSdMin,
-                                           varPar,
-                                           queOut)
-                                     )
-        # Daemon (kills processes when exiting):
-        lstPrcs[idxPrc].Daemon = True
-
-    # Start processes:
-    for idxPrc in range(0, varPar):
-        lstPrcs[idxPrc].start()
-
-    # Collect results from queue:
-    for idxPrc in range(0, varPar):
-        lstRes[idxPrc] = queOut.get(True)
-
-    # Join processes:
-    for idxPrc in range(0, varPar):
-        lstPrcs[idxPrc].join()
-    # *************************************************************************
-
-    # *************************************************************************
-    # *** Postprocessing
-
-    print('---Post-processing data from parallel processes')
-
-    # Create list for vectors with results, in order to put the results into
-    # the correct (original) order:
-    lstResRatio = [None] * varPar
-    lstResCentre = [None] * varPar
-
-    # Put output into correct order:
-    for idxRes in range(0, varPar):
-
-        # Index of results (first item in output list):
-        varTmpIdx = lstRes[idxRes][0]
-
-        # Put fitting results into list, in correct order:
-        lstResRatio[varTmpIdx] = lstRes[idxRes][1]
-        lstResCentre[varTmpIdx] = lstRes[idxRes][2]
-
-    # Concatenate output vectors (into the same order as the voxels that were
-    # included in the parallel processes):
-    aryRatioInc = np.zeros(0)
-    aryCentreInc = np.zeros(0)
-    for idxRes in range(0, varPar):
-        aryRatioInc = np.append(aryRatioInc, lstResRatio[idxRes])
-        aryCentreInc = np.append(aryCentreInc, lstResCentre[idxRes])
-
-    # Delete unneeded large objects:
-    del(lstRes)
-    del(lstResRatio)
-    del(lstResCentre)
-
-    # Arrays for stimulus-pRF overlap results (which will be used to get data
-    # into the original shape):
-    aryRatio = np.zeros((varNumVoxTlt, 1))
-    aryCentre = np.zeros((varNumVoxTlt, 1))
-
-    # Put results form pRF finding into array (they originally needed to be
-    # saved in a list due to parallelisation).
-    aryRatio[aryLgcInc, 0] = aryRatioInc
-    aryCentre[aryLgcInc, 0] = aryCentreInc
-
-    # Reshape results:
-    aryRatio = np.reshape(aryRatio,
-                          [vecNiiShp[0],
-                           vecNiiShp[1],
-                           vecNiiShp[2],
-                           1])
-    aryCentre = np.reshape(aryCentre,
-                           [vecNiiShp[0],
-                            vecNiiShp[1],
-                            vecNiiShp[2],
-                            1])
-    # *************************************************************************
-
-    # *************************************************************************
-    # *** Creation of binary masks for different overlap levels
-
-    print('---Creating binary masks for different overlap levels')
-
-    # Create thresholded maps for pRF models that have their centre on the
-    # stimulus. We first create a cell array that will contain the matrices
-    # with the masks for each threshold value (several mask with different
-    # thresholds can be produced at once).
-    varNumMsk = len(lstOvrlp)
-    lstMsk = [None] * varNumMsk
-    # Loop through overlap threshold values:
-    for idxMsk in range(0, varNumMsk):
-        lstMsk[idxMsk] = (aryRatio >= lstOvrlp[idxMsk]) * aryCentre
-    # *************************************************************************
-
-    # *************************************************************************
-    # *** Export results
-
-    print('---Exporting results')
-
-    # Create nii objects for ratio and centre images:
-    niiOtRatio = nib.Nifti1Image(aryRatio,
-                                 aryAffX,
-                                 header=hdrNiiX
-                                 )
-    niiOtCentre = nib.Nifti1Image(aryCentre,
-                                  aryAffX,
-                                  header=hdrNiiX
-                                  )
-
-    if idxRoi == 0:
-        # Central square
-        strHmf = 'square_centre'
-    elif idxRoi == 1:
-        # Edge
-        strHmf = 'square_edge'
-    elif idxRoi == 2:
-        # Periphery (left and right ends of screen)
-        strHmf = 'background'
-    elif idxRoi == 3:
-        # Full screen (avoiding fixation dot)
-        strHmf = 'fullscreen'
+# *** Calculation of stimulus-pRF overlap (all ROIs in a single pass)
+
+print('---Calculating stimulus-pRF overlap')
+
+# ROIs (central square, edge, periphery, full screen avoiding fixation dot):
+lstLgcStim = [aryLgcCntr, aryLgcEdg, aryLgcBck, aryLgcFull]
+if lgcRct:
+    lstRctRoi = [None, lstRctEdg, lstRctBck, None]
+else:
+    lstRctRoi = [None, None, None, None]
+lstRoiNme = ['square_centre', 'square_edge', 'background', 'fullscreen']
+
+# Total number of voxels:
+varNumVoxTlt = (vecNiiShp[0] * vecNiiShp[1] * vecNiiShp[2])
+
+# Reshape nii data:
+aryNiiX = np.reshape(aryNiiX, varNumVoxTlt)
+aryNiiY = np.reshape(aryNiiY, varNumVoxTlt)
+aryNiiSd = np.reshape(aryNiiSd, varNumVoxTlt)
+aryNiiR2 = np.reshape(aryNiiR2, varNumVoxTlt)
+
+print('------Number of voxels on which stimulus-pRF overlap calculation '
+      + 'will be performed: '
+      + str(np.sum(np.greater(aryNiiR2, varThrR))))
+
+# Calculate overlap for all ROIs on one pool of parallel processes (voxels
+# with an R2 value below the threshold are set to zero):
+aryRatioRoi, aryCentreRoi = fncPrfOvrlpPool(aryNiiX,
+                                            aryNiiY,
+                                            aryNiiSd,
+                                            aryNiiR2,
+                                            lstLgcStim,
+                                            lstRctRoi,
+                                            vecXcords,
+                                            vecYcords,
+                                            varThrR=varThrR,
+                                            varSdMin=varSdMin,
+                                            varPar=varPar)
+# *****************************************************************************
+
+
+# *****************************************************************************
+# *** Postprocessing
+
+print('---Post-processing results')
+
+# Number of ROIs:
+varNumRoi = len(lstLgcStim)
+
+# Reshape results (ROIs along fourth dimension):
+aryRatio = np.reshape(aryRatioRoi.T,
+                      [vecNiiShp[0],
+                       vecNiiShp[1],
+                       vecNiiShp[2],
+                       varNumRoi])
+aryCentre = np.reshape(aryCentreRoi.T,
+                       [vecNiiShp[0],
+                        vecNiiShp[1],
+                        vecNiiShp[2],
+                        varNumRoi])
+# *****************************************************************************
+
+
+# *****************************************************************************
+# *** Creation of binary masks for different overlap levels
+
+print('---Creating binary masks for different overlap levels')
+
+# Create thresholded maps for pRF models that have their centre on the
+# stimulus. We first create a list that will contain the 4D arrays with the
+# masks for each threshold value (several mask with different thresholds can
+# be produced at once).
+varNumMsk = len(lstOvrlp)
+lstMsk = [None] * varNumMsk
+# Loop through overlap threshold values:
+for idxMsk in range(0, varNumMsk):
+    lstMsk[idxMsk] = (aryRatio >= lstOvrlp[idxMsk]) * aryCentre
+# *****************************************************************************
+
+
+# *****************************************************************************
+# *** Export results
+
+print('---Exporting results')
+
+print('------Order of ROIs along fourth dimension: ' + ', '.join(lstRoiNme))
+
+# Create nii objects for ratio and centre images:
+niiOtRatio = nib.Nifti1Image(aryRatio,
+                             aryAffX,
+                             header=hdrNiiX
+                             )
+niiOtCentre = nib.Nifti1Image(aryCentre,
+                              aryAffX,
+                              header=hdrNiiX
+                              )
+
+# Save nii to disk:
+nib.save(niiOtRatio, (strNiiOt + 'ovrlp_ratio.nii.gz'))
+nib.save(niiOtCentre, (strNiiOt + 'ovrlp_ctnr.nii.gz'))
+
+# Export overlap masks (one 4D file per overlap threshold):
+for idxMsk in range(0, varNumMsk):
+
+    # Create nii object:
+    niiOtTmp = nib.Nifti1Image(lstMsk[idxMsk],
+                               aryAffX,
+                               header=hdrNiiX
+                               )
 
     # Save nii to disk:
-    nib.save(niiOtRatio, (strNiiOt + 'ovrlp_ratio_' + strHmf + '.nii.gz'))
-    nib.save(niiOtCentre, (strNiiOt + 'ovrlp_ctnr_' + strHmf + '.nii.gz'))
+    strTmp = (strNiiOt
+              + 'ovrlp_mask_'
+              + str(lstOvrlp[idxMsk])
+              + 'prct.nii.gz')
+    nib.save(niiOtTmp, strTmp)
 
-    # Export overlap ratio images:
-    for idxMsk in range(0, varNumMsk):
+# Export separate 3D ratio and centre images for each ROI (input to CBS depth
+# sampling):
+if lgcRoi3D:
 
-        # Create nii object:
-        niiOtTmp = nib.Nifti1Image(lstMsk[idxMsk],
+    for idxRoi in range(varNumRoi):
+
+        niiOtTmp = nib.Nifti1Image(aryRatio[..., idxRoi, None],
                                    aryAffX,
                                    header=hdrNiiX
                                    )
+        nib.save(niiOtTmp,
+                 (strNiiOt + 'ovrlp_ratio_' + lstRoiNme[idxRoi] + '.nii.gz'))
 
-        # Save nii to disk:
-        strTmp = (strNiiOt
-                  + 'ovrlp_mask_'
-                  + str(lstOvrlp[idxMsk])
-                  + 'prct_'
-                  + strHmf
-                  + '.nii.gz')
-        nib.save(niiOtTmp, strTmp)
-    # *************************************************************************
+        niiOtTmp = nib.Nifti1Image(aryCentre[..., idxRoi, None],
+                                   aryAffX,
+                                   header=hdrNiiX
+                                   )
+        nib.save(niiOtTmp,
+                 (strNiiOt + 'ovrlp_ctnr_' + lstRoiNme[idxRoi] + '.nii.gz'))
+# *****************************************************************************
 
 
 # *****************************************************************************
@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+"""
+Anisotropic diffusion of nii images that do not fit into memory.
+
+3D images: the input image is memory-mapped (or, if it is compressed or of
+another data type, converted into a memory-mapped float32 temporary file), the
+output is written into a memory-mapped nii file, and the diffusion is
+performed tile by tile (see `utilities_segmentator.aniso_diff_3D_tiled`).
+
+4D images (e.g. functional time series, multi-echo data): each volume is
+diffused independently on a pool of worker processes, which read their
+volumes from the (uncompressed) input file and write the results directly
+into the memory-mapped output file.
+"""
+
+# Part of texture analysis pipeline.
+# Copyright (C) 2019  Ingo Marquardt
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import multiprocessing as mp
+import numpy as np
+import nibabel as nb
+from utilities_segmentator import aniso_diff_3D, aniso_diff_3D_tiled
+
+# Shared modules of the analysis pipeline:
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'lib'))
+from utilities_nii import (fncMemAvl, fncLoadNii, fncNiiMmap,  # noqa: E402
+                           fncNiiCommit, fncNiiUnzip)
+
+
+# Input, output, reference & parameters of the worker processes (set by
+# `fncInitWrk`):
+dicWrk = {}
+
+
+def fncAnisoDiffNii(strPathIn, strPathOt, varNumIt=1, varKppa=50.0,
+                    varGmma=0.1, tplStp=(1.0, 1.0, 1.0), varOpt=1,
+                    varMemBdgt=None, varPar=1, varLvl=1):
+    """
+    Anisotropic diffusion of 3D nii image, tile by tile.
+
+    Parameters
+    ----------
+    strPathIn : str
+        Path of input nii file (nii or nii.gz).
+    strPathOt : str
+        Path of output nii file (nii or nii.gz, float32).
+    varNumIt, varKppa, varGmma, tplStp, varOpt :
+        Number of iterations, conduction coefficient, speed of diffusion,
+        distance between voxels (along the three image axes), and diffusion
+        equation (see `aniso_diff_3D`).
+    varMemBdgt : float or None
+        Memory budget [MB]. If None, a quarter of the available memory.
+    varPar : int
+        Number of threads (diffusion, and compression of the output).
+    varLvl : int
+        Compression level (zlib, if the output path ends with '.gz').
+
+    Notes
+    -----
+    The image is tiled along the last axis (i.e. along the slowest axis of the
+    nii data on disk), with ghost layers of `varNumIt` slices on either side
+    of each tile. Half of the memory budget is used for the tiles. The result
+    is bit-identical to that of `aniso_diff_3D` on the whole image (as loaded
+    with `fncLoadNii`).
+    """
+    if varMemBdgt is None:
+        varMemBdgt = 0.25 * fncMemAvl()
+
+    print('---------Anisotropic diffusion (tiled): '
+          + os.path.basename(strPathIn))
+
+    # Input data, float32. The data are memory-mapped or placed in a
+    # memory-mapped temporary file if they do not fit into the memory budget:
+    aryIn, objHdr, aryAff = fncLoadNii(strPathIn, dtype=np.float32,
+                                       varMemBdgt=(0.5 * varMemBdgt))
+
+    if aryIn.ndim != 3:
+        raise ValueError('Only 3D images allowed: ' + strPathIn)
+
+    # Output data, memory-mapped:
+    aryOt, strPthTmp = fncNiiMmap(strPathOt, aryIn.shape, aryAff, objHdr,
+                                  dtype=np.float32)
+
+    try:
+        # Size of a tile (without ghost layers), at least one slice [MB]:
+        varSlc = aryIn[..., 0].nbytes / 1000000.0
+        varTle = max(((0.25 * varMemBdgt) - (2.0 * varNumIt * varSlc)),
+                     varSlc)
+        aniso_diff_3D_tiled(aryIn, aryOt, niter=varNumIt, kappa=varKppa,
+                            gamma=varGmma, step=tplStp, option=varOpt,
+                            axis=2, tile_mb=varTle, nthreads=varPar)
+        del(aryIn)
+    except BaseException:
+        del(aryOt)
+        os.remove(strPthTmp)
+        raise
+
+    fncNiiCommit(aryOt, strPthTmp, strPathOt, varLvl=varLvl, varPar=varPar)
+
+
+def fncInitWrk(strPthIn, tplOt, strPathRef, dicPrm):
+    """
+    Initialise worker process (called once per process).
+
+    Parameters
+    ----------
+    strPthIn : str
+        Path of input nii file (uncompressed, 4D).
+    tplOt : tuple
+        Path of output file (memory-mapped temporary nii file, see
+        `fncNiiMmap`), offset of the data within that file (bytes), and shape
+        of the data.
+    strPathRef : str or None
+        Path of reference image (see `fncAnisoDiffNii4D`).
+    dicPrm : dict
+        Parameters of the diffusion (keyword arguments of `aniso_diff_3D`).
+
+    Notes
+    -----
+    The input, output, reference and parameters are kept in `dicWrk`, so that
+    they are not sent to the worker with every volume.
+    """
+    # Input (this doesn't load the data into memory):
+    dicWrk['objIn'] = nb.load(strPthIn).dataobj
+    # Output (memory map of the data of the output file):
+    strPthOt, varOff, tplShp = tplOt
+    dicWrk['aryOt'] = np.memmap(strPthOt, dtype=np.float32, mode='r+',
+                                offset=varOff, shape=tplShp, order='F')
+    # Reference image (shared by all volumes):
+    if strPathRef is None:
+        dicWrk['aryRef'] = None
+    else:
+        dicWrk['aryRef'] = fncLoadNii(strPathRef, dtype=np.float32)[0]
+    dicWrk['dicPrm'] = dicPrm
+
+
+def fncDiffVol(idxVol):
+    """
+    Diffuse one volume, and write it into the output file.
+
+    Parameters
+    ----------
+    idxVol : int
+        Index of volume (along the fourth axis).
+
+    Returns
+    -------
+    idxVol : int
+        Index of volume (for the status indicator).
+    """
+    aryTmp = np.array(dicWrk['objIn'][..., idxVol], dtype=np.float32,
+                      order='C')
+    aryTmp = aniso_diff_3D(aryTmp, inplace=True, ref=dicWrk['aryRef'],
+                           **dicWrk['dicPrm'])
+    dicWrk['aryOt'][..., idxVol] = aryTmp
+    dicWrk['aryOt'].flush()
+    return idxVol
+
+
+def fncAnisoDiffNii4D(strPathIn, strPathOt, varNumIt=1, varKppa=50.0,
+                      varGmma=0.1, tplStp=(1.0, 1.0, 1.0), varOpt=1,
+                      strPathRef=None, varPar=1, varLvl=1):
+    """
+    Anisotropic diffusion of each volume of a 4D nii image, in parallel.
+
+    Parameters
+    ----------
+    strPathIn : str
+        Path of input nii file (nii or nii.gz, 4D).
+    strPathOt : str
+        Path of output nii file (nii or nii.gz, float32).
+    varNumIt, varKppa, varGmma, tplStp, varOpt :
+        Number of iterations, conduction coefficient, speed of diffusion,
+        distance between voxels (along the three image axes), and diffusion
+        equation (see `aniso_diff_3D`).
+    strPathRef : str or None
+        Path of a 3D nii file (e.g. mean image), from which the conduction
+        coefficients of all volumes are computed (see `aniso_diff_3D`). If
+        None, the conduction coefficients of each volume are computed from
+        the volume itself.
+    varPar : int
+        Number of worker processes (and threads for the decompression &
+        compression of nii files).
+    varLvl : int
+        Compression level (zlib, if the output path ends with '.gz').
+
+    Notes
+    -----
+    Compressed input files are decompressed once into a temporary file next
+    to the output file, so that the workers can read their volumes directly.
+    Each worker holds one volume (and the reference image) in memory at a
+    time. The output is written into a memory-mapped temporary file, which is
+    compressed at the end (see `fncNiiCommit`).
+    """
+    print('---------Anisotropic diffusion (4D): '
+          + os.path.basename(strPathIn))
+
+    # Decompress input file once:
+    if strPathIn.endswith('.gz'):
+        strPthIn = os.path.join(os.path.dirname(os.path.abspath(strPathOt)),
+                                ('tmp_' + os.path.basename(strPathIn)[:-3]))
+        fncNiiUnzip(strPathIn, strPthIn, varPar=varPar)
+    else:
+        strPthIn = strPathIn
+
+    try:
+
+        objNii = nb.load(strPthIn)
+        tplShp = tuple(int(varTmp) for varTmp in objNii.shape)
+        if len(tplShp) != 4:
+            raise ValueError('Only 4D images allowed: ' + strPathIn)
+
+        # Output data, memory-mapped:
+        aryOt, strPthTmp = fncNiiMmap(strPathOt, tplShp, objNii.affine,
+                                      objNii.header, dtype=np.float32)
+        tplOt = (strPthTmp, int(aryOt.offset), tplShp)
+
+        dicPrm = {'niter': varNumIt,
+                  'kappa': varKppa,
+                  'gamma': varGmma,
+                  'step': tplStp,
+                  'option': varOpt}
+
+        try:
+            # The workers are terminated when leaving the context (also on
+            # error, so that they do not keep the output file open):
+            with mp.Pool(processes=varPar,
+                         initializer=fncInitWrk,
+                         initargs=(strPthIn, tplOt, strPathRef, dicPrm)
+                         ) as objPool:
+
+                # Status indicator (report progress in steps of ten percent):
+                varCntSts = 0
+                for idxTsk, _ in enumerate(objPool.imap_unordered(
+                        fncDiffVol, range(tplShp[3]))):
+                    varPrc = int(np.floor(float(idxTsk + 1)
+                                          / float(tplShp[3]) * 10.0))
+                    if varPrc > varCntSts:
+                        varCntSts = varPrc
+                        print('---------Progress: ' + str(varPrc * 10)
+                              + ' %')
+
+                objPool.close()
+                objPool.join()
+
+        except BaseException:
+            del(aryOt)
+            os.remove(strPthTmp)
+            raise
+
+        fncNiiCommit(aryOt, strPthTmp, strPathOt, varLvl=varLvl,
+                     varPar=varPar)
+
+    finally:
+        if strPthIn != strPathIn:
+            os.remove(strPthIn)
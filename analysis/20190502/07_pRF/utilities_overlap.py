@@ -0,0 +1,500 @@
+# -*- coding: utf-8 -*-
+"""
+Stimulus-pRF overlap engine.
+
+Batched calculation of the overlap between Gaussian population receptive
+fields and regions of the visual field. Many voxels are evaluated per function
+call. The overlap is calculated on the supersampled visual field model, using
+the separability of the Gaussian (i.e. a chunked voxels x grid matrix
+product); the result is identical (up to rounding errors) to the sum over the
+visual field model for each voxel. Optionally, for regions that can be
+expressed as a (weighted) sum of rectangles, the overlap can be calculated in
+closed form (as product of differences of error functions). The closed form is
+the continuous limit of the sum over the visual field model, and can differ
+from it by several percentage points.
+"""
+
+# Part of texture analysis pipeline.
+# Copyright (C) 2019  Ingo Marquardt
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import multiprocessing as mp
+import numpy as np
+from scipy.special import erf
+
+
+# Shared arrays of the worker processes (set by `fncInitWrk`):
+dicShrd = {}
+
+
+def fncGaussMass(vecMu, vecSd, varMin, varMax):
+    """
+    Mass of one-dimensional Gaussians between two limits.
+
+    Parameters
+    ----------
+    vecMu : np.array
+        1D array with centres of the Gaussians (one per voxel).
+    vecSd : np.array
+        1D array with widths (SD) of the Gaussians (one per voxel).
+    varMin : float
+        Lower integration limit.
+    varMax : float
+        Upper integration limit.
+
+    Returns
+    -------
+    vecMass : np.array
+        Integral of the normalised Gaussians between `varMin` and `varMax`.
+    """
+    vecScl = np.sqrt(2.0) * vecSd
+    vecMass = 0.5 * (erf(np.divide((varMax - vecMu), vecScl))
+                     - erf(np.divide((varMin - vecMu), vecScl)))
+    return vecMass
+
+
+def fncOvrlpRect(vecX, vecY, vecSd, lstRct, tplFld):
+    """
+    Closed-form overlap between 2D Gaussian pRFs and rectangular regions.
+
+    Parameters
+    ----------
+    vecX : np.array
+        1D array with x-positions of pRF centres (one per voxel).
+    vecY : np.array
+        1D array with y-positions of pRF centres (one per voxel).
+    vecSd : np.array
+        1D array with pRF sizes (SD).
+    lstRct : list
+        List of rectangles, each defined as a tuple `(varX0, varX1, varY0,
+        varY1, varWght)`. The region is the weighted sum of the rectangles,
+        e.g. a frame can be defined as an outer rectangle with weight 1.0 and
+        an inner rectangle with weight -1.0.
+    tplFld : tuple
+        Extent of the visual field model, `(varXmin, varXmax, varYmin,
+        varYmax)`. The pRF mass is normalised by the mass within the visual
+        field (as for the grid-based overlap), and rectangles are clipped to
+        the visual field.
+
+    Returns
+    -------
+    vecRatio : np.array
+        Overlap ratio (percent of pRF mass within the visual field that is
+        contained in the region).
+
+    Notes
+    -----
+    This is the continuous limit of the grid-based overlap (see
+    `fncOvrlpGrid`), not an exact reproduction of it. The two differ by up to
+    several percentage points, e.g. for pRFs close to the limits of the
+    visual field, or pRFs that are small relative to the spacing of the
+    visual field model.
+    """
+    varXmin, varXmax, varYmin, varYmax = tplFld
+
+    # pRF mass within the visual field (the 2D Gaussian is separable, so the
+    # integral over a rectangle is the product of two 1D integrals):
+    vecDen = (fncGaussMass(vecX, vecSd, varXmin, varXmax)
+              * fncGaussMass(vecY, vecSd, varYmin, varYmax))
+
+    # pRF mass within the region:
+    vecNum = np.zeros(vecX.shape, dtype=np.float64)
+    for varX0, varX1, varY0, varY1, varWght in lstRct:
+        vecNum += (varWght
+                   * fncGaussMass(vecX, vecSd, max(varX0, varXmin),
+                                  min(varX1, varXmax))
+                   * fncGaussMass(vecY, vecSd, max(varY0, varYmin),
+                                  min(varY1, varYmax)))
+
+    vecRatio = np.zeros(vecX.shape, dtype=np.float64)
+    lgcVld = np.greater(vecDen, 0.0)
+    vecRatio[lgcVld] = np.divide(vecNum[lgcVld], vecDen[lgcVld]) * 100.0
+
+    return vecRatio
+
+
+def fncOvrlpGrid(vecX, vecY, vecSd, aryMsk, vecXcrd, vecYcrd,
+                 varChnk=20000):
+    """
+    Grid-based overlap between 2D Gaussian pRFs and arbitrary regions.
+
+    Parameters
+    ----------
+    vecX : np.array
+        1D array with x-positions of pRF centres (one per voxel).
+    vecY : np.array
+        1D array with y-positions of pRF centres (one per voxel).
+    vecSd : np.array
+        1D array with pRF sizes (SD).
+    aryMsk : np.array
+        3D array (region x y-position x x-position) representing one or
+        several regions on the supersampled visual field model (ones and
+        zeros).
+    vecXcrd : np.array
+        x-coordinates of the visual field model.
+    vecYcrd : np.array
+        y-coordinates of the visual field model.
+    varChnk : int
+        Number of voxels per chunk (limits the size of the intermediate
+        voxels x grid arrays).
+
+    Returns
+    -------
+    aryRatio : np.array
+        Overlap ratio (percent of pRF mass within the visual field that is
+        contained in the region), array of shape (regions, voxels).
+
+    Notes
+    -----
+    The Gaussian is separable, i.e. G(x, y) = g(x) * g(y). Therefore, the
+    overlap sum(G * M) can be computed as g(y).T * M * g(x), i.e. with one
+    matrix product per chunk of voxels, without evaluating the full 2D
+    Gaussian for every voxel. The Gaussian factors are evaluated once and
+    multiplied with all regions at the same time.
+    """
+    varNumVox = vecX.shape[0]
+    varNumRoi, varNumY, varNumX = aryMsk.shape
+    aryRatio = np.zeros((varNumRoi, varNumVox), dtype=np.float64)
+
+    # Regions side by side (y-position x (region, x-position)):
+    aryMskCat = np.reshape(
+        np.transpose(np.asarray(aryMsk, dtype=np.float64), (1, 0, 2)),
+        (varNumY, (varNumRoi * varNumX)))
+
+    for idxStr in range(0, varNumVox, varChnk):
+        idxStp = min((idxStr + varChnk), varNumVox)
+
+        # 1D Gaussian factors (voxels x grid):
+        aryGx, aryGy = fncGaussFct(vecX[idxStr:idxStp],
+                                   vecY[idxStr:idxStp],
+                                   vecSd[idxStr:idxStp],
+                                   vecXcrd,
+                                   vecYcrd)
+
+        # Overlap with regions (voxels x regions):
+        aryNum = np.einsum('irj,ij->ir',
+                           np.reshape(np.dot(aryGy, aryMskCat),
+                                      ((idxStp - idxStr),
+                                       varNumRoi,
+                                       varNumX)),
+                           aryGx)
+
+        # Total pRF mass on the visual field model:
+        vecDen = np.sum(aryGy, axis=1) * np.sum(aryGx, axis=1)
+
+        aryTmp = np.zeros(aryNum.shape, dtype=np.float64)
+        lgcVld = np.greater(vecDen, 0.0)
+        aryTmp[lgcVld, :] = (np.divide(aryNum[lgcVld, :],
+                                       vecDen[lgcVld, None])
+                             * 100.0)
+        aryRatio[:, idxStr:idxStp] = aryTmp.T
+
+    return aryRatio
+
+
+def fncGaussFct(vecX, vecY, vecSd, vecXcrd, vecYcrd):
+    """
+    Evaluate separable factors of 2D Gaussians on the visual field model.
+
+    Returns
+    -------
+    aryGx : np.array
+        Array of shape (voxels, number of x-coordinates).
+    aryGy : np.array
+        Array of shape (voxels, number of y-coordinates).
+    """
+    vecVar = 2.0 * np.square(vecSd)[:, None]
+    aryGx = np.exp(-np.divide(np.square(vecXcrd[None, :] - vecX[:, None]),
+                              vecVar))
+    aryGy = np.exp(-np.divide(np.square(vecYcrd[None, :] - vecY[:, None]),
+                              vecVar))
+    return aryGx, aryGy
+
+
+def fncNrstIdx(vecCrd, vecVal):
+    """
+    Index of the closest coordinate (first one in case of a tie).
+
+    Vectorised equivalent of `np.argmin(np.absolute(vecCrd - varVal))` for
+    sorted coordinates.
+    """
+    varNumCrd = vecCrd.shape[0]
+    vecIdx = np.searchsorted(vecCrd, vecVal, side='left')
+    vecIdx = np.clip(vecIdx, 1, (varNumCrd - 1))
+    vecLow = vecCrd[vecIdx - 1]
+    vecHgh = vecCrd[vecIdx]
+    lgcLow = np.less_equal(np.absolute(vecVal - vecLow),
+                           np.absolute(vecHgh - vecVal))
+    vecIdx[lgcLow] -= 1
+    return vecIdx
+
+
+def fncCntrHit(vecX, vecY, aryMsk, vecXcrd, vecYcrd):
+    """
+    Whether the pRF centres are located on the regions.
+
+    The pRF centres are assigned to the closest point of the visual field
+    model. Note that the first index of each region array is for the
+    y-position, and the second index for the x-position. Returns an array of
+    shape (regions, voxels).
+    """
+    vecXidx = fncNrstIdx(vecXcrd, vecX)
+    vecYidx = fncNrstIdx(vecYcrd, vecY)
+    return np.asarray(aryMsk, dtype=np.float64)[:, vecYidx, vecXidx]
+
+
+def fncPrfOvrlpMulti(vecX, vecY, vecSd, lstMsk, vecXcrd, vecYcrd,
+                     lstRct=None, varSdMin=0.2, varChnk=20000):
+    """
+    Calculate stimulus-pRF overlap for a batch of voxels and several ROIs.
+
+    Parameters
+    ----------
+    vecX, vecY, vecSd : np.array
+        1D arrays with pRF parameters (one entry per voxel).
+    lstMsk : list
+        List of 2D arrays (y-position x x-position) representing the ROIs on
+        the supersampled visual field model.
+    vecXcrd, vecYcrd : np.array
+        Coordinates of the visual field model.
+    lstRct : list or None
+        List with one entry per ROI. If an ROI can be expressed as a weighted
+        sum of rectangles (see `fncOvrlpRect`), its overlap ratio is
+        calculated in closed form (which differs from the grid-based overlap,
+        see notes of `fncOvrlpRect`). If the entry is None, the overlap is
+        calculated on the visual field model. If `lstRct` is None (default),
+        all ROIs are calculated on the visual field model.
+    varSdMin : float
+        Minimum pRF size. The overlap ratio of voxels with a smaller pRF size
+        is set to zero (implausibly small pRFs occur because of interpolation
+        at the surface of the brain).
+    varChnk : int
+        Number of voxels per chunk for the grid-based calculation.
+
+    Returns
+    -------
+    aryRatio : np.array
+        Overlap ratio [percent], array of shape (ROIs, voxels).
+    aryCntr : np.array
+        Whether the pRF centre is on the ROI (ones and zeros), array of shape
+        (ROIs, voxels).
+
+    Notes
+    -----
+    The Gaussian factors of each voxel are evaluated once for all ROIs that
+    are calculated on the visual field model.
+    """
+    vecX = np.asarray(vecX, dtype=np.float64)
+    vecY = np.asarray(vecY, dtype=np.float64)
+    vecSd = np.asarray(vecSd, dtype=np.float64)
+    aryMsk = np.stack(lstMsk, axis=0)
+    varNumRoi = aryMsk.shape[0]
+    if lstRct is None:
+        lstRct = [None] * varNumRoi
+
+    aryRatio = np.zeros((varNumRoi, vecX.shape[0]), dtype=np.float64)
+
+    # Exclude voxels with implausibly small pRF size:
+    lgcSd = np.greater_equal(vecSd, varSdMin)
+
+    # ROIs on visual field model:
+    lstIdxGrd = [idxRoi for idxRoi in range(varNumRoi)
+                 if lstRct[idxRoi] is None]
+    if len(lstIdxGrd) > 0:
+        aryTmp = fncOvrlpGrid(vecX[lgcSd], vecY[lgcSd], vecSd[lgcSd],
+                              aryMsk[lstIdxGrd, :, :], vecXcrd, vecYcrd,
+                              varChnk=varChnk)
+        for idxTmp, idxRoi in enumerate(lstIdxGrd):
+            aryRatio[idxRoi, lgcSd] = aryTmp[idxTmp, :]
+
+    # Rectangular ROIs (closed form):
+    tplFld = (vecXcrd[0], vecXcrd[-1], vecYcrd[0], vecYcrd[-1])
+    for idxRoi in range(varNumRoi):
+        if lstRct[idxRoi] is not None:
+            aryRatio[idxRoi, lgcSd] = fncOvrlpRect(vecX[lgcSd],
+                                                   vecY[lgcSd],
+                                                   vecSd[lgcSd],
+                                                   lstRct[idxRoi],
+                                                   tplFld)
+
+    aryCntr = fncCntrHit(vecX, vecY, aryMsk, vecXcrd, vecYcrd)
+
+    return aryRatio, aryCntr
+
+
+def fncPrfOvrlp(vecX, vecY, vecSd, aryLgcStim, vecXcrd, vecYcrd, lstRct=None,
+                varSdMin=0.2, varChnk=20000):
+    """
+    Calculate stimulus-pRF overlap for a batch of voxels and a single ROI.
+
+    See `fncPrfOvrlpMulti`. Returns 1D arrays with overlap ratio and pRF
+    centre on ROI.
+    """
+    aryRatio, aryCntr = fncPrfOvrlpMulti(vecX, vecY, vecSd, [aryLgcStim],
+                                         vecXcrd, vecYcrd, lstRct=[lstRct],
+                                         varSdMin=varSdMin, varChnk=varChnk)
+    return aryRatio[0, :], aryCntr[0, :]
+
+
+def fncShrdAry(aryIn):
+    """
+    Copy array into shared memory.
+
+    Returns
+    -------
+    tplShrd : tuple
+        Shared memory buffer (`multiprocessing.RawArray`) and shape of the
+        array. The data are stored at double precision.
+    """
+    aryIn = np.asarray(aryIn)
+    objRaw = mp.RawArray('d', int(aryIn.size))
+    if aryIn.size > 0:
+        np.frombuffer(objRaw, dtype=np.float64)[:] = aryIn.ravel()
+    return (objRaw, aryIn.shape)
+
+
+def fncShrdView(tplShrd):
+    """Numpy view on array in shared memory (see `fncShrdAry`)."""
+    objRaw, tplShp = tplShrd
+    return np.frombuffer(objRaw, dtype=np.float64).reshape(tplShp)
+
+
+def fncInitWrk(dicShrdIn, lstRct, varThrR, varSdMin, varChnk):
+    """Initialise worker process (called once per process)."""
+    # Numpy views on the shared arrays (no copy):
+    for strKey in dicShrdIn:
+        dicShrd[strKey] = fncShrdView(dicShrdIn[strKey])
+    dicShrd['lstRct'] = lstRct
+    dicShrd['varThrR'] = varThrR
+    dicShrd['varSdMin'] = varSdMin
+    dicShrd['varChnk'] = varChnk
+
+
+def fncOvrlpTsk(tplTsk):
+    """
+    Calculate stimulus-pRF overlap for all ROIs and one range of voxels.
+
+    The result is written directly into the shared output arrays.
+    """
+    idxStr, idxStp = tplTsk
+
+    # Voxels in range that fulfil the inclusion criterion (R2 threshold):
+    lgcInc = np.greater(dicShrd['aryR2'][idxStr:idxStp], dicShrd['varThrR'])
+
+    if np.any(lgcInc):
+        aryRatio, aryCntr = fncPrfOvrlpMulti(
+            dicShrd['aryX'][idxStr:idxStp][lgcInc],
+            dicShrd['aryY'][idxStr:idxStp][lgcInc],
+            dicShrd['arySd'][idxStr:idxStp][lgcInc],
+            list(dicShrd['aryMsk']),
+            dicShrd['vecXcrd'],
+            dicShrd['vecYcrd'],
+            lstRct=dicShrd['lstRct'],
+            varSdMin=dicShrd['varSdMin'],
+            varChnk=dicShrd['varChnk'])
+        dicShrd['aryRatio'][:, idxStr:idxStp][:, lgcInc] = aryRatio
+        dicShrd['aryCntr'][:, idxStr:idxStp][:, lgcInc] = aryCntr
+
+    return int(np.sum(lgcInc))
+
+
+def fncPrfOvrlpPool(vecX, vecY, vecSd, vecR2, lstMsk, lstRct, vecXcrd,
+                    vecYcrd, varThrR=0.1, varSdMin=0.2, varPar=1,
+                    varTskSze=50000, varChnk=20000):
+    """
+    Calculate stimulus-pRF overlap for several ROIs on a worker pool.
+
+    Parameters
+    ----------
+    vecX, vecY, vecSd, vecR2 : np.array
+        1D arrays with pRF parameters (one entry per voxel).
+    lstMsk : list
+        List of 2D arrays representing the ROIs on the supersampled visual
+        field model (see `fncPrfOvrlp`).
+    lstRct : list
+        List with one entry per ROI, either a list of rectangles (for closed
+        form calculation) or None (see `fncPrfOvrlp`).
+    vecXcrd, vecYcrd : np.array
+        Coordinates of the visual field model.
+    varThrR : float
+        Overlap is only calculated for voxels with an R2 value above this
+        threshold (zero otherwise).
+    varSdMin : float
+        Minimum pRF size (see `fncPrfOvrlp`).
+    varPar : int
+        Number of worker processes.
+    varTskSze : int
+        Number of voxels per task.
+    varChnk : int
+        Number of voxels per chunk for the grid-based calculation.
+
+    Returns
+    -------
+    aryRatio : np.array
+        Overlap ratio [percent], array of shape (ROIs, voxels).
+    aryCntr : np.array
+        Whether the pRF centre is on the ROI, array of shape (ROIs, voxels).
+
+    Notes
+    -----
+    The pRF parameters, the ROI masks, and the output arrays live in shared
+    memory. A single pool of worker processes is created for all ROIs, and
+    the workers write their results directly into the preallocated output
+    arrays (no pickling of data chunks or results). All ROIs are calculated
+    in a single pass (see `fncPrfOvrlpMulti`).
+    """
+    varNumRoi = len(lstMsk)
+    varNumVox = np.asarray(vecX).size
+
+    dicShrdIn = {'aryX': fncShrdAry(vecX),
+                 'aryY': fncShrdAry(vecY),
+                 'arySd': fncShrdAry(vecSd),
+                 'aryR2': fncShrdAry(vecR2),
+                 'aryMsk': fncShrdAry(np.stack(lstMsk, axis=0)),
+                 'vecXcrd': fncShrdAry(vecXcrd),
+                 'vecYcrd': fncShrdAry(vecYcrd),
+                 'aryRatio': fncShrdAry(np.zeros((varNumRoi, varNumVox))),
+                 'aryCntr': fncShrdAry(np.zeros((varNumRoi, varNumVox)))}
+
+    # List of tasks (range of voxels; each task covers all ROIs, so that the
+    # pRF model of every voxel is only evaluated once):
+    lstTsk = [(idxStr, min((idxStr + varTskSze), varNumVox))
+              for idxStr in range(0, varNumVox, varTskSze)]
+    varNumTsk = len(lstTsk)
+
+    # The workers are terminated when leaving the context (also on error, so
+    # that they do not keep the shared arrays alive):
+    with mp.Pool(processes=varPar,
+                 initializer=fncInitWrk,
+                 initargs=(dicShrdIn, lstRct, varThrR, varSdMin, varChnk)
+                 ) as objPool:
+
+        # Status indicator (report progress in steps of ten percent):
+        varCntSts = 0
+        for idxTsk, _ in enumerate(objPool.imap_unordered(fncOvrlpTsk,
+                                                          lstTsk)):
+            varPrc = int(np.floor(float(idxTsk + 1) / float(varNumTsk)
+                                  * 10.0))
+            if varPrc > varCntSts:
+                varCntSts = varPrc
+                print('---------Progress: ' + str(varPrc * 10) + ' %')
+
+        objPool.close()
+        objPool.join()
+
+    aryRatio = np.copy(fncShrdView(dicShrdIn['aryRatio']))
+    aryCntr = np.copy(fncShrdView(dicShrdIn['aryCntr']))
+
+    return aryRatio, aryCntr
@@ -18,12 +18,160 @@
 # this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from __future__ import division
-import numpy as np
 import warnings
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+
+def _flux(delta, out, inv_kappa2, scale, option, cond=None):
+    """Conduction flux g(delta) * delta, scaled (in place, float32).
+
+    Parameters
+    ----------
+    delta : numpy array
+        Intensity differences between neighbouring voxels.
+    out : numpy array
+        Output buffer, same shape as `delta` (must not be `delta`).
+    inv_kappa2 : np.float32
+        1 / kappa**2.
+    scale : np.float32
+        Factor applied to the flux (skipped if 1).
+    option : int, 1 or 2
+        Diffusion equation (see `aniso_diff_3D`).
+    cond : numpy array or None
+        Differences from which the conduction coefficients g are computed
+        (e.g. of a reference image). If None, `delta` is used.
+
+    """
+    np.square((delta if cond is None else cond), out=out)
+    if option == 1:
+        np.multiply(out, -inv_kappa2, out=out)
+        np.exp(out, out=out)
+    else:
+        np.multiply(out, inv_kappa2, out=out)
+        np.add(out, np.float32(1.), out=out)
+        np.reciprocal(out, out=out)
+    if scale != 1.:
+        np.multiply(out, scale, out=out)
+    np.multiply(out, delta, out=out)
+
+
+def _delta(arr, a, b, nxt, delta, axis):
+    """Differences to the next voxel along `axis`, planes [a, b) of `arr`.
+
+    The differences are zero at the end of the axis. For axis 0, `nxt` is
+    the plane after the block (None at the edge of the volume).
+
+    """
+    if axis == 0:
+        np.subtract(arr[(a + 1):b], arr[a:(b - 1)], out=delta[:-1])
+        if nxt is None:
+            delta[-1].fill(0.)
+        else:
+            np.subtract(nxt, arr[b - 1], out=delta[-1])
+    elif axis == 1:
+        np.subtract(arr[a:b, 1:, :], arr[a:b, :-1, :], out=delta[:, :-1, :])
+        delta[:, -1, :].fill(0.)
+    else:
+        np.subtract(arr[a:b, :, 1:], arr[a:b, :, :-1], out=delta[:, :, :-1])
+        delta[:, :, -1].fill(0.)
+
+
+def _diffuse_slab(stackout, z0, z1, halo, buf, inv_kappa2, scales, option,
+                  ref=None):
+    """One diffusion iteration on the z-slab [z0, z1) of `stackout`, in place.
+
+    The slab is processed block by block (in ascending z). The flux between
+    the last plane of a block and the next plane is kept for the next block,
+    so that the planes of a block can be updated in place before the next
+    block is processed. The planes adjacent to the slab (which are updated
+    by other threads) are read from the halo, i.e. from copies that are made
+    before the iteration.
+
+    Parameters
+    ----------
+    stackout : 3d numpy array, float32
+        Data, updated in place.
+    z0, z1 : int
+        First and last (exclusive) plane of the slab.
+    halo : list
+        Copies of the planes z0 - 1 and z1 (None at the edges of the volume).
+    buf : dict
+        Preallocated buffers of the slab ('delta', 'flux', 'acc', and
+        'rdelta' if a reference is used: blocks of planes; 'prev': one
+        plane).
+    inv_kappa2 : np.float32
+        1 / kappa**2.
+    scales : tuple
+        Relative weights of the fluxes along (z, y, x), and common factor
+        (gamma / step), np.float32.
+    option : int, 1 or 2
+        Diffusion equation (see `aniso_diff_3D`).
+    ref : 3d numpy array, float32, or None
+        Reference image for the conduction coefficients (not modified, see
+        `aniso_diff_3D`).
+
+    """
+    nz = buf['delta'].shape[0]
+    prev = buf['prev']
+    nz_total = stackout.shape[0]
+
+    # Flux between the plane before the slab and the first plane of the slab
+    # (zero at the edge of the volume):
+    if halo[0] is None:
+        prev.fill(0.)
+    else:
+        np.subtract(stackout[z0], halo[0], out=buf['delta'][0])
+        rdelta = None
+        if ref is not None:
+            rdelta = buf['rdelta'][0]
+            np.subtract(ref[z0], ref[z0 - 1], out=rdelta)
+        _flux(buf['delta'][0], prev, inv_kappa2, scales[0], option,
+              cond=rdelta)
+
+    for a in range(z0, z1, nz):
+        b = min(a + nz, z1)
+        k = b - a
+        delta = buf['delta'][:k]
+        flux = buf['flux'][:k]
+        acc = buf['acc'][:k]
+        rdelta = None if ref is None else buf['rdelta'][:k]
+        block = stackout[a:b]
+
+        for axis in range(3):
+
+            # Differences (along z, to the next plane, which is either not
+            # yet updated, or read from the halo):
+            nxt = stackout[b] if b < z1 else halo[1]
+            _delta(stackout, a, b, nxt, delta, axis)
+            if ref is not None:
+                nxt = ref[b] if b < nz_total else None
+                _delta(ref, a, b, nxt, rdelta, axis)
+            _flux(delta, flux, inv_kappa2, scales[axis], option, cond=rdelta)
+
+            # Divergence of the flux:
+            if axis == 0:
+                np.subtract(flux[0], prev, out=acc[0])
+                np.subtract(flux[1:], flux[:-1], out=acc[1:])
+                prev[...] = flux[-1]
+            elif axis == 1:
+                np.add(acc, flux, out=acc)
+                np.subtract(acc[:, 1:, :], flux[:, :-1, :],
+                            out=acc[:, 1:, :])
+            else:
+                np.add(acc, flux, out=acc)
+                np.subtract(acc[:, :, 1:], flux[:, :, :-1],
+                            out=acc[:, :, 1:])
+
+        # Update the block:
+        if scales[3] != 1.:
+            np.multiply(acc, scales[3], out=acc)
+        np.add(block, acc, out=block)
 
 
 def aniso_diff_3D(stack, niter=1, kappa=50, gamma=0.1, step=(1., 1., 1.),
-                  option=1, ploton=False):
+                  option=1, ploton=False, nthreads=1, inplace=False,
+                  block_mb=0.25, ref=None):
     """3D anisotropic diffusion based smoothing.
 
     Acknowledgements
@@ -57,6 +205,20 @@ def aniso_diff_3D(stack, niter=1, kappa=50, gamma=0.1, step=(1., 1., 1.),
         equation No 2).
     ploton : bool
         If True, the middle z-plane will be plotted on every iteration.
+    nthreads : int
+        Number of threads. The volume is divided into this many slabs along
+        the first axis (z), which are diffused in parallel.
+    inplace : bool
+        If True and `stack` is a C-contiguous float32 3d array, the diffusion
+        is performed in `stack` itself (no copy of the volume is made).
+    block_mb : float
+        Size of each of the working buffers of a thread [MB], see notes. The
+        buffers should fit into the (L2) cache of the CPU.
+    ref : 3d numpy array or None
+        Reference image of the same shape (e.g. a mean image). If provided,
+        the conduction coefficients are computed from the gradients of the
+        reference (which is not diffused) instead of the gradients of the
+        stack, so that the same edges are preserved in several images.
 
     Returns
     -------
@@ -86,28 +248,70 @@ def aniso_diff_3D(stack, niter=1, kappa=50, gamma=0.1, step=(1., 1., 1.),
     July 2012 translated to Python
     January 2017 docstring reorganization.
 
+    The volume is updated in place, in blocks of planes along z (of about
+    `block_mb` MB each, at least one plane). The conduction fluxes of a block
+    are computed into preallocated float32 buffers, so that the memory
+    footprint is the volume plus three blocks per thread, independent of the
+    number of iterations.
+    Each flux between neighbouring voxels is computed once per iteration.
+    With more than one thread, each thread diffuses one z-slab; the planes
+    adjacent to the slabs are copied (halo) before each iteration, so that
+    the result does not depend on the number of threads. The result is
+    identical to that of the original implementation up to float32 rounding.
+
     """
     # ...you could always diffuse each color channel independently if you
     # really want
+    # (see `aniso_diff_4D` for diffusing each volume of a 4D stack)
     if stack.ndim == 4:
-            warnings.warn("Only grayscale stacks allowed, converting to 3D \
-                          matrix")
-            stack = stack.mean(3)
+        warnings.warn("Only grayscale stacks allowed, converting to 3D "
+                      "matrix")
+        stack = stack.mean(3)
+
+    if option not in (1, 2):
+        raise ValueError("option must be 1 or 2")
+
+    if ref is not None:
+        ref = np.ascontiguousarray(ref, dtype=np.float32)
+        if ref.shape != stack.shape:
+            raise ValueError("Shape of reference differs from stack")
 
     # initialize output array
-    stack = stack.astype('float32')
-    stackout = stack.copy()
-
-    # initialize some internal variables
-    deltaS = np.zeros_like(stackout)
-    deltaE = deltaS.copy()
-    deltaD = deltaS.copy()
-    NS = deltaS.copy()
-    EW = deltaS.copy()
-    UD = deltaS.copy()
-    gS = np.ones_like(stackout)
-    gE = gS.copy()
-    gD = gS.copy()
+    if (inplace and (stack.dtype == np.float32)
+            and stack.flags['C_CONTIGUOUS']):
+        stackout = stack
+    else:
+        stackout = np.array(stack, dtype=np.float32, order='C')
+
+    # constants (float32, so that no float64 temporaries are created)
+    inv_kappa2 = np.float32(1. / (float(kappa) ** 2.))
+    # (the common factor gamma / step is applied once to the sum of the
+    # fluxes, with relative weights for the three directions)
+    scales = [float(gamma) / float(step[idx]) for idx in range(3)]
+    scales = tuple([np.float32(scl / scales[0]) for scl in scales]
+                   + [np.float32(scales[0])])
+
+    # z-slabs (one per thread), and preallocated buffers of each slab
+    nz_total = stackout.shape[0]
+    nslabs = max(1, min(int(nthreads), nz_total))
+    bounds = np.linspace(0, nz_total, (nslabs + 1)).astype(np.int64)
+    plane_shape = stackout.shape[1:]
+    plane_bytes = max(1, stackout[0].nbytes)
+    slabs = []
+    for z0, z1 in zip(bounds[:-1], bounds[1:]):
+        nz = int(max(1, min((z1 - z0), (block_mb * 1e6) // plane_bytes)))
+        slabs.append({
+            'z0': int(z0),
+            'z1': int(z1),
+            'halo': [None if z0 == 0 else np.empty(plane_shape, np.float32),
+                     None if z1 == nz_total else np.empty(plane_shape,
+                                                          np.float32)],
+            'buf': {'delta': np.empty(((nz,) + plane_shape), np.float32),
+                    'flux': np.empty(((nz,) + plane_shape), np.float32),
+                    'acc': np.empty(((nz,) + plane_shape), np.float32),
+                    'rdelta': (None if ref is None else
+                               np.empty(((nz,) + plane_shape), np.float32)),
+                    'prev': np.empty(plane_shape, np.float32)}})
 
     # create the plot figure, if requested
     if ploton:
@@ -118,7 +322,7 @@ def aniso_diff_3D(stack, niter=1, kappa=50, gamma=0.1, step=(1., 1., 1.),
         fig = pl.figure(figsize=(20, 5.5), num="Anisotropic diffusion")
         ax1, ax2 = fig.add_subplot(1, 2, 1), fig.add_subplot(1, 2, 2)
 
-        ax1.imshow(stack[showplane, ...].squeeze(),
+        ax1.imshow(np.array(stack[showplane, ...]).squeeze(),
                    interpolation='nearest')
         ih = ax2.imshow(stackout[showplane, ...].squeeze(),
                         interpolation='nearest', animated=True)
@@ -127,45 +331,178 @@ def aniso_diff_3D(stack, niter=1, kappa=50, gamma=0.1, step=(1., 1., 1.),
 
         fig.canvas.draw()
 
-    for ii in xrange(niter):
-
-            # calculate the diffs
-            deltaD[:-1, :, :] = np.diff(stackout, axis=0)
-            deltaS[:, :-1, :] = np.diff(stackout, axis=1)
-            deltaE[:, :, :-1] = np.diff(stackout, axis=2)
-
-            # conduction gradients (only need to compute one per dim!)
-            if option == 1:
-                    gD = np.exp(-(deltaD/kappa)**2.)/step[0]
-                    gS = np.exp(-(deltaS/kappa)**2.)/step[1]
-                    gE = np.exp(-(deltaE/kappa)**2.)/step[2]
-            elif option == 2:
-                    gD = 1./(1.+(deltaD/kappa)**2.)/step[0]
-                    gS = 1./(1.+(deltaS/kappa)**2.)/step[1]
-                    gE = 1./(1.+(deltaE/kappa)**2.)/step[2]
-
-            # update matrices
-            D = gD*deltaD
-            E = gE*deltaE
-            S = gS*deltaS
-
-            # subtract a copy that has been shifted 'Up/North/West' by one
-            # pixel.
-            UD[:] = D
-            NS[:] = S
-            EW[:] = E
-            UD[1:, :, :] -= D[:-1, :, :]
-            NS[:, 1:, :] -= S[:, :-1, :]
-            EW[:, :, 1:] -= E[:, :, :-1]
-
-            # update the image
-            stackout += gamma*(UD+NS+EW)
+    pool = ThreadPoolExecutor(max_workers=nslabs) if nslabs > 1 else None
+
+    try:
+        for ii in range(niter):
+
+            # copy the planes adjacent to each slab (before any thread
+            # updates them)
+            for slab in slabs:
+                if slab['halo'][0] is not None:
+                    slab['halo'][0][...] = stackout[slab['z0'] - 1]
+                if slab['halo'][1] is not None:
+                    slab['halo'][1][...] = stackout[slab['z1']]
+
+            # update the image (slab by slab)
+            lst_args = [(stackout, slab['z0'], slab['z1'], slab['halo'],
+                         slab['buf'], inv_kappa2, scales, option, ref)
+                        for slab in slabs]
+            if pool is None:
+                _diffuse_slab(*lst_args[0])
+            else:
+                for ftr in [pool.submit(_diffuse_slab, *args)
+                            for args in lst_args]:
+                    ftr.result()
 
             if ploton:
-                    iterstring = "Iteration %i" % (ii+1)
-                    ih.set_data(stackout[showplane, ...].squeeze())
-                    ax2.set_title(iterstring)
-                    fig.canvas.draw()
-                    # sleep(0.01)
+                iterstring = "Iteration %i" % (ii+1)
+                ih.set_data(stackout[showplane, ...].squeeze())
+                ax2.set_title(iterstring)
+                fig.canvas.draw()
+                # sleep(0.01)
+
+    finally:
+        if pool is not None:
+            pool.shutdown()
 
     return stackout
+
+
+def aniso_diff_3D_tiled(stack, out, niter=1, kappa=50, gamma=0.1,
+                        step=(1., 1., 1.), option=1, axis=0, tile_mb=256.,
+                        nthreads=1, block_mb=0.25, ref=None):
+    """3D anisotropic diffusion, tile by tile (for volumes larger than RAM).
+
+    The volume is divided into tiles along one axis. Each tile is read with
+    ghost layers of `niter` planes on either side, diffused in memory (see
+    `aniso_diff_3D`), and the tile without the ghost layers is written to the
+    output. Because the diffusion spreads by one voxel per iteration, the
+    errors at the (artificial) borders of a tile do not reach the tile
+    itself, and the result is bit-identical to that of `aniso_diff_3D` on the
+    whole volume.
+
+    Parameters
+    ----------
+    stack : 3d array-like
+        Input volume, supporting slicing (e.g. np.memmap, or the array proxy
+        of a nibabel image).
+    out : 3d array-like
+        Output volume of the same shape (e.g. np.memmap, float32). Can be the
+        same as `stack`, in which case the input is overwritten.
+    niter, kappa, gamma, step, option, nthreads, block_mb :
+        See `aniso_diff_3D`.
+    ref : 3d array-like or None
+        Reference image for the conduction coefficients (see
+        `aniso_diff_3D`), read tile by tile as the stack.
+    axis : int
+        Axis along which the volume is tiled. For memory-mapped data, this
+        should be the slowest axis on disk (i.e. the last axis for nii data,
+        which are saved in Fortran order), so that each tile is read from a
+        contiguous part of the file.
+    tile_mb : float
+        Size of a tile (without ghost layers) [MB]; a tile has at least
+        `niter` planes. Memory usage is about
+        that of two tiles (the diffused tile is written to the output after
+        the next tile has been read).
+
+    Returns
+    -------
+    out : 3d array-like
+        Diffused volume.
+
+    """
+    if len(stack.shape) != 3:
+        raise ValueError("Only 3D stacks allowed in tiled mode")
+
+    nz_total = stack.shape[axis]
+    plane_bytes = 4 * max(1, int(np.prod(stack.shape)) // max(1, nz_total))
+    ghost = int(niter)
+    # (a tile is at least as thick as the ghost layers, see below)
+    nz = int(max(1, ghost, (tile_mb * 1e6) // plane_bytes))
+
+    # If the output is the input, the planes of a tile (including its ghost
+    # layers) must not be overwritten before they are read. Each tile is
+    # therefore written after the next tile has been read (the ghost layers
+    # of the tile after the next one do not reach back to the tile, because
+    # the tiles are at least as thick as the ghost layers):
+    pending = None
+
+    for z0 in range(0, nz_total, nz):
+        z1 = min(nz_total, z0 + nz)
+        g0 = max(0, z0 - ghost)
+        g1 = min(nz_total, z1 + ghost)
+
+        idx_in = [slice(None)] * 3
+        idx_in[axis] = slice(g0, g1)
+        tile = np.array(stack[tuple(idx_in)], dtype=np.float32, order='C')
+
+        if pending is not None:
+            idx_ot = [slice(None)] * 3
+            idx_ot[axis] = pending[0]
+            out[tuple(idx_ot)] = pending[1]
+
+        # (the axes of the tile are not reordered, so that the fluxes are
+        # summed in the same order as for the whole volume)
+        tile = aniso_diff_3D(tile, niter=niter, kappa=kappa, gamma=gamma,
+                             step=step, option=option, nthreads=nthreads,
+                             inplace=True, block_mb=block_mb,
+                             ref=(None if ref is None else
+                                  ref[tuple(idx_in)]))
+
+        idx_tile = [slice(None)] * 3
+        idx_tile[axis] = slice((z0 - g0), (z1 - g0))
+        pending = (slice(z0, z1), tile[tuple(idx_tile)])
+
+    if pending is not None:
+        idx_ot = [slice(None)] * 3
+        idx_ot[axis] = pending[0]
+        out[tuple(idx_ot)] = pending[1]
+
+    return out
+
+
+def aniso_diff_4D(stack, out=None, niter=1, kappa=50, gamma=0.1,
+                  step=(1., 1., 1.), option=1, nthreads=1, block_mb=0.25,
+                  ref=None):
+    """Anisotropic diffusion of each volume of a 4D stack, independently.
+
+    Parameters
+    ----------
+    stack : 4d array-like
+        Input stack (x, y, z, volumes), e.g. a functional time series or
+        multi-echo data. The volumes are read one by one (e.g. from a
+        np.memmap).
+    out : 4d array-like or None
+        Output of the same shape, written volume by volume (e.g. a np.memmap).
+        If None, a float32 array is created.
+    niter, kappa, gamma, step, option, nthreads, block_mb :
+        See `aniso_diff_3D`.
+    ref : 3d array-like or None
+        Reference image (x, y, z) for the conduction coefficients of all
+        volumes (see `aniso_diff_3D`). If None, the conduction coefficients
+        of each volume are computed from the volume itself.
+
+    Returns
+    -------
+    out : 4d array-like
+        Diffused stack (each volume is identical to the result of
+        `aniso_diff_3D` on that volume).
+
+    """
+    if len(stack.shape) != 4:
+        raise ValueError("Only 4D stacks allowed")
+    if out is None:
+        out = np.empty(stack.shape, dtype=np.float32)
+    if ref is not None:
+        # (converted once for all volumes)
+        ref = np.ascontiguousarray(ref, dtype=np.float32)
+
+    for idx in range(stack.shape[3]):
+        vol = np.array(stack[..., idx], dtype=np.float32, order='C')
+        out[..., idx] = aniso_diff_3D(vol, niter=niter, kappa=kappa,
+                                      gamma=gamma, step=step, option=option,
+                                      nthreads=nthreads, inplace=True,
+                                      block_mb=block_mb, ref=ref)
+
+    return out
@@ -0,0 +1,325 @@
+# -*- coding: utf-8 -*-
+"""
+Convert collections of single-volume vtk meshes into npy arrays (in parallel).
+
+The vtk files are parsed on a process pool, and each volume is written
+directly into its slot of a preallocated npy file (memory-mapped), of shape
+(depth, volume, vertex). The vtk files are only deleted after the npy file has
+been completely written and flushed to disk.
+
+The progress of the conversion is recorded in a manifest (json file next to
+the npy file). If the conversion is interrupted, it can be resumed: volumes
+that have already been written are skipped.
+"""
+
+# Part of py_depthsampling library
+# Copyright (C) 2018  Ingo Marquardt
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import json
+import multiprocessing as mp
+import numpy as np
+from loadVtkMulti import funcLoadVtkMulti
+
+
+def funcFsync(strPth):
+    """Flush file (or directory) to disk."""
+    varFd = os.open(strPth, os.O_RDONLY)
+    try:
+        os.fsync(varFd)
+    finally:
+        os.close(varFd)
+
+
+def funcMnfSave(strPthMnf, dicMnf):
+    """
+    Save progress manifest (atomically).
+
+    The manifest is first written to a temporary file, which is then renamed,
+    so that the manifest on disk is always complete.
+    """
+    with open(strPthMnf + '.tmp', 'w') as objFle:
+        json.dump(dicMnf, objFle)
+    os.replace((strPthMnf + '.tmp'), strPthMnf)
+
+
+def funcMnfLoad(strPthMnf, strPthPrt, lstFls):
+    """
+    Load progress manifest of interrupted conversion.
+
+    Returns the manifest (dictionary with the list of vtk files, the shape of
+    the npy array, and the indices of volumes that have been written), or None
+    if there is no (valid) manifest.
+    """
+    if not os.path.isfile(strPthMnf):
+        return None
+    with open(strPthMnf, 'r') as objFle:
+        dicMnf = json.load(objFle)
+    # The manifest is only valid if the (temporary) npy file exists and has
+    # the expected shape, and if the vtk files have not changed:
+    if not os.path.isfile(strPthPrt):
+        return None
+    if tuple(np.load(strPthPrt, mmap_mode='r').shape) != \
+            tuple(dicMnf['shape']):
+        return None
+    if dicMnf['files'] != [os.path.basename(f) for f in lstFls]:
+        return None
+    return dicMnf
+
+
+def funcCnvVol(tplTsk):
+    """
+    Load one vtk file, and write it into its slot of the npy file.
+
+    Parameters
+    ----------
+    tplTsk : tuple
+        Path of vtk file, path of (preallocated) npy file, index of volume,
+        string preceding the vertex data, number of lines between that string
+        and the data, and number of depth levels (see `funcLoadVtkMulti`).
+
+    Returns
+    -------
+    tplTsk : tuple
+        The task (for bookkeeping in the parent process).
+    """
+    strPthVtk, strPthNpy, idxVol, strPrcdData, varNumLne, varNumDpth = tplTsk
+
+    aryTmp = funcLoadVtkMulti(strPthVtk,
+                              strPrcdData,
+                              varNumLne,
+                              varNumDpth)
+
+    aryErt = np.load(strPthNpy, mmap_mode='r+')
+
+    if aryTmp.shape[0] != aryErt.shape[2]:
+        raise ValueError('Number of vertices of ' + strPthVtk + ' ('
+                         + str(aryTmp.shape[0]) + ') differs from first '
+                         + 'volume (' + str(aryErt.shape[2]) + ').')
+
+    aryErt[:, idxVol, :] = aryTmp.T
+    aryErt.flush()
+    del(aryErt)
+
+    return tplTsk
+
+
+def funcFnlDir(strDirTmp, strPthPrt, strPthNpy, lstFls):
+    """
+    Finalise npy file of one directory, and delete vtk files.
+
+    The (completely written) temporary npy file is flushed to disk, and
+    renamed. The vtk files are deleted afterwards, and finally the progress
+    manifest.
+    """
+    print(('--Saving to disk: ' + strPthNpy))
+    # The temporary npy file does not exist anymore if the conversion was
+    # interrupted after renaming it:
+    if os.path.isfile(strPthPrt):
+        funcFsync(strPthPrt)
+        os.replace(strPthPrt, strPthNpy)
+        funcFsync(strDirTmp)
+    # Delete vtk files (only now that the npy file is on disk):
+    for strPthVtk in lstFls:
+        if os.path.isfile(strPthVtk):
+            os.remove(strPthVtk)
+    os.remove(strPthNpy + '.manifest.json')
+
+
+def funcVtkDir(strDirTmp):
+    """
+    List of vtk files in directory (sorted), and path of npy output file.
+
+    The output file is named after the directory (i.e. after the condition):
+    'aryErt_<condition>.npy'.
+    """
+    # Condition name (needed for file names):
+    strCondTmp = os.path.split(strDirTmp)[1]
+
+    # Get list of vtk files in target directory (sorted):
+    lstFls = sorted([f for f in os.listdir(strDirTmp) if '.vtk' in f])
+    lstFls = [os.path.join(strDirTmp, f) for f in lstFls]
+
+    strPthNpy = os.path.join(strDirTmp, ('aryErt_' + strCondTmp + '.npy'))
+
+    return lstFls, strPthNpy
+
+
+def funcVtkToNpy(lstDir, strPrcdData, varNumLne, varNumDpth, varPar,
+                 lgcRsm=True):
+    """
+    Convert single-volume vtk files of several directories to npy files.
+
+    Parameters
+    ----------
+    lstDir : list
+        Directories with vtk files (one file per volume). The files are sorted
+        by name to determine the order of volumes.
+    strPrcdData : str
+        Beginning of string which precedes vertex data in vtk files.
+    varNumLne : int
+        Number of lines between vertex-identification-string and first data
+        point.
+    varNumDpth : int
+        Number of cortical depths.
+    varPar : int
+        Number of processes.
+    lgcRsm : bool
+        Whether to resume an interrupted conversion (if False, the conversion
+        starts from scratch).
+
+    Notes
+    -----
+    The volumes of all directories are distributed over the same process
+    pool, so that the directories are converted concurrently. The npy file of
+    each directory is written to a temporary file ('<name>.npy.part'), which
+    is flushed to disk and renamed once all volumes have been written. Only
+    then the vtk files of that directory are deleted. If the conversion is
+    interrupted, the vtk files are therefore never lost.
+
+    The progress is recorded in a manifest ('<name>.npy.manifest.json'; list
+    of vtk files, shape, and indices of volumes that have been written). A
+    volume is only marked as done after it has been flushed to the npy file.
+    When the conversion is resumed, volumes that are marked as done are
+    skipped. If the conversion was interrupted after the npy file has been
+    renamed (but before all vtk files have been deleted), the deletion is
+    completed.
+    """
+    lstTsk = []
+    dicDir = {}
+
+    for strDirTmp in lstDir:
+
+        print(('--Target directory: ' + strDirTmp))
+
+        lstFls, strPthNpy = funcVtkDir(strDirTmp)
+        strPthPrt = strPthNpy + '.part'
+        strPthMnf = strPthNpy + '.manifest.json'
+
+        # Conversion was interrupted after npy file was completed (during
+        # deletion of vtk files):
+        if (lgcRsm and os.path.isfile(strPthMnf)
+                and (not os.path.isfile(strPthPrt))
+                and os.path.isfile(strPthNpy)):
+            with open(strPthMnf, 'r') as objFle:
+                dicMnf = json.load(objFle)
+            if len(dicMnf['done']) == dicMnf['shape'][1]:
+                print('---Completing interrupted conversion')
+                funcFnlDir(strDirTmp, strPthPrt, strPthNpy,
+                           [os.path.join(strDirTmp, f)
+                            for f in dicMnf['files']])
+                continue
+
+        # Number of volumes:
+        varNumVol = len(lstFls)
+        print(('---Number of volumes: ' + str(varNumVol)))
+
+        if varNumVol == 0:
+            continue
+
+        # Progress of interrupted conversion:
+        if lgcRsm:
+            dicMnf = funcMnfLoad(strPthMnf, strPthPrt, lstFls)
+        else:
+            dicMnf = None
+
+        if dicMnf is None:
+
+            # Load first volume, to get the number of vertices (has to be
+            # equal across volumes):
+            aryTmp = funcLoadVtkMulti(lstFls[0],
+                                      strPrcdData,
+                                      varNumLne,
+                                      varNumDpth)
+            varNumVrtc = aryTmp.shape[0]
+
+            # Preallocate npy file (temporary name):
+            aryErt = np.lib.format.open_memmap(strPthPrt,
+                                               mode='w+',
+                                               dtype=np.float32,
+                                               shape=(varNumDpth, varNumVol,
+                                                      varNumVrtc))
+            aryErt[:, 0, :] = aryTmp.T
+            aryErt.flush()
+            del(aryErt)
+
+            dicMnf = {'files': [os.path.basename(f) for f in lstFls],
+                      'shape': [varNumDpth, varNumVol, varNumVrtc],
+                      'done': [0]}
+            funcMnfSave(strPthMnf, dicMnf)
+
+        else:
+
+            print(('---Resuming interrupted conversion ('
+                   + str(len(dicMnf['done'])) + ' volumes done)'))
+
+        # Tasks for remaining volumes:
+        setDne = set(dicMnf['done'])
+        lstTmp = [idxVol for idxVol in range(varNumVol)
+                  if idxVol not in setDne]
+        for idxVol in lstTmp:
+            lstTsk.append((lstFls[idxVol], strPthPrt, idxVol, strPrcdData,
+                           varNumLne, varNumDpth))
+
+        # Directory, path of npy file, vtk files, number of volumes that
+        # remain to be converted, and progress manifest:
+        dicDir[strPthPrt] = [strDirTmp, strPthNpy, lstFls, len(lstTmp),
+                             dicMnf]
+
+    # Directories without further volumes are completed immediately:
+    lstDne = [strPthPrt for strPthPrt in dicDir
+              if dicDir[strPthPrt][3] == 0]
+
+    varNumTsk = len(lstTsk)
+    print(('--Converting ' + str(varNumTsk) + ' volumes on '
+           + str(varPar) + ' processes'))
+
+    # The workers are terminated when leaving the context (also on error, so
+    # that no worker keeps writing into the npy files while the progress
+    # manifests are unwound):
+    with mp.Pool(processes=varPar) as objPool:
+
+        for idxTsk, tplTsk in enumerate(objPool.imap_unordered(funcCnvVol,
+                                                               lstTsk)):
+
+            # Status indicator (every 10%):
+            if (varNumTsk > 10) and ((idxTsk + 1) % (varNumTsk // 10) == 0):
+                print(('---Progress: ' + str(idxTsk + 1) + ' of '
+                       + str(varNumTsk) + ' volumes'))
+
+            # Record progress (the volume has been flushed to the npy file):
+            dicDir[tplTsk[1]][4]['done'].append(tplTsk[2])
+            funcMnfSave((dicDir[tplTsk[1]][1] + '.manifest.json'),
+                        dicDir[tplTsk[1]][4])
+
+            dicDir[tplTsk[1]][3] -= 1
+            if dicDir[tplTsk[1]][3] == 0:
+                lstDne.append(tplTsk[1])
+
+            # Finalise directories that are complete (while the pool continues
+            # with the other directories):
+            while len(lstDne) > 0:
+                strPthPrt = lstDne.pop()
+                funcFnlDir(dicDir[strPthPrt][0], strPthPrt,
+                           dicDir[strPthPrt][1], dicDir[strPthPrt][2])
+
+        objPool.close()
+        objPool.join()
+
+    # Directories with a single volume:
+    for strPthPrt in lstDne:
+        funcFnlDir(dicDir[strPthPrt][0], strPthPrt, dicDir[strPthPrt][1],
+                   dicDir[strPthPrt][2])
@@ -18,8 +18,8 @@
 
 ###############################################################################
 # Depth sampling meta script. Perform depth sampling with CBS tools and post- #
-# process results (file renaming and conversion of event-related time course  #
-# vtk meshes to npy format).                                                  #
+# process results (file renaming, combination of statistical maps, and       #
+# conversion of event-related time course vtk meshes to npy format).         #
 ###############################################################################
 
 
@@ -38,9 +38,10 @@ aryCbs=(cbs_lh_glm_prf.LayoutXML \
 # Names of python scripts to run:
 aryPy=(renameJistOutput.py \
        renameJistOutput_ert.py \
-       postprocess_retinotopy_vtk_lh.py \
-       postprocess_retinotopy_vtk_rh.py \
-       vtk_to_npy_conversion.py)
+       postprocess_retinotopy_vtk.py \
+       vtk_maps_conversion.py \
+       vtk_to_npy_conversion.py \
+       mesh_store_conversion.py)
 
 # Working directory:
 strPthWd="${pacman_data_path}${pacman_sub_id}/cbs/cbs_wd"
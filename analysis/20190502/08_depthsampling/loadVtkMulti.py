@@ -21,10 +21,245 @@ Function of the depth sampling pipeline.
 # You should have received a copy of the GNU General Public License along with
 # this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import csv
+import io
 import numpy as np
 
 
+# Data types of legacy vtk files (binary vtk files are big endian):
+dicVtkDtype = {'unsigned_char': '>u1',
+               'char': '>i1',
+               'unsigned_short': '>u2',
+               'short': '>i2',
+               'unsigned_int': '>u4',
+               'int': '>i4',
+               'unsigned_long': '>u8',
+               'long': '>i8',
+               'float': '>f4',
+               'double': '>f8'}
+
+
+def funcVtkLne(bytVtk, varPos):
+    """Read line from vtk file (returns line and position of next line)."""
+    varEnd = bytVtk.find(b'\n', varPos)
+    if varEnd == -1:
+        varEnd = len(bytVtk)
+    return bytVtk[varPos:varEnd].decode('ascii', 'replace').strip(), \
+        (varEnd + 1)
+
+
+def funcVtkBinSec(bytVtk):
+    """
+    Walk through the sections of a binary vtk file.
+
+    The sections of the binary legacy vtk file are walked through header by
+    header; the binary blocks in between are skipped based on their size
+    (which is defined by the headers). Scanning the file for a search string
+    is not possible, because the binary data may contain any byte sequence.
+
+    Parameters
+    ----------
+    bytVtk : bytes or mmap.mmap
+        Content of vtk file.
+
+    Yields
+    ------
+    strLne : str
+        Header line of section (e.g. 'SCALARS EmbedVertex float 1').
+    varPosLne : int
+        Position (bytes) of header line.
+    varPosData : int
+        Position (bytes) of the data of the section (for SCALARS sections,
+        after the LOOKUP_TABLE header).
+    varNumDat : int
+        Number of data points of the current POINT_DATA / CELL_DATA section.
+    """
+    # Skip file header (version, title, format, and dataset type):
+    varPos = 0
+    for _ in range(4):
+        _, varPos = funcVtkLne(bytVtk, varPos)
+
+    # Number of data points of current POINT_DATA / CELL_DATA section:
+    varNumDat = 0
+
+    while varPos < len(bytVtk):
+
+        varPosLne = varPos
+        strLne, varPos = funcVtkLne(bytVtk, varPos)
+        lstLne = strLne.split()
+
+        # Skip empty lines (e.g. line break after binary block):
+        if len(lstLne) == 0:
+            continue
+
+        strKey = lstLne[0].upper()
+
+        if strKey in ('POINT_DATA', 'CELL_DATA'):
+            varNumDat = int(lstLne[1])
+
+        elif strKey == 'SCALARS':
+            # The SCALARS header is followed by the LOOKUP_TABLE header:
+            _, varPos = funcVtkLne(bytVtk, varPos)
+
+        yield strLne, varPosLne, varPos, varNumDat
+
+        if strKey == 'POINTS':
+            varPos += (int(lstLne[1]) * 3
+                       * np.dtype(dicVtkDtype[lstLne[2]]).itemsize)
+
+        elif strKey in ('VERTICES', 'LINES', 'POLYGONS', 'TRIANGLE_STRIPS'):
+            varPos += int(lstLne[2]) * 4
+
+        elif strKey in ('POINT_DATA', 'CELL_DATA'):
+            pass
+
+        elif strKey == 'SCALARS':
+            varNumCmp = int(lstLne[3]) if len(lstLne) > 3 else 1
+            varPos += (varNumDat * varNumCmp
+                       * np.dtype(dicVtkDtype[lstLne[2]]).itemsize)
+
+        elif strKey == 'LOOKUP_TABLE':
+            # Lookup table with RGBA values (unsigned char):
+            varPos += int(lstLne[2]) * 4
+
+        elif strKey in ('VECTORS', 'NORMALS'):
+            varPos += (varNumDat * 3
+                       * np.dtype(dicVtkDtype[lstLne[2]]).itemsize)
+
+        elif strKey == 'TEXTURE_COORDINATES':
+            varPos += (varNumDat * int(lstLne[2])
+                       * np.dtype(dicVtkDtype[lstLne[3]]).itemsize)
+
+        elif strKey == 'FIELD':
+            for _ in range(int(lstLne[2])):
+                strLne, varPos = funcVtkLne(bytVtk, varPos)
+                while len(strLne) == 0:
+                    strLne, varPos = funcVtkLne(bytVtk, varPos)
+                lstTmp = strLne.split()
+                varPos += (int(lstTmp[1]) * int(lstTmp[2])
+                           * np.dtype(dicVtkDtype[lstTmp[3]]).itemsize)
+
+        elif strKey == 'METADATA':
+            # Metadata (ascii) end with an empty line:
+            while len(strLne) > 0:
+                strLne, varPos = funcVtkLne(bytVtk, varPos)
+
+        else:
+            raise ValueError('Unknown section in binary vtk file: '
+                             + strLne)
+
+
+def funcVtkBinScalars(bytVtk, strPrcdData):
+    """
+    Locate vertex data in binary vtk file.
+
+    Parameters
+    ----------
+    bytVtk : bytes
+        Content of vtk file.
+    strPrcdData : str
+        Beginning of the header line of the data section (e.g. 'SCALARS').
+
+    Returns
+    -------
+    varNumVrtx : int
+        Number of vertices (data points).
+    varNumCmp : int
+        Number of components (values per vertex).
+    strDtype : str
+        numpy data type of the data section.
+    varPos : int
+        Position (bytes) of first data point.
+
+    Notes
+    -----
+    The file is walked through section by section (see `funcVtkBinSec`). If
+    several data sections match, the last one is returned (as in the previous
+    csv-based implementation).
+    """
+    tplRes = None
+
+    for strLne, _, varPos, varNumDat in funcVtkBinSec(bytVtk):
+        lstLne = strLne.split()
+        if (lstLne[0].upper() == 'SCALARS') and \
+                strLne.startswith(strPrcdData):
+            varNumCmp = int(lstLne[3]) if len(lstLne) > 3 else 1
+            tplRes = (varNumDat, varNumCmp, dicVtkDtype[lstLne[2]], varPos)
+
+    if tplRes is None:
+        raise ValueError('Data section not found in vtk file: '
+                         + strPrcdData)
+
+    return tplRes
+
+
+def funcVtkAsciiPos(bytVtk, strPrcdData, varNumLne):
+    """
+    Locate vertex data in ascii vtk file.
+
+    Parameters
+    ----------
+    bytVtk : bytes
+        Content of vtk file.
+    strPrcdData : str
+        Beginning of string which precedes vertex data (leading whitespace of
+        the line is ignored). If several lines start with this string, the
+        last one is used.
+    varNumLne : int
+        Number of lines between vertex-identification-string and first data
+        point.
+
+    Returns
+    -------
+    varNumDataVrtx : int
+        Number of vertices.
+    varIdxTmp : int
+        Position (bytes) of the line which starts with `strPrcdData`.
+    varIdxFrst : int
+        Position (bytes) of the first data point.
+    """
+    # Get index of (last) line which starts with the string (as specified
+    # above) which precedes the vertex data. Leading whitespace is ignored
+    # (as in the previous csv-based implementation):
+    bytPrcd = strPrcdData.encode('ascii')
+    varEnd = len(bytVtk)
+    while True:
+        varTmp = bytVtk.rfind(bytPrcd, 0, varEnd)
+        if varTmp == -1:
+            raise ValueError('Data section not found in vtk file: '
+                             + strPrcdData)
+        varIdxTmp = bytVtk.rfind(b'\n', 0, varTmp) + 1
+        if len(bytVtk[varIdxTmp:varTmp].strip()) == 0:
+            break
+        varEnd = varTmp + len(bytPrcd) - 1
+
+    # The number of vertecies is preceded by the string 'POINT_DATA' in vtk
+    # files. We extract the number behind the string:
+    varPos = bytVtk.rfind(b'POINT_DATA', 0, varIdxTmp)
+    varNumDataVrtx = int(funcVtkLne(bytVtk, varPos)[0].split()[1])
+
+    # Index of first vertex data point:
+    varIdxFrst = varIdxTmp
+    for _ in range(varNumLne):
+        varIdxFrst = bytVtk.index(b'\n', varIdxFrst) + 1
+
+    return varNumDataVrtx, varIdxTmp, varIdxFrst
+
+
+def funcVtkAsciiEnd(bytVtk, varIdxFrst, varNumDataVrtx):
+    """
+    Position (bytes) after the vertex data in ascii vtk file.
+
+    The vertex data consist of one line per vertex, starting at `varIdxFrst`.
+    """
+    vecNl = np.flatnonzero(np.equal(np.frombuffer(bytVtk,
+                                                  dtype=np.uint8,
+                                                  offset=varIdxFrst),
+                                    ord('\n')))
+    if vecNl.size < varNumDataVrtx:
+        return len(bytVtk)
+    return varIdxFrst + int(vecNl[varNumDataVrtx - 1]) + 1
+
+
 def funcLoadVtkMulti(strVtkIn,
                      strPrcdData,
                      varNumLne,
@@ -35,56 +270,72 @@ def funcLoadVtkMulti(strVtkIn,
     The vtk file to be loaded is supposed to be a cortex mesh with multiple
     values per vertex, e.g. statistical parameters at several cortical depth
     levels.
+
+    Parameters
+    ----------
+    strVtkIn : str
+        Path of vtk file (legacy format, ascii or binary).
+    strPrcdData : str
+        Beginning of string which precedes vertex data (e.g. 'SCALARS'). If
+        several lines start with this string, the last one is used.
+    varNumLne : int
+        Number of lines between vertex-identification-string and first data
+        point (ascii vtk files only; in binary files, the position of the data
+        is defined by the headers).
+    varNumDpth : int or None
+        Number of values per vertex to load (e.g. cortical depths). If None,
+        all values are loaded.
+
+    Returns
+    -------
+    aryVtkData : np.array
+        Vertex data, float32 array of shape (vertices, varNumDpth).
     """
     # print('---------Importing vtk file with multiple values per vertex: '
     #       + strVtkIn)
 
-    # Open file:
-    fleVtkIn = open(strVtkIn, 'r')
-
-    # Read file:
-    csvIn = csv.reader(fleVtkIn,
-                       delimiter='\n',
-                       skipinitialspace=True)
-
-    # Create empty list for vertex data:
-    lstVtkData = []
+    # Read file (in one go):
+    with open(strVtkIn, 'rb') as fleVtkIn:
+        bytVtk = fleVtkIn.read()
 
-    # Loop through csv object to fill list with csv data:
-    for lstTmp in csvIn:
-        for strTmp in lstTmp:
-            lstVtkData.append(strTmp[:])
+    # The third line of the file defines the format (ASCII or BINARY):
+    varPos = 0
+    for _ in range(3):
+        strFmt, varPos = funcVtkLne(bytVtk, varPos)
 
-    # Close file:
-    fleVtkIn.close()
+    if strFmt.upper() == 'BINARY':
 
-    # Get index of string (as specified above) which precedes the vertex data:
-    for idxSrch in range(0, len(lstVtkData)):
-        if lstVtkData[idxSrch].startswith((strPrcdData)):
-            varIdxTmp = idxSrch
+        varNumDataVrtx, varNumCmp, strDtype, varPos = \
+            funcVtkBinScalars(bytVtk, strPrcdData)
 
-    # Get number of vertices from the line preceding the specified string:
-    strNumDataVrtx = lstVtkData[(varIdxTmp - 1)]
+        aryVtkData = np.frombuffer(bytVtk,
+                                   dtype=strDtype,
+                                   count=(varNumDataVrtx * varNumCmp),
+                                   offset=varPos)
+        aryVtkData = aryVtkData.reshape(varNumDataVrtx, varNumCmp)
 
-    # The number of vertecies is preceded by the string 'POINT_DATA' in vtk
-    # files. We extract the number behind the string:
-    varNumDataVrtx = int(strNumDataVrtx[11:])
-
-    # Index of first vertex data point:
-    varIdxFrst = varIdxTmp + varNumLne
+        if varNumDpth is None:
+            varNumDpth = varNumCmp
 
-    # Array for numeric vertex data:
-    aryVtkData = np.zeros((varNumDataVrtx, varNumDpth))
+        # Convert to native byte order:
+        return aryVtkData[:, 0:varNumDpth].astype(np.float32)
 
-    # Get numeric vertex data:
-    for idxData in range(0, varNumDataVrtx):
+    varNumDataVrtx, _, varIdxFrst = funcVtkAsciiPos(bytVtk, strPrcdData,
+                                                     varNumLne)
 
-        # Line of current vertex in csv list:
-        varTmpStrt = varIdxFrst + idxData
+    # Number of values per vertex (in first line of vertex data):
+    if varNumDpth is None:
+        varNumDpth = len(funcVtkLne(bytVtk, varIdxFrst)[0].split())
 
-        # Put vertex data into array:
-        aryVtkData[idxData, :] = \
-            lstVtkData[varTmpStrt].split(' ')[0:varNumDpth]
+    # Parse the vertex data (one line per vertex, of which the first
+    # `varNumDpth` values are used) in one go:
+    objVtk = io.BytesIO(bytVtk)
+    objVtk.seek(varIdxFrst)
+    aryVtkData = np.loadtxt(objVtk,
+                            dtype=np.float32,
+                            usecols=tuple(range(varNumDpth)),
+                            max_rows=varNumDataVrtx,
+                            ndmin=2)
 
     # Return vertex data:
     return aryVtkData
@@ -0,0 +1,312 @@
+# -*- coding: utf-8 -*-
+"""
+Memory-mapped store for depth-sampled data on cortical meshes.
+
+Depth-sampled data (e.g. event-related time courses, or GLM / pRF parameters)
+are saved vertex-major, in chunks of vertices. The vertices are sorted by
+region of interest (ROI), so that the vertices of an ROI are stored
+contiguously. A store is a directory with the following files:
+
+    data.npy    Data, shape (chunk, depth, vertex within chunk, feature),
+                float32. Can be memory-mapped, so that selecting the vertices
+                of one ROI at one depth level only reads the pages that contain
+                these data.
+    vertex.npy  Vertex IDs (index of vertex in the original mesh) in the order
+                of the store.
+    label.npy   ROI label (index into the list of ROIs in the metadata, -1 for
+                vertices that are not within any ROI), in the order of the
+                store.
+    meta.json   Metadata (number of vertices, depth levels & features, chunk
+                size, names of features, names & ranges of ROIs). Written
+                last, i.e. a store without metadata is incomplete.
+"""
+
+# Part of py_depthsampling library
+# Copyright (C) 2018  Ingo Marquardt
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import csv
+import json
+import numpy as np
+
+
+def funcLoadRoiCsv(strPthCsv, strClm='vtkOriginalPointIds'):
+    """
+    Load vertex IDs of ROI from csv file (as exported from paraview).
+
+    Parameters
+    ----------
+    strPthCsv : str
+        Path of csv file, with header. One row per vertex.
+    strClm : str
+        Name of the column containing the vertex IDs.
+
+    Returns
+    -------
+    vecVrtx : np.array
+        Vertex IDs (sorted, unique).
+    """
+    with open(strPthCsv, 'r') as objFle:
+        objCsv = csv.reader(objFle)
+        lstHdr = next(objCsv)
+        idxClm = lstHdr.index(strClm)
+        lstVrtx = [int(float(lstTmp[idxClm])) for lstTmp in objCsv
+                   if len(lstTmp) > idxClm]
+    return np.unique(np.array(lstVrtx, dtype=np.int64))
+
+
+def funcMeshStoreOrder(varNumVrtx, dicRoi):
+    """
+    Order of vertices in store.
+
+    Parameters
+    ----------
+    varNumVrtx : int
+        Number of vertices of mesh.
+    dicRoi : dict
+        Vertex IDs for each ROI (see `funcLoadRoiCsv`); the order of the ROIs
+        is preserved. If a vertex is part of several ROIs, it is assigned to
+        the first one.
+
+    Returns
+    -------
+    vecVrtx : np.array
+        Vertex IDs, in the order of the store (vertices of first ROI, ...,
+        vertices of last ROI, remaining vertices; sorted by ID within ROI).
+    vecLbl : np.array
+        ROI label of each vertex in the store (index of ROI, -1 if none).
+    dicRng : dict
+        Range (first and last + 1 position in store) of each ROI.
+    """
+    vecLblVrtx = np.full(varNumVrtx, -1, dtype=np.int16)
+    for idxRoi, strRoi in enumerate(dicRoi):
+        vecTmp = np.asarray(dicRoi[strRoi], dtype=np.int64)
+        vecTmp = vecTmp[np.less(vecTmp, varNumVrtx)]
+        vecTmp = vecTmp[np.equal(vecLblVrtx[vecTmp], -1)]
+        vecLblVrtx[vecTmp] = idxRoi
+
+    # Sort by label (vertices without label last), then by vertex ID:
+    vecKey = vecLblVrtx.astype(np.int64)
+    vecKey[np.equal(vecKey, -1)] = len(dicRoi)
+    vecVrtx = np.argsort(vecKey, kind='stable').astype(np.int64)
+    vecLbl = vecLblVrtx[vecVrtx]
+
+    dicRng = {}
+    for idxRoi, strRoi in enumerate(dicRoi):
+        vecPos = np.flatnonzero(np.equal(vecLbl, idxRoi))
+        if vecPos.size > 0:
+            dicRng[strRoi] = [int(vecPos[0]), int(vecPos[-1] + 1)]
+        else:
+            dicRng[strRoi] = [0, 0]
+
+    return vecVrtx, vecLbl, dicRng
+
+
+def funcMeshStoreCreate(strPthStr, varNumVrtx, varNumDpth, lstFtr, dicRoi,
+                        varChnk=1024):
+    """
+    Create (empty) mesh store.
+
+    Parameters
+    ----------
+    strPthStr : str
+        Path of store (directory; created if it does not exist).
+    varNumVrtx : int
+        Number of vertices of mesh.
+    varNumDpth : int
+        Number of depth levels.
+    lstFtr : list
+        Names of features (e.g. volumes of time course, or statistical maps).
+    dicRoi : dict
+        Vertex IDs for each ROI (see `funcMeshStoreOrder`).
+    varChnk : int
+        Number of vertices per chunk.
+
+    Returns
+    -------
+    dicStr : dict
+        Store (see `funcMeshStoreOpen`), opened for writing (see
+        `funcMeshStorePut`). Needs to be finalised with `funcMeshStoreFnl`.
+    """
+    if not os.path.isdir(strPthStr):
+        os.makedirs(strPthStr)
+
+    # Remove metadata of previous store (the store is incomplete until it is
+    # finalised):
+    if os.path.isfile(os.path.join(strPthStr, 'meta.json')):
+        os.remove(os.path.join(strPthStr, 'meta.json'))
+
+    vecVrtx, vecLbl, dicRng = funcMeshStoreOrder(varNumVrtx, dicRoi)
+    np.save(os.path.join(strPthStr, 'vertex.npy'), vecVrtx)
+    np.save(os.path.join(strPthStr, 'label.npy'), vecLbl)
+
+    varNumChnk = int(np.ceil(float(varNumVrtx) / float(varChnk)))
+
+    aryData = np.lib.format.open_memmap(
+        os.path.join(strPthStr, 'data.npy'),
+        mode='w+',
+        dtype=np.float32,
+        shape=(varNumChnk, varNumDpth, varChnk, len(lstFtr)))
+
+    dicMeta = {'num_vertices': int(varNumVrtx),
+               'num_depths': int(varNumDpth),
+               'num_features': len(lstFtr),
+               'chunk': int(varChnk),
+               'features': [str(strTmp) for strTmp in lstFtr],
+               'rois': list(dicRoi.keys()),
+               'roi_ranges': dicRng}
+
+    return {'path': strPthStr,
+            'meta': dicMeta,
+            'data': aryData,
+            'vertex': vecVrtx,
+            'label': vecLbl}
+
+
+def funcMeshStorePut(dicStr, aryData, idxFtr=0):
+    """
+    Write data into mesh store.
+
+    Parameters
+    ----------
+    dicStr : dict
+        Store, opened for writing (see `funcMeshStoreCreate`).
+    aryData : np.array
+        Data, in the original order of vertices; shape (depth, feature,
+        vertex) or (depth, vertex) for a single feature. Can be a memory-map
+        (e.g. `aryErt_<condition>.npy`, shape depth x volume x vertex).
+    idxFtr : int
+        Index of first feature to write.
+    """
+    if aryData.ndim == 2:
+        aryData = aryData[:, None, :]
+
+    varChnk = dicStr['meta']['chunk']
+    vecVrtx = dicStr['vertex']
+    varNumFtr = aryData.shape[1]
+
+    for idxChnk in range(dicStr['data'].shape[0]):
+        vecTmp = vecVrtx[(idxChnk * varChnk):((idxChnk + 1) * varChnk)]
+        # Data of vertices of current chunk, shape (depth, vertex, feature):
+        aryTmp = np.transpose(aryData[:, :, vecTmp], (0, 2, 1))
+        dicStr['data'][idxChnk, :, :vecTmp.size,
+                       idxFtr:(idxFtr + varNumFtr)] = aryTmp
+
+
+def funcMeshStoreFnl(dicStr):
+    """Flush data of mesh store to disk, and save metadata."""
+    dicStr['data'].flush()
+    strPthMeta = os.path.join(dicStr['path'], 'meta.json')
+    with open(strPthMeta + '.tmp', 'w') as objFle:
+        json.dump(dicStr['meta'], objFle, indent=1)
+    os.replace((strPthMeta + '.tmp'), strPthMeta)
+
+
+def funcMeshStoreOpen(strPthStr):
+    """
+    Open mesh store (read only, memory-mapped).
+
+    Returns
+    -------
+    dicStr : dict
+        Store, with the entries 'path', 'meta' (metadata), 'data' (memory-map
+        of data, shape chunk x depth x vertex within chunk x feature),
+        'vertex' (vertex IDs in the order of the store), and 'label' (ROI
+        labels in the order of the store).
+    """
+    with open(os.path.join(strPthStr, 'meta.json'), 'r') as objFle:
+        dicMeta = json.load(objFle)
+    return {'path': strPthStr,
+            'meta': dicMeta,
+            'data': np.load(os.path.join(strPthStr, 'data.npy'),
+                            mmap_mode='r'),
+            'vertex': np.load(os.path.join(strPthStr, 'vertex.npy')),
+            'label': np.load(os.path.join(strPthStr, 'label.npy'))}
+
+
+def funcMeshStoreRng(dicStr, varStr, varStp, idxDpth=None):
+    """
+    Load data of a contiguous range of vertices (in the order of the store).
+
+    Returns an array of shape (vertex, feature) if a depth level is selected,
+    else (depth, vertex, feature).
+    """
+    varChnk = dicStr['meta']['chunk']
+    varChnkStr = varStr // varChnk
+    varChnkStp = int(np.ceil(float(varStp) / float(varChnk)))
+    varOff = varStr - (varChnkStr * varChnk)
+    varNum = varStp - varStr
+
+    if idxDpth is None:
+        aryTmp = dicStr['data'][varChnkStr:varChnkStp]
+        aryTmp = np.transpose(aryTmp, (1, 0, 2, 3))
+        aryTmp = aryTmp.reshape(aryTmp.shape[0], -1, aryTmp.shape[3])
+        return np.array(aryTmp[:, varOff:(varOff + varNum), :])
+
+    aryTmp = dicStr['data'][varChnkStr:varChnkStp, idxDpth]
+    aryTmp = aryTmp.reshape(-1, aryTmp.shape[2])
+    return np.array(aryTmp[varOff:(varOff + varNum), :])
+
+
+def funcMeshStoreRoi(dicStr, strRoi, idxDpth=None):
+    """
+    Load data of the vertices of one ROI.
+
+    Parameters
+    ----------
+    dicStr : dict
+        Store (see `funcMeshStoreOpen`).
+    strRoi : str
+        Name of ROI.
+    idxDpth : int or None
+        Depth level. If None, all depth levels are loaded.
+
+    Returns
+    -------
+    aryRoi : np.array
+        Data of ROI, shape (vertex, feature) if a depth level is selected,
+        else (depth, vertex, feature).
+    vecVrtx : np.array
+        Vertex IDs (in the original mesh) of the ROI vertices.
+
+    Notes
+    -----
+    Only the chunks that contain vertices of the ROI are read (and, if a
+    depth level is selected, only the data of that depth level within these
+    chunks).
+    """
+    varStr, varStp = dicStr['meta']['roi_ranges'][strRoi]
+    return (funcMeshStoreRng(dicStr, varStr, varStp, idxDpth=idxDpth),
+            dicStr['vertex'][varStr:varStp])
+
+
+def funcMeshStoreVrtx(dicStr, vecVrtx, idxDpth=None):
+    """
+    Load data of arbitrary vertices (vertex IDs of the original mesh).
+
+    Returns an array of shape (vertex, feature) if a depth level is selected,
+    else (depth, vertex, feature), in the order of `vecVrtx`.
+    """
+    # Position of vertices in store:
+    vecPos = np.empty(dicStr['vertex'].size, dtype=np.int64)
+    vecPos[dicStr['vertex']] = np.arange(dicStr['vertex'].size)
+    vecPos = vecPos[np.asarray(vecVrtx, dtype=np.int64)]
+
+    varChnk = dicStr['meta']['chunk']
+    if idxDpth is None:
+        aryTmp = dicStr['data'][(vecPos // varChnk), :, (vecPos % varChnk), :]
+        return np.transpose(aryTmp, (1, 0, 2))
+    return dicStr['data'][(vecPos // varChnk), idxDpth, (vecPos % varChnk), :]
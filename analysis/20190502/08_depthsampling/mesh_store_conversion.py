@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+"""
+Convert depth-sampled data into memory-mapped mesh stores.
+
+Depth-sampled data are saved in a vertex-major, chunked format, with the
+vertices sorted by region of interest (ROI), so that the data of one ROI (at
+one depth level) can be loaded without loading the whole array (see
+`meshStore`). Two kinds of stores are created for each hemisphere:
+
+    - Event-related time courses (one store per condition, converted from the
+      'aryErt_<condition>.npy' files; features are volumes).
+    - Depth profiles of statistical maps (GLM parameter estimates, pRF
+      parameters, ...; one store for all maps with one value per depth level
+      in the maps container of the hemisphere; features are maps).
+"""
+
+# Part of py_depthsampling library
+# Copyright (C) 2018  Ingo Marquardt
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import numpy as np
+from vtkMaps import funcMapsOpen, funcMapsScl
+from meshStore import (funcLoadRoiCsv, funcMeshStoreCreate, funcMeshStorePut,
+                       funcMeshStoreFnl)
+
+
+# *****************************************************************************
+# *** Parameters
+
+# Load environmental variables defining the input data path:
+pacman_data_path = str(os.environ['pacman_data_path'])
+pacman_sub_id = str(os.environ['pacman_sub_id'])
+
+# Hemispheres:
+lstHmi = ['lh', 'rh']
+
+# ROIs (csv files with vertex IDs, as exported from paraview; hemisphere and
+# ROI left open):
+lstRoi = ['v1', 'v2', 'v3']
+strPthRoi = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         '{}',
+                         '{}.csv')
+
+# Conditions of event-related time courses:
+lstCnd = ['bright_square', 'full_screen']
+
+# Path of event-related time courses (hemisphere & condition left open; the
+# mesh store is saved next to the npy file, with file extension '.mesh'):
+strPthErt = (pacman_data_path + pacman_sub_id
+             + '/cbs/{}_era/{}/aryErt_{}.npy')
+
+# Directory with statistical maps (hemisphere left open), and name of maps
+# container (see `vtk_maps_conversion.py`):
+strPthVtk = (pacman_data_path + pacman_sub_id + '/cbs/{}/')
+strMaps = 'maps.npz'
+
+# Name of mesh store for statistical maps (within directory of maps):
+strStrVtk = 'depth_profiles.mesh'
+
+# Number of cortical depths:
+varNumDpth = 11
+
+# Number of vertices per chunk:
+varChnk = 1024
+# *****************************************************************************
+
+
+# *****************************************************************************
+# *** Create mesh stores
+
+print('----------------------------------------------------------------------')
+
+print('-Mesh store conversion')
+
+for strHmi in lstHmi:
+
+    print(('--Hemisphere: ' + strHmi))
+
+    # Vertex IDs of ROIs:
+    dicRoi = {}
+    for strRoi in lstRoi:
+        dicRoi[strRoi] = funcLoadRoiCsv(strPthRoi.format(strHmi, strRoi))
+        print(('---ROI ' + strRoi + ': ' + str(dicRoi[strRoi].size)
+               + ' vertices'))
+
+    # *** Event-related time courses
+
+    for strCnd in lstCnd:
+
+        strPthTmp = strPthErt.format(strHmi, strCnd, strCnd)
+
+        if not os.path.isfile(strPthTmp):
+            print(('---Not found (skipping): ' + strPthTmp))
+            continue
+
+        print(('---Event-related time courses: ' + strPthTmp))
+
+        # Shape: depth x volume x vertex:
+        aryErt = np.load(strPthTmp, mmap_mode='r')
+
+        dicStr = funcMeshStoreCreate(
+            (os.path.splitext(strPthTmp)[0] + '.mesh'),
+            aryErt.shape[2],
+            aryErt.shape[0],
+            [('vol_' + str(idxVol).zfill(3))
+             for idxVol in range(aryErt.shape[1])],
+            dicRoi,
+            varChnk=varChnk)
+        funcMeshStorePut(dicStr, aryErt)
+        funcMeshStoreFnl(dicStr)
+        del(aryErt)
+
+    # *** Depth profiles of statistical maps
+
+    strPthTmp = os.path.join(strPthVtk.format(strHmi), strMaps)
+
+    if not os.path.isfile(strPthTmp):
+        print(('---Not found (skipping): ' + strPthTmp))
+        continue
+
+    dicMaps = funcMapsOpen(strPthTmp)
+
+    # Maps with one value per depth level (i.e. not single-depth maps such as
+    # the mid-GM retinotopic maps):
+    lstMaps = [strName for strName, varNumCmp
+               in zip(dicMaps['meta']['maps'], dicMaps['meta']['components'])
+               if varNumCmp >= varNumDpth]
+
+    print(('---Depth profiles of ' + str(len(lstMaps)) + ' maps: '
+           + strPthTmp))
+
+    if len(lstMaps) == 0:
+        continue
+
+    dicStr = funcMeshStoreCreate(
+        os.path.join(strPthVtk.format(strHmi), strStrVtk),
+        dicMaps['meta']['num_vertices'],
+        varNumDpth,
+        lstMaps,
+        dicRoi,
+        varChnk=varChnk)
+
+    for idxMap, strName in enumerate(lstMaps):
+        # Shape: vertex x depth
+        aryTmp = funcMapsScl(dicMaps, strName)[:, :varNumDpth]
+        funcMeshStorePut(dicStr, aryTmp.T, idxFtr=idxMap)
+
+    funcMeshStoreFnl(dicStr)
+    dicMaps['npz'].close()
+# *****************************************************************************
+
+print('--Done.')
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+
+
+"""
+Postprocess VTK retinotopy.
+
+The purpose of this script is to mask vtk files with values from another vtk
+file. This functionality is needed in order to threshold pRF results (polar
+angle and eccentricity) with a map of explained variance (R2); vertices with a
+low explained variance are not supposed to be shown in the retinotopic maps.
+Additionally, for polar angle maps, the values can be converted from radians
+ranging from -pi to pi into degrees ranging from 0 to 360 (starting at three
+o'clock and moving clockwise); this may improve visualisation in paraview.
+The maps can be saved into separate files, or combined into one file per
+hemisphere. Both hemispheres are processed in parallel.
+(C) Ingo Marquardt, 30.08.2016
+"""
+
+# *****************************************************************************
+# *** Import modules
+import os
+import multiprocessing as mp
+from retinotopyVtk import funcPostRet
+# *****************************************************************************
+
+print('-VTK masking')
+
+# *****************************************************************************
+# *** Define parameters
+
+# Load environmental variables defining the input data path:
+pacman_data_path = str(os.environ['pacman_data_path'])
+pacman_sub_id = str(os.environ['pacman_sub_id'])
+
+# Hemispheres:
+lstHmi = ['lh', 'rh']
+
+# Path of the vtk file used for thresholding (reference; hemisphere left
+# open):
+strVtkRf = (pacman_data_path
+            + pacman_sub_id
+            + '/cbs/{}/pRF_results_R2_mid_GM.vtk')
+
+# Maps to process. For each map: name of output array (saved in vtk file, will
+# be displayed in paraview), path of input vtk file (hemisphere left open),
+# convert radians (range -pi to pi) to degree (range 0 to 360 degrees)?, and
+# threshold by reference?
+lstMap = [('PolarAngle',
+           (pacman_data_path
+            + pacman_sub_id
+            + '/cbs/{}/pRF_results_polar_angle_mid_GM.vtk'),
+           True,
+           True),
+          ('Eccentricity',
+           (pacman_data_path
+            + pacman_sub_id
+            + '/cbs/{}/pRF_results_eccentricity_mid_GM.vtk'),
+           False,
+           True),
+          ('R2',
+           strVtkRf,
+           False,
+           False)]
+
+# Output files (hemisphere left open), and names of the arrays to save in
+# each file. The geometry of the mesh is only copied (not parsed), so that
+# several maps can be combined into one mesh per hemisphere.
+lstOt = [((pacman_data_path
+           + pacman_sub_id
+           + '/cbs/{}/pRF_results_polar_angle_mid_GM_thr.vtk'),
+          ['PolarAngle']),
+         ((pacman_data_path
+           + pacman_sub_id
+           + '/cbs/{}/pRF_results_retinotopy_mid_GM_thr.vtk'),
+          ['PolarAngle', 'Eccentricity', 'R2'])]
+
+# Lower threhold (vertices with a value below this in the reference image will
+# be set to the substitute value in the input vtk file):
+varThrLw = 0.1
+# Low substitute value (vertices below the threhold will be replaced with this
+# values):
+varSubLw = 0.0
+
+# String which precedes vertex data:
+strPrcdData = 'SCALARS EmbedVertex float 1'
+
+# Number of lines between vertex-identification-string and first data point:
+varItrmdt = 2
+# *****************************************************************************
+
+
+# *****************************************************************************
+# *** Read, manipulate & save data
+
+print('------Reading & manipulating data.')
+
+for strName, _, lgcRad2Dgr, _ in lstMap:
+    if lgcRad2Dgr:
+        print('---------Convert radians (range -pi to pi) to degree (range '
+              + ' 0 to 360 degrees): ' + strName)
+
+print('---------Replacing data values in input file that are below the ' +
+      'threshold in the reference file.')
+
+# One task per hemisphere:
+lstTsk = [(strVtkRf.format(strHmi),
+           [(strName, strVtkIn.format(strHmi), lgcRad2Dgr, lgcThr)
+            for strName, strVtkIn, lgcRad2Dgr, lgcThr in lstMap],
+           [(strVtkOt.format(strHmi), lstName)
+            for strVtkOt, lstName in lstOt],
+           strPrcdData,
+           varItrmdt,
+           varThrLw,
+           varSubLw) for strHmi in lstHmi]
+
+# Process hemispheres in parallel:
+objPool = mp.Pool(processes=len(lstTsk))
+objPool.map(funcPostRet, lstTsk)
+objPool.close()
+objPool.join()
+# *****************************************************************************
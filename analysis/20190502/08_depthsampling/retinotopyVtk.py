@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""
+Functions for post-processing of retinotopic maps on vtk meshes.
+
+@author: Ingo Marquardt
+"""
+
+# Part of py_depthsampling library
+# Copyright (C) 2018  Ingo Marquardt
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import io
+import numpy as np
+from loadVtkMulti import funcVtkAsciiPos, funcVtkAsciiEnd
+from writeVtkMulti import funcWriteVtkMulti
+
+
+def funcRad2Dgr(vecAng):
+    """
+    Convert polar angle from radians to degrees.
+
+    Radians ranging from -pi to pi are converted into degrees ranging from 0
+    to 360 (starting at three o'clock and moving clockwise). Values outside of
+    the expected range are not changed.
+    """
+    # Convert radians (-pi to pi) to degrees (-180 to 180):
+    vecDgr = np.rad2deg(vecAng)
+
+    # Change range from [-180 to 180 degree] to [0 to 360 degree]:
+    lgcNeg = np.logical_and(np.greater_equal(vecDgr, -180.0),
+                            np.less(vecDgr, 0.0))
+    lgcPos = np.logical_and(np.greater(vecDgr, 0.0),
+                            np.less_equal(vecDgr, 180.0))
+    vecOut = np.copy(vecDgr)
+    vecOut[lgcNeg] = -vecDgr[lgcNeg]
+    vecOut[lgcPos] = 360.0 - vecDgr[lgcPos]
+
+    lgcErr = np.logical_not(np.logical_or(
+        np.logical_or(lgcNeg, lgcPos), np.equal(vecDgr, 0.0)))
+    if np.any(lgcErr):
+        print('------------ERROR: Angle outside of expected range ('
+              + str(np.sum(lgcErr)) + ' vertices).')
+        print('------------' + str(vecDgr[lgcErr][:10]))
+        vecOut[lgcErr] = vecDgr[lgcErr]
+
+    return vecOut
+
+
+def funcLoadVtkData(bytVtk, strPrcdData, varItrmdt):
+    """
+    Load data section of ascii vtk file (one value per vertex).
+
+    Returns
+    -------
+    vecData : np.array
+        Vertex data (float64).
+    varIdxPrcd : int
+        Position (bytes) of line which precedes the vertex data.
+    varIdxFrst : int
+        Position (bytes) of first data point.
+    varIdxEnd : int
+        Position (bytes) after the vertex data.
+    """
+    varNumVrtx, varIdxPrcd, varIdxFrst = funcVtkAsciiPos(bytVtk,
+                                                         strPrcdData,
+                                                         varItrmdt)
+    varIdxEnd = funcVtkAsciiEnd(bytVtk, varIdxFrst, varNumVrtx)
+
+    vecData = np.loadtxt(io.BytesIO(bytVtk[varIdxFrst:varIdxEnd]),
+                         dtype=np.float64,
+                         usecols=(0,),
+                         ndmin=1)
+
+    return vecData, varIdxPrcd, varIdxFrst, varIdxEnd
+
+
+def funcPostRet(tplTsk):
+    """
+    Threshold vtk maps by reference map (and convert polar angle).
+
+    Parameters
+    ----------
+    tplTsk : tuple
+        Path of reference vtk file (e.g. R2), list of input maps, list of
+        outputs, string which precedes vertex data, number of lines between
+        that string and the first data point, lower threshold, and substitute
+        value. Each input map is a tuple (name of array, path of vtk file,
+        whether to convert radians to degrees (see `funcRad2Dgr`), whether to
+        threshold the map by the reference). Each output is a tuple (output
+        path, list of names of arrays to save in that file).
+
+    Notes
+    -----
+    The vertex data of the input files are parsed into arrays. The geometry of
+    the mesh is copied from the first input file without parsing it, and the
+    selected arrays are appended (see `funcWriteVtkMulti`), so that several
+    maps can be saved into one file.
+    """
+    (strVtkRf, lstMap, lstOt, strPrcdData, varItrmdt, varThrLw,
+     varSubLw) = tplTsk
+
+    print('------Importing vtk files: ' + strVtkRf)
+
+    # Vertex data, by path of vtk file (a file is only loaded once, even if it
+    # is used as reference and as input):
+    dicVtk = {}
+    for strVtkIn in [strVtkRf] + [tplMap[1] for tplMap in lstMap]:
+        if strVtkIn not in dicVtk:
+            with open(strVtkIn, 'rb') as objFle:
+                dicVtk[strVtkIn] = funcLoadVtkData(objFle.read(),
+                                                   strPrcdData,
+                                                   varItrmdt)[0]
+
+    vecRf = dicVtk[strVtkRf]
+
+    dicMap = {}
+    for strName, strVtkIn, lgcRad2Dgr, lgcThr in lstMap:
+
+        vecIn = np.copy(dicVtk[strVtkIn])
+
+        # Check whether the number of vertices is the same for the file to be
+        # masked and the reference file, only continue if this is the case:
+        if vecIn.shape != vecRf.shape:
+            print('---ERROR: Input file and reference file contain different '
+                  + 'number of vertices: ' + strVtkIn)
+            return
+
+        # Convert radians (range -pi to pi) to degree (range 0 to 360
+        # degrees):
+        if lgcRad2Dgr:
+            vecIn = funcRad2Dgr(vecIn)
+
+        # Replace values in input file where value in reference file is below
+        # threshold:
+        if lgcThr:
+            vecIn[np.less(vecRf, varThrLw)] = varSubLw
+
+        dicMap[strName] = vecIn
+
+    for strVtkOt, lstName in lstOt:
+        print('------Saving result to disk: ' + strVtkOt)
+        funcWriteVtkMulti(lstMap[0][1],
+                          strVtkOt,
+                          [(strName, dicMap[strName]) for strName in lstName])
@@ -0,0 +1,363 @@
+# -*- coding: utf-8 -*-
+"""
+Container for vertex maps that share the same mesh geometry.
+
+The CBS depth sampling creates one vtk file per map (e.g. GLM parameter
+estimates, pRF parameters), each containing the same mesh geometry. In a maps
+container, the geometry is saved once, and each map is saved as a compressed
+array. A container is a zip file (in the npz format, i.e. it can also be read
+with `np.load`) with the following members:
+
+    _meta.npy      Metadata (json, as uint8 array): number of vertices,
+                   format of the geometry (ascii or binary), names and
+                   number of components of the maps, and names of the
+                   original vtk files.
+    _geometry.npy  Geometry of the mesh (uint8 array), i.e. the first part of
+                   the original vtk files (file header, POINTS, POLYGONS),
+                   byte by byte.
+    <name>.npy     Vertex data of each map, float32, shape (vertices,
+                   components).
+
+Opening a container only reads the metadata; the geometry and the maps are
+only read (and decompressed) when they are accessed.
+"""
+
+# Part of py_depthsampling library
+# Copyright (C) 2018  Ingo Marquardt
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import re
+import json
+import mmap
+import zipfile
+import numpy as np
+from loadVtkMulti import (funcVtkLne, funcVtkBinSec, funcLoadVtkMulti,
+                          dicVtkDtype)
+from writeVtkMulti import funcVtkGeo, funcWriteVtkScl
+
+
+def funcMapsPut(objZip, strName, aryTmp):
+    """Write array into zip file (as npy member, compressed)."""
+    with objZip.open((strName + '.npy'), mode='w', force_zip64=True) as objFle:
+        np.lib.format.write_array(objFle, np.ascontiguousarray(aryTmp),
+                                  allow_pickle=False)
+
+
+# Header lines of data arrays (and of cell data) in ascii vtk files (lookup
+# tables are only data arrays if their size is given, otherwise they belong to
+# the preceding SCALARS array):
+objVtkArr = re.compile(rb'^[ \t]*((?:SCALARS|COLOR_SCALARS|VECTORS|NORMALS'
+                       rb'|TEXTURE_COORDINATES|TENSORS|FIELD|CELL_DATA)\b.*'
+                       rb'|LOOKUP_TABLE[ \t]+\S+[ \t]+\S+.*)$',
+                       flags=re.MULTILINE)
+
+
+def funcVtkArr(bytVtk, lgcBin, varEnd):
+    """
+    Header lines of the data arrays of a vtk file.
+
+    Parameters
+    ----------
+    bytVtk : bytes or mmap.mmap
+        Content of vtk file (legacy format, ascii or binary).
+    lgcBin : bool
+        Whether the file is binary.
+    varEnd : int
+        Position (bytes) of the end of the geometry (see `funcVtkGeo`).
+
+    Returns
+    -------
+    lstArr : list
+        Header line of each data array (e.g. 'SCALARS EmbedVertex float 1'),
+        and of each CELL_DATA section.
+    """
+    if lgcBin:
+        return [strLne for strLne, _, _, _ in funcVtkBinSec(bytVtk)
+                if strLne.split()[0].upper() not in
+                ('POINTS', 'VERTICES', 'LINES', 'POLYGONS', 'TRIANGLE_STRIPS',
+                 'POINT_DATA', 'METADATA')]
+    return [objMtc.group(1).decode('ascii', 'replace').strip()
+            for objMtc in objVtkArr.finditer(bytVtk, varEnd)]
+
+
+def funcMapsCreate(strPthMaps, lstVtk, strPrcdData, varNumLne, varLvl=6):
+    """
+    Create maps container from vtk files with the same geometry.
+
+    Parameters
+    ----------
+    strPthMaps : str
+        Path of maps container (file extension '.npz').
+    lstVtk : list
+        Paths of vtk files (legacy format, ascii or binary). The name of each
+        map is the file name without extension.
+    strPrcdData : str
+        Beginning of string which precedes vertex data in the vtk files (see
+        `funcLoadVtkMulti`).
+    varNumLne : int
+        Number of lines between vertex-identification-string and first data
+        point.
+    varLvl : int
+        Compression level (zlib).
+
+    Returns
+    -------
+    lstDne : list
+        Paths of vtk files that have been added to the container.
+    lstSkp : list
+        Paths of vtk files that have been skipped, because their geometry
+        differs from the first file, or because they do not contain exactly
+        one data array (starting with `strPrcdData`, e.g. files with several
+        SCALARS arrays), which could not be stored without loss of data.
+
+    Notes
+    -----
+    The geometry of each vtk file is compared with that of the first file
+    (byte by byte), without parsing it. The maps are written one by one, so
+    that only one map is held in memory. The container is written to a
+    temporary file, which is renamed after completion.
+    """
+    strPthTmp = strPthMaps + '.tmp'
+
+    bytGeo = None
+    dicMeta = {'maps': [], 'components': [], 'files': []}
+    lstDne = []
+    lstSkp = []
+
+    objZip = zipfile.ZipFile(strPthTmp, mode='w',
+                             compression=zipfile.ZIP_DEFLATED,
+                             compresslevel=varLvl,
+                             allowZip64=True)
+
+    try:
+
+        for strPthVtk in lstVtk:
+
+            # Compare geometry with first vtk file:
+            with open(strPthVtk, 'rb') as objFle:
+                objMm = mmap.mmap(objFle.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    lgcBin, varNumPnt, varEnd = funcVtkGeo(objMm)
+                    if bytGeo is None:
+                        bytGeo = objMm[:varEnd]
+                        dicMeta['num_vertices'] = varNumPnt
+                        dicMeta['binary'] = lgcBin
+                        funcMapsPut(objZip, '_geometry',
+                                    np.frombuffer(bytGeo, dtype=np.uint8))
+                    lgcGeo = ((varEnd == len(bytGeo))
+                              and (objMm[:varEnd] == bytGeo))
+                    try:
+                        lstArr = funcVtkArr(objMm, lgcBin, varEnd)
+                    except ValueError:
+                        # Unknown section in binary file:
+                        lstArr = None
+                finally:
+                    objMm.close()
+
+            if not lgcGeo:
+                print(('---Geometry differs from first file (skipping): '
+                       + strPthVtk))
+                lstSkp.append(strPthVtk)
+                continue
+
+            # Only files with a single data array can be stored without loss
+            # of data (the vertex data are read from the last array that
+            # starts with `strPrcdData`):
+            if (lstArr is None) or (len(lstArr) != 1) or \
+                    (not lstArr[0].startswith(strPrcdData)):
+                print(('---Not a single data array (skipping): '
+                       + strPthVtk))
+                lstSkp.append(strPthVtk)
+                continue
+
+            strName = os.path.splitext(os.path.basename(strPthVtk))[0]
+            if (strName in dicMeta['maps']) or strName.startswith('_'):
+                raise ValueError('Invalid (or duplicate) name of map: '
+                                 + strName)
+
+            # Vertex data (all components):
+            aryTmp = funcLoadVtkMulti(strPthVtk, strPrcdData, varNumLne,
+                                      None)
+
+            funcMapsPut(objZip, strName, aryTmp)
+            dicMeta['maps'].append(strName)
+            dicMeta['components'].append(int(aryTmp.shape[1]))
+            dicMeta['files'].append(os.path.basename(strPthVtk))
+            lstDne.append(strPthVtk)
+
+        # Metadata are written last:
+        funcMapsPut(objZip, '_meta',
+                    np.frombuffer(json.dumps(dicMeta).encode('utf-8'),
+                                  dtype=np.uint8))
+
+    except BaseException:
+        objZip.close()
+        os.remove(strPthTmp)
+        raise
+
+    objZip.close()
+    os.replace(strPthTmp, strPthMaps)
+
+    return lstDne, lstSkp
+
+
+def funcMapsOpen(strPthMaps):
+    """
+    Open maps container (only the metadata are read).
+
+    Returns
+    -------
+    dicMaps : dict
+        Container, with the entries 'path', 'npz' (lazily loading npz file),
+        'meta' (metadata), and 'geometry' (None until the geometry is loaded,
+        see `funcMapsGeo`).
+    """
+    objNpz = np.load(strPthMaps, allow_pickle=False)
+    dicMeta = json.loads(objNpz['_meta'].tobytes().decode('utf-8'))
+    return {'path': strPthMaps,
+            'npz': objNpz,
+            'meta': dicMeta,
+            'geometry': None}
+
+
+def funcMapsScl(dicMaps, strName):
+    """
+    Load one map from maps container.
+
+    Returns the vertex data of the map, float32 array of shape (vertices,
+    components). Only the data of this map are read from disk.
+    """
+    if strName not in dicMaps['meta']['maps']:
+        raise KeyError('Map not found in container: ' + strName)
+    return dicMaps['npz'][strName]
+
+
+def funcMapsGeo(dicMaps):
+    """
+    Load geometry of mesh from maps container.
+
+    The geometry is parsed on first access, and kept in the container
+    dictionary.
+
+    Returns
+    -------
+    aryPnt : np.array
+        Coordinates of points (vertices), float32 array of shape (vertices,
+        3).
+    dicCll : dict
+        Cells (e.g. 'POLYGONS'), each in the vtk layout: flat int64 array of
+        (number of points, point indices) for each cell.
+    """
+    if dicMaps['geometry'] is None:
+        bytGeo = dicMaps['npz']['_geometry'].tobytes()
+        dicMaps['geometry'] = funcVtkGeoLoad(bytGeo, dicMaps['meta']['binary'])
+    return dicMaps['geometry']
+
+
+def funcVtkGeoLoad(bytGeo, lgcBin):
+    """Parse geometry (POINTS & cells) of vtk file, see `funcMapsGeo`."""
+    aryPnt = None
+    dicCll = {}
+    lstCll = ['VERTICES', 'LINES', 'POLYGONS', 'TRIANGLE_STRIPS']
+
+    if lgcBin:
+        for strLne, _, varPos, _ in funcVtkBinSec(bytGeo):
+            lstLne = strLne.split()
+            strKey = lstLne[0].upper()
+            if strKey == 'POINTS':
+                aryPnt = np.frombuffer(bytGeo,
+                                       dtype=dicVtkDtype[lstLne[2]],
+                                       count=(int(lstLne[1]) * 3),
+                                       offset=varPos)
+            elif strKey in lstCll:
+                dicCll[strKey] = np.frombuffer(bytGeo,
+                                               dtype='>i4',
+                                               count=int(lstLne[2]),
+                                               offset=varPos)
+    else:
+        # Skip file header (version, title, format, and dataset type):
+        varPos = 0
+        for _ in range(4):
+            _, varPos = funcVtkLne(bytGeo, varPos)
+        # Section headers can be searched for directly (the data may contain
+        # several points or cells per line):
+        for strKey in ['POINTS'] + lstCll:
+            varTmp = bytGeo.find(('\n' + strKey + ' ').encode('ascii'),
+                                 (varPos - 1))
+            if varTmp == -1:
+                continue
+            strLne, varTmp = funcVtkLne(bytGeo, (varTmp + 1))
+            lstLne = strLne.split()
+            if strKey == 'POINTS':
+                aryPnt = np.fromstring(bytGeo[varTmp:], dtype=np.float64,
+                                       count=(int(lstLne[1]) * 3), sep=' ')
+            else:
+                dicCll[strKey] = np.fromstring(bytGeo[varTmp:],
+                                               dtype=np.int64,
+                                               count=int(lstLne[2]), sep=' ')
+
+    if aryPnt is None:
+        raise ValueError('No POINTS section in geometry.')
+
+    return (aryPnt.astype(np.float32).reshape(-1, 3),
+            {strKey: dicCll[strKey].astype(np.int64) for strKey in dicCll})
+
+
+def funcMapsLoad(strPthMaps, lstName=None):
+    """
+    Load geometry & maps from maps container.
+
+    Parameters
+    ----------
+    strPthMaps : str
+        Path of maps container.
+    lstName : list or None
+        Names of maps to load. If None, all maps are loaded.
+
+    Returns
+    -------
+    tplGeo : tuple
+        Geometry, see `funcMapsGeo`.
+    dicScl : dict
+        Vertex data of each map (see `funcMapsScl`).
+    """
+    dicMaps = funcMapsOpen(strPthMaps)
+    if lstName is None:
+        lstName = dicMaps['meta']['maps']
+    return (funcMapsGeo(dicMaps),
+            {strName: funcMapsScl(dicMaps, strName) for strName in lstName})
+
+
+def funcMapsVtk(dicMaps, strVtkOt, lstName):
+    """
+    Save maps from maps container as vtk file (e.g. for paraview).
+
+    The geometry is written as it was in the original vtk files, followed by
+    one SCALARS array per map (see `funcWriteVtkScl`).
+    """
+    strVtkTmp = strVtkOt + '.tmp'
+    bytGeo = dicMaps['npz']['_geometry'].tobytes()
+    with open(strVtkTmp, 'wb') as objFle:
+        objFle.write(bytGeo)
+        if not bytGeo.endswith(b'\n'):
+            objFle.write(b'\n')
+        funcWriteVtkScl(objFle,
+                        dicMaps['meta']['binary'],
+                        dicMaps['meta']['num_vertices'],
+                        [(strName, funcMapsScl(dicMaps, strName))
+                         for strName in lstName],
+                        '%.8g')
+    os.replace(strVtkTmp, strVtkOt)
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""
+Combine vtk files of statistical maps into one maps container per hemisphere.
+
+The CBS depth sampling creates one vtk file per map (GLM parameter estimates,
+pRF parameters, ...), and each of these files contains the same mesh
+geometry. The vtk files of each hemisphere are combined into a maps container,
+in which the geometry is saved once, and the vertex data of each map are saved
+as a compressed array (see `vtkMaps`). Vtk files with a different geometry, or
+with more than one data array, are left as they are. Individual maps can be
+exported to vtk again (e.g. for paraview) with `vtkMaps.funcMapsVtk`.
+"""
+
+# Part of py_depthsampling library
+# Copyright (C) 2018  Ingo Marquardt
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+from vtkMaps import funcMapsCreate, funcMapsOpen
+
+
+# *****************************************************************************
+# *** Parameters
+
+# Load environmental variables defining the input data path:
+pacman_data_path = str(os.environ['pacman_data_path'])
+pacman_sub_id = str(os.environ['pacman_sub_id'])
+
+# Hemispheres:
+lstHmi = ['lh', 'rh']
+
+# Directory with vtk files of statistical maps (hemisphere left open):
+strPthVtk = (pacman_data_path + pacman_sub_id + '/cbs/{}/')
+
+# Name of maps container (within vtk directory):
+strMaps = 'maps.npz'
+
+# Vtk files ending with these strings are not added to the container. These
+# are derived files (e.g. thresholded retinotopy maps, created by
+# `postprocess_retinotopy_vtk.py` for paraview), some of which contain several
+# data arrays. Only source maps (one data array per file) are combined.
+lstExc = ['_thr.vtk']
+
+# Beginning of string which precedes vertex data in data vtk files:
+strPrcdData = 'SCALARS'
+
+# Number of lines between vertex-identification-string and first data point:
+varNumLne = 2
+
+# Compression level (zlib, 1 to 9):
+varLvl = 6
+
+# Delete vtk files after they have been added to the container? (Vtk files that
+# have been skipped are never deleted.)
+lgcDel = False
+# *****************************************************************************
+
+
+# *****************************************************************************
+# *** Convert vtk files
+
+print('----------------------------------------------------------------------')
+
+print('-Vtk maps conversion')
+
+for strHmi in lstHmi:
+
+    strPthTmp = strPthVtk.format(strHmi)
+
+    lstVtk = sorted([f for f in os.listdir(strPthTmp)
+                     if (f[-4:] == '.vtk')
+                     and (not any([f.endswith(strExc) for strExc in lstExc]))])
+    lstVtk = [os.path.join(strPthTmp, f) for f in lstVtk]
+
+    print(('--Hemisphere ' + strHmi + ': ' + str(len(lstVtk))
+           + ' vtk files'))
+
+    if len(lstVtk) == 0:
+        continue
+
+    lstDne, lstSkp = funcMapsCreate(os.path.join(strPthTmp, strMaps),
+                                    lstVtk,
+                                    strPrcdData,
+                                    varNumLne,
+                                    varLvl=varLvl)
+
+    print(('---Maps in container: ' + str(len(lstDne)) + ', skipped: '
+           + str(len(lstSkp))))
+
+    if lgcDel:
+        # Only delete vtk files whose maps can be read from the container:
+        dicMaps = funcMapsOpen(os.path.join(strPthTmp, strMaps))
+        for strVtk in lstDne:
+            strName = os.path.splitext(os.path.basename(strVtk))[0]
+            if dicMaps['npz'][strName].shape[0] == \
+                    dicMaps['meta']['num_vertices']:
+                os.remove(strVtk)
+        dicMaps['npz'].close()
+# *****************************************************************************
+
+print('--Done.')
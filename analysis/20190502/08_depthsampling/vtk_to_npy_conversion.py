@@ -3,7 +3,9 @@
 Convert event-related time course vtk meshes to npy format.
 
 The collection of single-volume vtk meshes is converted into a single npy
-format for faster access and to conserve disk space.
+format for faster access and to conserve disk space. The vtk files are parsed
+in parallel (all directories concurrently), and deleted only after the npy
+file has been written to disk (see `convertVtkMulti.funcVtkToNpy`).
 """
 
 # Part of py_depthsampling library
@@ -24,9 +26,7 @@ format for faster access and to conserve disk space.
 
 
 import os
-from os import listdir
-import numpy as np
-from loadVtkMulti import funcLoadVtkMulti
+from convertVtkMulti import funcVtkToNpy
 
 
 # *****************************************************************************
@@ -51,6 +51,14 @@ strPrcdData = 'SCALARS'
 
 # Number of lines between vertex-identification-string and first data point:
 varNumLne = 2
+
+# Number of parallel processes:
+varPar = 8
+
+# Resume interrupted conversion? If True, the progress of a previous
+# (interrupted) conversion is read from the manifest next to the npy file, and
+# volumes that have already been converted are skipped.
+lgcRsm = True
 # *****************************************************************************
 
 
@@ -61,61 +69,8 @@ print('----------------------------------------------------------------------')
 
 print('-vtk to npy conversion')
 
-# Loop through target directories:
-for strDirTmp in lstDir:
-
-    print(('--Target directory: ' + strDirTmp))
-
-    # Condition name (needed for file names):
-    strCondTmp = os.path.split(strDirTmp)[1]
-
-    # Get list of files in target directory:
-    lstFls = listdir(strDirTmp)
-
-    # Ignore files that do not have vtk file extension:
-    lstFls = [f for f in lstFls if '.vtk' in f]
-
-    # Sort files:
-    lstFls = sorted(lstFls)
-
-    # Number of volumes:
-    varNumVol = len(lstFls)
-
-    # Loop through volumes (i.e. through 3D vtk files):
-    for idxVol in range(0, varNumVol):
-
-        print(('---Volume: ' + str(idxVol)))
-
-        # Path of current vtk file:
-        strPthVtkTmp = os.path.join(strDirTmp, lstFls[idxVol])
-
-        # Load vtk mesh for current timepoint:
-        aryTmp = funcLoadVtkMulti(strPthVtkTmp,
-                                  strPrcdData,
-                                  varNumLne,
-                                  varNumDpth).astype(np.float32)
-
-        # Get number of vertices for first volume (has to be equal across
-        # volumes) and preallocate np array:
-        if idxVol == 0:
-
-            # Number of vertices:
-            varNumVrtc = aryTmp.shape[0]
-
-            # Array to be filled with data:
-            aryErt = np.zeros((varNumDpth, varNumVol, varNumVrtc),
-                              dtype=np.float32)
-
-        # Put current volume into array:
-        aryErt[:, idxVol, :] = aryTmp.T
-
-        # Delete vtk file:
-        os.remove(strPthVtkTmp)
-
-    # Save array to disk:
-    strPthNpy = os.path.join(strDirTmp, ('aryErt_' + strCondTmp + '.npy'))
-    print(('--Saving to disk: ' + strPthNpy))
-    np.save(strPthNpy, aryErt)
+funcVtkToNpy(lstDir, strPrcdData, varNumLne, varNumDpth, varPar,
+             lgcRsm=lgcRsm)
 # *****************************************************************************
 
 print('--Done.')
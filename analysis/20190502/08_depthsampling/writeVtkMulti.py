@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+"""
+Write vertex data to vtk file, reusing the geometry of an existing vtk file.
+
+The geometry of the mesh (file header, POINTS, and POLYGONS etc.) is copied
+byte by byte from an existing vtk file (without parsing it), and only the data
+section (POINT_DATA) is newly written. Several named arrays can be written
+into the same file.
+"""
+
+# Part of py_depthsampling library
+# Copyright (C) 2018  Ingo Marquardt
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import mmap
+import numpy as np
+from loadVtkMulti import funcVtkLne, funcVtkBinSec
+
+
+def funcVtkGeo(bytVtk):
+    """
+    Locate the geometry section of a vtk file.
+
+    Parameters
+    ----------
+    bytVtk : bytes or mmap.mmap
+        Content of vtk file (legacy format, ascii or binary).
+
+    Returns
+    -------
+    lgcBin : bool
+        Whether the file is binary.
+    varNumPnt : int
+        Number of points (vertices) of the mesh.
+    varEnd : int
+        Position (bytes) of the end of the geometry, i.e. of the first data
+        section (POINT_DATA or CELL_DATA), or end of file if there is no data
+        section.
+    """
+    # The third line of the file defines the format (ASCII or BINARY):
+    varPos = 0
+    for _ in range(3):
+        strFmt, varPos = funcVtkLne(bytVtk, varPos)
+    lgcBin = (strFmt.upper() == 'BINARY')
+
+    varNumPnt = None
+    varEnd = len(bytVtk)
+
+    if lgcBin:
+
+        for strLne, varPosLne, _, _ in funcVtkBinSec(bytVtk):
+            strKey = strLne.split()[0].upper()
+            if strKey == 'POINTS':
+                varNumPnt = int(strLne.split()[1])
+            elif strKey in ('POINT_DATA', 'CELL_DATA'):
+                varEnd = varPosLne
+                break
+
+    else:
+
+        # In ascii files, the section headers can be searched for directly
+        # (only the part of the file up to the data section is read):
+        for bytKey in (b'\nPOINT_DATA', b'\nCELL_DATA'):
+            varTmp = bytVtk.find(bytKey, 0, varEnd)
+            if varTmp != -1:
+                varEnd = varTmp + 1
+        varTmp = bytVtk.find(b'\nPOINTS', 0, varEnd)
+        if varTmp != -1:
+            varNumPnt = int(funcVtkLne(bytVtk, (varTmp + 1))[0].split()[1])
+
+    if varNumPnt is None:
+        raise ValueError('No POINTS section in vtk file.')
+
+    return lgcBin, varNumPnt, varEnd
+
+
+def funcCopyRng(objFleIn, objFleOt, varNumByt):
+    """
+    Copy the first bytes of a file into another file.
+
+    The data are copied within the kernel (`os.sendfile`) where possible,
+    otherwise in blocks.
+    """
+    varOff = 0
+    try:
+        while varOff < varNumByt:
+            varTmp = os.sendfile(objFleOt.fileno(), objFleIn.fileno(), varOff,
+                                 (varNumByt - varOff))
+            if varTmp == 0:
+                break
+            varOff += varTmp
+    except (AttributeError, OSError):
+        # `os.sendfile` is not available (or not supported for this file
+        # system), continue with the remaining bytes:
+        pass
+    objFleIn.seek(varOff)
+    objFleOt.seek(varOff)
+    while varOff < varNumByt:
+        bytTmp = objFleIn.read(min((varNumByt - varOff), 16777216))
+        if len(bytTmp) == 0:
+            break
+        objFleOt.write(bytTmp)
+        varOff += len(bytTmp)
+    if varOff != varNumByt:
+        raise IOError('Could not copy geometry of vtk file.')
+
+
+def funcWriteVtkScl(objFleOt, lgcBin, varNumPnt, lstScl, strFmt):
+    """Write data section (POINT_DATA, one SCALARS array per entry)."""
+    objFleOt.write('POINT_DATA {}\n'.format(varNumPnt).encode('ascii'))
+
+    for strName, aryTmp in lstScl:
+
+        if (len(strName.split()) != 1) or (strName != strName.strip()):
+            raise ValueError('Invalid name of vtk array: ' + strName)
+
+        aryTmp = np.asarray(aryTmp)
+        if aryTmp.ndim == 1:
+            aryTmp = aryTmp[:, None]
+        if aryTmp.shape[0] != varNumPnt:
+            raise ValueError('Number of vertices of array ' + strName + ' ('
+                             + str(aryTmp.shape[0]) + ') differs from mesh ('
+                             + str(varNumPnt) + ').')
+
+        objFleOt.write(('SCALARS {} float {}\nLOOKUP_TABLE default\n'
+                        ).format(strName, aryTmp.shape[1]).encode('ascii'))
+        if lgcBin:
+            objFleOt.write(aryTmp.astype('>f4').tobytes())
+            objFleOt.write(b'\n')
+        else:
+            np.savetxt(objFleOt, aryTmp, fmt=strFmt)
+
+
+def funcWriteVtkMulti(strVtkGeo, strVtkOt, lstScl, strFmt='%.8g'):
+    """
+    Write vertex data into vtk file, with the geometry of another vtk file.
+
+    Parameters
+    ----------
+    strVtkGeo : str
+        Path of vtk file with the geometry of the mesh (legacy format, ascii
+        or binary). Only the geometry is used, the data sections of the file
+        are discarded.
+    strVtkOt : str
+        Output path. Can be the same as `strVtkGeo`, in which case the data
+        section of the file is replaced.
+    lstScl : list
+        List of tuples (name of array, vertex data), one per array. The
+        vertex data are of shape (vertices,) or (vertices, components). The
+        arrays are saved as float (SCALARS) in the format of `strVtkGeo`.
+    strFmt : str
+        Format of the vertex data in ascii files (see `np.savetxt`).
+
+    Notes
+    -----
+    The geometry is copied as a byte range from the input file; it is neither
+    parsed nor serialised. The output is written to a temporary file, which is
+    renamed after completion.
+    """
+    strVtkTmp = strVtkOt + '.tmp'
+
+    objFleIn = open(strVtkGeo, 'rb')
+    objFleOt = open(strVtkTmp, 'wb')
+
+    try:
+
+        # Only the pages of the file which are accessed (header sections) are
+        # read from disk:
+        objMm = mmap.mmap(objFleIn.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            lgcBin, varNumPnt, varEnd = funcVtkGeo(objMm)
+            lgcNl = (varEnd == 0) or (objMm[(varEnd - 1):varEnd] == b'\n')
+        finally:
+            objMm.close()
+
+        # Copy geometry:
+        funcCopyRng(objFleIn, objFleOt, varEnd)
+        if not lgcNl:
+            objFleOt.write(b'\n')
+
+        funcWriteVtkScl(objFleOt, lgcBin, varNumPnt, lstScl, strFmt)
+
+    except BaseException:
+        # Do not leave incomplete output behind:
+        objFleIn.close()
+        objFleOt.close()
+        os.remove(strVtkTmp)
+        raise
+
+    objFleIn.close()
+    objFleOt.close()
+    os.replace(strVtkTmp, strVtkOt)
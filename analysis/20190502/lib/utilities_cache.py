@@ -0,0 +1,326 @@
+# -*- coding: utf-8 -*-
+"""
+Content-addressed cache for the outputs of python stages of the pipeline.
+
+The key of a stage is a hash of its name, its parameters, and its input files
+(including the script itself). The input files are identified by their size
+and modification time (fast), or by their content (slower, but independent
+of the file timestamps). If the key of a stage is found in the cache, the
+stage is skipped and its outputs are restored from the cache; otherwise the
+stage is run and its outputs are added to the cache. Usage in a script:
+
+    dicCache = fncCacheInit('01_py_prepare_prf', lstIn, dicPar)
+    if fncCacheGet(dicCache):
+        sys.exit(0)
+    ...  # Run stage
+    fncCacheSet(dicCache, lstOt)
+
+Each cache entry is a directory (named after the key) containing a copy of
+each output file and a manifest (json) with the original paths, sizes and
+modification times of the outputs. The outputs are restored with their
+original modification times, so that the keys of subsequent stages (which
+use these files as inputs) do not change. When the total size of the cache
+exceeds its limit, the least recently used entries are deleted.
+
+The cache directory and its size limit are defined by the environmental
+variables `pacman_cache_path` (default: 'cache' within `pacman_data_path`;
+an empty string disables the cache) and `pacman_cache_size` (in MB, default:
+20000).
+"""
+
+# Part of PacMan analysis pipeline.
+# Copyright (C) 2019  Ingo Marquardt
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+
+
+# Name of manifest within cache entry:
+strCacheMnf = 'manifest.json'
+
+
+def fncFleHash(strPth, lgcCnt):
+    """
+    Identify file by content or by size & modification time.
+
+    Parameters
+    ----------
+    strPth : str
+        Path of file.
+    lgcCnt : bool
+        If True, the content of the file is hashed (SHA-256, read in blocks).
+        Otherwise, the size and modification time of the file are used.
+
+    Returns
+    -------
+    strHash : str
+        Identifier of file (hex string, or size & modification time).
+    """
+    if not lgcCnt:
+        objStt = os.stat(strPth)
+        return str(objStt.st_size) + ':' + str(objStt.st_mtime_ns)
+    objHash = hashlib.sha256()
+    with open(strPth, 'rb') as objFle:
+        for bytTmp in iter(lambda: objFle.read(16777216), b''):
+            objHash.update(bytTmp)
+    return objHash.hexdigest()
+
+
+def fncCacheKey(strStage, lstIn, dicPar, lgcCnt=False):
+    """
+    Key of pipeline stage.
+
+    Parameters
+    ----------
+    strStage : str
+        Name of the stage.
+    lstIn : list
+        Paths of input files (including the script of the stage, and the
+        modules it uses, so that changes to the code invalidate the key).
+    dicPar : dict
+        Parameters of the stage (json serialisable, other values are
+        converted to str). Only parameters that affect the outputs should be
+        included.
+    lgcCnt : bool
+        Whether to hash the content of the input files (see `fncFleHash`).
+
+    Returns
+    -------
+    strKey : str
+        Key (SHA-256, hex string).
+    """
+    objHash = hashlib.sha256()
+    objHash.update(strStage.encode('utf-8'))
+    objHash.update(json.dumps(dicPar, sort_keys=True, default=str
+                              ).encode('utf-8'))
+    for strPth in lstIn:
+        strPth = os.path.abspath(strPth)
+        objHash.update(b'\0' + strPth.encode('utf-8') + b'\0')
+        objHash.update(fncFleHash(strPth, lgcCnt).encode('ascii'))
+    return objHash.hexdigest()
+
+
+def fncCacheInit(strStage, lstIn, dicPar, lgcCnt=False, strPthCache=None,
+                 varMaxSze=None):
+    """
+    Compute key of pipeline stage, and locate its cache entry.
+
+    Parameters
+    ----------
+    strStage : str
+        Name of the stage.
+    lstIn : list
+        Paths of input files (see `fncCacheKey`).
+    dicPar : dict
+        Parameters of the stage (see `fncCacheKey`).
+    lgcCnt : bool
+        Whether to hash the content of the input files.
+    strPthCache : str or None
+        Cache directory. If None, the environmental variable
+        `pacman_cache_path` is used (see module docstring). If empty, the
+        cache is disabled.
+    varMaxSze : float or None
+        Size limit of cache [MB]. If None, the environmental variable
+        `pacman_cache_size` is used (default: 20000 MB).
+
+    Returns
+    -------
+    dicCache : dict
+        Cache state of the stage, with the entries 'stage', 'key', 'path'
+        (cache directory, None if the cache is disabled), 'entry' (path of
+        cache entry of the stage), and 'max_size' (size limit in bytes).
+    """
+    if strPthCache is None:
+        strPthCache = os.environ.get(
+            'pacman_cache_path',
+            os.path.join(os.environ.get('pacman_data_path', ''), 'cache'))
+    if varMaxSze is None:
+        varMaxSze = float(os.environ.get('pacman_cache_size', 20000.0))
+
+    dicCache = {'stage': strStage,
+                'key': None,
+                'path': None,
+                'entry': None,
+                'max_size': int(varMaxSze * 1000000.0)}
+
+    if len(strPthCache) == 0:
+        return dicCache
+
+    dicCache['key'] = fncCacheKey(strStage, lstIn, dicPar, lgcCnt=lgcCnt)
+    dicCache['path'] = strPthCache
+    dicCache['entry'] = os.path.join(strPthCache, dicCache['key'])
+
+    return dicCache
+
+
+def fncCacheGet(dicCache):
+    """
+    Restore outputs of pipeline stage from cache.
+
+    Parameters
+    ----------
+    dicCache : dict
+        Cache state of the stage (see `fncCacheInit`).
+
+    Returns
+    -------
+    lgcHit : bool
+        True if the outputs have been restored (i.e. the stage can be
+        skipped), False otherwise.
+
+    Notes
+    -----
+    Outputs that already exist with the cached size and modification time
+    are not copied. The modification time of the cache entry is updated on
+    every hit (least recently used eviction, see `fncCacheEvict`).
+    """
+    if dicCache['entry'] is None:
+        return False
+
+    strPthMnf = os.path.join(dicCache['entry'], strCacheMnf)
+    try:
+        with open(strPthMnf, 'r') as objFle:
+            lstMnf = json.load(objFle)
+    except (IOError, OSError, ValueError):
+        return False
+
+    print('---Cache hit (' + dicCache['stage'] + '), restoring '
+          + str(len(lstMnf)) + ' output file(s)')
+
+    for strNme, strPthOt, varSze, varMtm in lstMnf:
+        if os.path.isfile(strPthOt):
+            objStt = os.stat(strPthOt)
+            if (objStt.st_size == varSze) and (objStt.st_mtime_ns == varMtm):
+                continue
+        strDir = os.path.dirname(strPthOt)
+        if not os.path.isdir(strDir):
+            os.makedirs(strDir)
+        # Copy to temporary file first, so that no incomplete output is left
+        # behind:
+        strPthTmp = strPthOt + '.cache.tmp'
+        shutil.copyfile(os.path.join(dicCache['entry'], strNme), strPthTmp)
+        os.utime(strPthTmp, ns=(varMtm, varMtm))
+        os.replace(strPthTmp, strPthOt)
+
+    os.utime(strPthMnf)
+
+    return True
+
+
+def fncCacheSet(dicCache, lstOt):
+    """
+    Add outputs of pipeline stage to cache.
+
+    Parameters
+    ----------
+    dicCache : dict
+        Cache state of the stage (see `fncCacheInit`).
+    lstOt : list
+        Paths of output files of the stage.
+
+    Notes
+    -----
+    The outputs are copied (not linked), because subsequent stages may
+    overwrite files in place. The entry is created in a temporary directory
+    and renamed after completion, so that incomplete entries are never used.
+    After the entry has been added, old entries are evicted (see
+    `fncCacheEvict`).
+    """
+    if dicCache['entry'] is None:
+        return
+
+    if not os.path.isdir(dicCache['path']):
+        os.makedirs(dicCache['path'])
+
+    strPthTmp = tempfile.mkdtemp(prefix='.tmp_', dir=dicCache['path'])
+
+    try:
+        lstMnf = []
+        for idxOt, strPthOt in enumerate(lstOt):
+            strPthOt = os.path.abspath(strPthOt)
+            strNme = str(idxOt).zfill(5)
+            shutil.copyfile(strPthOt, os.path.join(strPthTmp, strNme))
+            objStt = os.stat(strPthOt)
+            lstMnf.append((strNme, strPthOt, objStt.st_size,
+                           objStt.st_mtime_ns))
+        with open(os.path.join(strPthTmp, strCacheMnf), 'w') as objFle:
+            json.dump(lstMnf, objFle)
+        if os.path.isdir(dicCache['entry']):
+            shutil.rmtree(dicCache['entry'])
+        os.rename(strPthTmp, dicCache['entry'])
+    except BaseException:
+        shutil.rmtree(strPthTmp, ignore_errors=True)
+        raise
+
+    print('---Added ' + str(len(lstMnf)) + ' output file(s) to cache ('
+          + dicCache['stage'] + ')')
+
+    fncCacheEvict(dicCache['path'], dicCache['max_size'],
+                  strKeep=dicCache['key'])
+
+
+def fncCacheEvict(strPthCache, varMaxByt, strKeep=None):
+    """
+    Delete least recently used cache entries until the cache fits its limit.
+
+    Parameters
+    ----------
+    strPthCache : str
+        Cache directory.
+    varMaxByt : int
+        Size limit of cache [bytes].
+    strKeep : str or None
+        Key of entry that is not deleted (e.g. the entry that has just been
+        added, even if it exceeds the limit on its own).
+
+    Notes
+    -----
+    The time of last use of an entry is the modification time of its
+    manifest (updated on every hit). Left-over temporary directories (of
+    interrupted stages) older than one day are deleted as well.
+    """
+    lstEnt = []
+    varSzeTtl = 0
+    for strKey in os.listdir(strPthCache):
+        strPthEnt = os.path.join(strPthCache, strKey)
+        if not os.path.isdir(strPthEnt):
+            continue
+        if strKey.startswith('.tmp_'):
+            if (time.time() - os.stat(strPthEnt).st_mtime) > 86400.0:
+                shutil.rmtree(strPthEnt, ignore_errors=True)
+            continue
+        try:
+            varTme = os.stat(os.path.join(strPthEnt, strCacheMnf)).st_mtime
+        except OSError:
+            varTme = 0.0
+        varSze = sum(os.path.getsize(os.path.join(strPthEnt, strNme))
+                     for strNme in os.listdir(strPthEnt))
+        lstEnt.append((varTme, strKey, varSze))
+        varSzeTtl += varSze
+
+    # Oldest entries first:
+    for varTme, strKey, varSze in sorted(lstEnt):
+        if varSzeTtl <= varMaxByt:
+            break
+        if strKey == strKeep:
+            continue
+        print('---Evicting cache entry: ' + strKey)
+        shutil.rmtree(os.path.join(strPthCache, strKey), ignore_errors=True)
+        varSzeTtl -= varSze
@@ -0,0 +1,330 @@
+# -*- coding: utf-8 -*-
+"""
+Creation of binary masks, shared by all stages of the analysis pipeline.
+
+Cluster size thresholds are applied with a single lookup table over the
+cluster labels (cluster sizes are counted with `np.bincount`), i.e. with one
+pass over the volume, independent of the number of clusters. For volumes that
+do not fit into memory (e.g. memory-mapped), the clusters can be labelled slab
+by slab (see `fncCluFltSlab`).
+
+Dilation, erosion, opening and closing by several voxels are computed with a
+distance transform (see `fncDil`), instead of repeated dilations / erosions.
+A mask can be created from an image following a recipe of thresholds, cluster
+filters and morphological operations (see `fncMskRcp`).
+"""
+
+# Part of PacMan analysis pipeline.
+# Copyright (C) 2019  Ingo Marquardt
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+from scipy import ndimage
+
+
+def fncCluStrc(varCon, varNumDim=3):
+    """
+    Neighbourhood of a voxel for connected cluster labelling.
+
+    `varCon` is the maximum number of orthogonal steps to a neighbour (as the
+    `connectivity` argument of `skimage.measure.label`), e.g. 1 for faces, 2
+    for faces & edges, and 3 for faces, edges & corners (3D).
+    """
+    return ndimage.generate_binary_structure(varNumDim, varCon)
+
+
+def fncCluFlt(aryMsk, varCluSzeThr, varCon=2):
+    """
+    Remove connected clusters smaller than a size threshold from a mask.
+
+    Parameters
+    ----------
+    aryMsk : np.array
+        Mask (non-zero voxels are inside the mask).
+    varCluSzeThr : int
+        Clusters with fewer voxels than this threshold are removed.
+    varCon : int
+        Connectivity (see `fncCluStrc`).
+
+    Returns
+    -------
+    aryOut : np.array
+        Mask without small clusters (bool).
+
+    Notes
+    -----
+    The number of voxels in each cluster is counted with `np.bincount`, and
+    the clusters are removed with a lookup table over the labels (one pass
+    over the volume, independent of the number of clusters).
+    """
+    aryLbl, varNumLbl = ndimage.label(aryMsk, structure=fncCluStrc(
+        varCon, aryMsk.ndim))
+
+    # Number of voxels per cluster, and lookup table of clusters to keep (the
+    # background, label zero, is never kept):
+    vecCnt = np.bincount(aryLbl.ravel(), minlength=(varNumLbl + 1))
+    vecLut = np.greater_equal(vecCnt, varCluSzeThr)
+    vecLut[0] = False
+
+    return vecLut[aryLbl]
+
+
+def fncCluFltSlab(aryMsk, varCluSzeThr, aryOut=None, varCon=2, varSlb=64):
+    """
+    Remove small clusters from a mask, slab by slab (along the last axis).
+
+    Parameters
+    ----------
+    aryMsk : array-like
+        3D mask (non-zero voxels are inside the mask), supporting slicing
+        along the last axis (e.g. np.memmap, or the array proxy of a nibabel
+        image).
+    varCluSzeThr : int
+        Clusters with fewer voxels than this threshold are removed.
+    aryOut : array-like or None
+        Output array of the same shape (e.g. np.memmap). If None, a bool array
+        is created.
+    varCon : int
+        Connectivity (see `fncCluStrc`).
+    varSlb : int
+        Number of slices per slab.
+
+    Returns
+    -------
+    aryOut : array-like
+        Mask without small clusters (identical to the result of `fncCluFlt`).
+
+    Notes
+    -----
+    In a first pass, each slab is labelled separately (with labels that are
+    unique across slabs), the number of voxels per label is counted, and
+    labels of neighbouring voxels on either side of each slab border are
+    merged (union-find). In a second pass, the slabs are labelled again, and
+    the lookup table of clusters to keep is applied. Only two slabs (and the
+    last slice of the previous slab) are held in memory at a time.
+    """
+    aryStrc = fncCluStrc(varCon, 3)
+    varNumSlc = aryMsk.shape[2]
+
+    # In-plane offsets of neighbours in the next slice:
+    lstOff = [(idxX - 1, idxY - 1) for idxX in range(3) for idxY in range(3)
+              if aryStrc[idxX, idxY, 2]]
+
+    def fncSlb(idxStr, varLblOff):
+        """Label slab, with labels starting after `varLblOff`."""
+        aryTmp = np.asarray(aryMsk[:, :, idxStr:(idxStr + varSlb)])
+        aryLbl, varNumLbl = ndimage.label(aryTmp, structure=aryStrc)
+        aryLbl = aryLbl.astype(np.int64)
+        aryLbl[aryLbl > 0] += varLblOff
+        return aryLbl, varNumLbl
+
+    # First pass (labels, sizes, and pairs of labels to merge):
+    lstCnt = [np.zeros(1, dtype=np.int64)]
+    lstPair = []
+    varLblOff = 0
+    aryPrv = None
+    for idxStr in range(0, varNumSlc, varSlb):
+
+        aryLbl, varNumLbl = fncSlb(idxStr, varLblOff)
+        lstCnt.append(np.bincount(aryLbl.ravel(),
+                                  minlength=(varLblOff + varNumLbl + 1)
+                                  )[(varLblOff + 1):])
+
+        # Neighbouring voxels across the slab border:
+        if aryPrv is not None:
+            aryNxt = aryLbl[:, :, 0]
+            for varOffX, varOffY in lstOff:
+                tplPrv = (slice(max(0, -varOffX),
+                                aryPrv.shape[0] - max(0, varOffX)),
+                          slice(max(0, -varOffY),
+                                aryPrv.shape[1] - max(0, varOffY)))
+                tplNxt = (slice(max(0, varOffX),
+                                aryNxt.shape[0] - max(0, -varOffX)),
+                          slice(max(0, varOffY),
+                                aryNxt.shape[1] - max(0, -varOffY)))
+                vecA = aryPrv[tplPrv].ravel()
+                vecB = aryNxt[tplNxt].ravel()
+                lgcTmp = np.logical_and(vecA > 0, vecB > 0)
+                if np.any(lgcTmp):
+                    lstPair.append(np.unique(np.stack(
+                        (vecA[lgcTmp], vecB[lgcTmp]), axis=1), axis=0))
+
+        aryPrv = aryLbl[:, :, -1].copy()
+        varLblOff += varNumLbl
+        del(aryLbl)
+
+    vecCnt = np.concatenate(lstCnt)
+
+    # Merge labels (union-find; each label points to its root):
+    vecRoot = np.arange(vecCnt.size, dtype=np.int64)
+    if len(lstPair) > 0:
+        for varA, varB in np.concatenate(lstPair, axis=0):
+            while vecRoot[varA] != varA:
+                varA = vecRoot[varA]
+            while vecRoot[varB] != varB:
+                varB = vecRoot[varB]
+            if varA != varB:
+                vecRoot[max(varA, varB)] = min(varA, varB)
+    # Path compression (all labels point directly to their root):
+    while True:
+        vecTmp = vecRoot[vecRoot]
+        if np.array_equal(vecTmp, vecRoot):
+            break
+        vecRoot = vecTmp
+
+    # Size of each cluster (sum over its labels), and lookup table:
+    vecSze = np.bincount(vecRoot, weights=vecCnt, minlength=vecCnt.size)
+    vecLut = np.greater_equal(vecSze[vecRoot], varCluSzeThr)
+    vecLut[0] = False
+
+    # Second pass (labels of each slab are the same as in the first pass):
+    if aryOut is None:
+        aryOut = np.zeros(aryMsk.shape, dtype=bool)
+    varLblOff = 0
+    for idxStr in range(0, varNumSlc, varSlb):
+        aryLbl, varNumLbl = fncSlb(idxStr, varLblOff)
+        aryOut[:, :, idxStr:(idxStr + varSlb)] = vecLut[aryLbl]
+        varLblOff += varNumLbl
+        del(aryLbl)
+
+    return aryOut
+
+
+def fncDst(aryMsk, strMtr):
+    """
+    Distance of each voxel in the mask to the nearest voxel outside the mask.
+
+    Parameters
+    ----------
+    aryMsk : np.array
+        Mask (bool).
+    strMtr : str
+        Metric, 'taxicab' (chamfer distance, steps across faces),
+        'chessboard' (chamfer distance, steps across faces, edges & corners),
+        or 'euclidean' (exact Euclidean distance transform).
+
+    Returns
+    -------
+    aryDst : np.array
+        Distances (in voxels; zero outside the mask). Voxels outside of the
+        volume do not count as outside of the mask.
+    """
+    if strMtr == 'euclidean':
+        return ndimage.distance_transform_edt(aryMsk)
+    if strMtr in ('taxicab', 'chessboard'):
+        return ndimage.distance_transform_cdt(aryMsk, metric=strMtr)
+    raise ValueError('Unknown metric: ' + str(strMtr))
+
+
+def fncDil(aryMsk, varNum, strMtr='taxicab'):
+    """
+    Dilate mask by `varNum` voxels.
+
+    With the 'taxicab' metric, the result is identical to `varNum` successive
+    binary dilations with the default structuring element (neighbours across
+    faces, as `skimage.morphology.binary_dilation`); with the 'chessboard'
+    metric, to successive dilations with the 3x3x3 cube; and with the
+    'euclidean' metric, to a single dilation with a sphere of radius `varNum`.
+    The cost does not depend on `varNum` (one distance transform).
+    """
+    aryMsk = np.not_equal(aryMsk, 0)
+    if (varNum < 1) or (not np.any(aryMsk)):
+        return aryMsk
+    # Distance of each voxel to the nearest voxel in the mask:
+    return np.less_equal(fncDst(np.logical_not(aryMsk), strMtr), varNum)
+
+
+def fncEro(aryMsk, varNum, strMtr='taxicab'):
+    """
+    Erode mask by `varNum` voxels.
+
+    See `fncDil`; voxels outside of the volume count as inside the mask (as
+    with `skimage.morphology.binary_erosion`), so that the mask is not eroded
+    from the edges of the volume.
+    """
+    aryMsk = np.not_equal(aryMsk, 0)
+    if (varNum < 1) or np.all(aryMsk):
+        return aryMsk
+    return np.greater(fncDst(aryMsk, strMtr), varNum)
+
+
+def fncOpen(aryMsk, varNum, strMtr='taxicab'):
+    """Opening (erosion followed by dilation) by `varNum` voxels."""
+    return fncDil(fncEro(aryMsk, varNum, strMtr), varNum, strMtr)
+
+
+def fncClose(aryMsk, varNum, strMtr='taxicab'):
+    """Closing (dilation followed by erosion) by `varNum` voxels."""
+    return fncEro(fncDil(aryMsk, varNum, strMtr), varNum, strMtr)
+
+
+def fncMskRcp(aryData, lstRcp, strMtr='taxicab', varCon=2):
+    """
+    Create mask from image, following a recipe.
+
+    Parameters
+    ----------
+    aryData : np.array
+        Image (e.g. mean EPI, or a tissue probability map).
+    lstRcp : list
+        Steps of the recipe, in order, each a tuple (name, parameter):
+
+            ('threshold', value)  Voxels with an intensity of at least the
+                                  value are inside the mask.
+            ('binarise', None)    Non-zero voxels are inside the mask.
+            ('cluster', size)     Remove clusters with fewer voxels than
+                                  `size` (see `fncCluFlt`).
+            ('dilate', n)         Dilation by n voxels (see `fncDil`).
+            ('erode', n)          Erosion by n voxels (see `fncEro`).
+            ('open', n)           Opening by n voxels.
+            ('close', n)          Closing by n voxels.
+
+        The first step has to be 'threshold' or 'binarise'.
+    strMtr : str
+        Metric of the morphological operations (see `fncDst`).
+    varCon : int
+        Connectivity of clusters (see `fncCluStrc`).
+
+    Returns
+    -------
+    aryMsk : np.array
+        Mask (bool).
+    """
+    dicMrph = {'dilate': fncDil,
+               'erode': fncEro,
+               'open': fncOpen,
+               'close': fncClose}
+
+    aryMsk = None
+
+    for strStp, varPrm in lstRcp:
+
+        print('------Mask: ' + strStp
+              + ('' if varPrm is None else (' (' + str(varPrm) + ')')))
+
+        if strStp == 'threshold':
+            aryMsk = np.greater_equal(aryData, varPrm)
+        elif strStp == 'binarise':
+            aryMsk = np.not_equal(aryData, 0)
+        elif aryMsk is None:
+            raise ValueError('Mask recipe has to start with a threshold.')
+        elif strStp == 'cluster':
+            aryMsk = fncCluFlt(aryMsk, varPrm, varCon=varCon)
+        elif strStp in dicMrph:
+            aryMsk = dicMrph[strStp](aryMsk, int(varPrm), strMtr)
+        else:
+            raise ValueError('Unknown step of mask recipe: ' + str(strStp))
+
+    return aryMsk
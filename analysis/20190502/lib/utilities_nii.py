@@ -0,0 +1,830 @@
+# -*- coding: utf-8 -*-
+"""
+Loading & saving of nii files, shared by all stages of the analysis pipeline.
+
+Compressed nii files can be saved in the BGZF format (blocked gzip, as used
+by samtools/htslib): the file consists of many small gzip members (of at most
+64 kB of uncompressed data each), which are compressed in parallel. Any gzip
+reader (including nibabel and FSL) can read these files. When such files are
+read with the functions of this module, the blocks are also decompressed in
+parallel. Other gzip files are decompressed sequentially.
+
+The scripts of the individual stages add this directory to the python path:
+
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                    os.pardir, 'lib'))
+"""
+
+# Part of PacMan analysis pipeline.
+# Copyright (C) 2019  Ingo Marquardt
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import io
+import os
+import zlib
+import gzip
+import struct
+import tempfile
+import tracemalloc
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import nibabel as nb
+from nibabel.volumeutils import apply_read_scaling
+
+
+# Maximum amount of uncompressed data per BGZF block (so that the compressed
+# block fits into 64 kB, also for incompressible data):
+varBgzfBlk = 65280
+
+# Amount of data per thread task (multiple of the block size):
+varBgzfTsk = 64 * varBgzfBlk
+
+# Empty BGZF block, marking the end of the file:
+bytBgzfEof = (b'\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC'
+              + b'\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00')
+
+
+def fncMemAvl():
+    """Available physical memory [MB] (4000 MB if unknown)."""
+    try:
+        return (float(os.sysconf('SC_AVPHYS_PAGES'))
+                * float(os.sysconf('SC_PAGE_SIZE')) / 1000000.0)
+    except (ValueError, OSError, AttributeError):
+        return 4000.0
+
+
+def fncBgzfCmp(bytRaw, varLvl):
+    """
+    Compress data into BGZF blocks.
+
+    Parameters
+    ----------
+    bytRaw : bytes-like
+        Uncompressed data.
+    varLvl : int
+        Compression level (zlib, 1 to 9).
+
+    Returns
+    -------
+    bytCmp : bytes
+        Gzip members (one per `varBgzfBlk` bytes of data), each with the
+        BGZF extra field that holds the size of the compressed block.
+    """
+    objRaw = memoryview(bytRaw).cast('B')
+    lstBlk = []
+    for varPos in range(0, len(objRaw), varBgzfBlk):
+        objTmp = objRaw[varPos:(varPos + varBgzfBlk)]
+        objCmp = zlib.compressobj(varLvl, zlib.DEFLATED, -15)
+        bytTmp = objCmp.compress(objTmp) + objCmp.flush()
+        lstBlk.append(b''.join([
+            b'\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00',
+            struct.pack('<H', (len(bytTmp) + 25)),
+            bytTmp,
+            struct.pack('<II', (zlib.crc32(objTmp) & 0xffffffff),
+                        len(objTmp))]))
+    return b''.join(lstBlk)
+
+
+def fncBgzfDcmp(lstBlk):
+    """
+    Decompress BGZF blocks (the CRC and size of each block are checked).
+
+    Parameters
+    ----------
+    lstBlk : list
+        Compressed blocks (bytes-like), each a complete gzip member.
+
+    Returns
+    -------
+    bytRaw : bytes
+        Uncompressed data of all blocks.
+    """
+    lstRaw = []
+    for objBlk in lstBlk:
+        varXlen = struct.unpack_from('<H', objBlk, 10)[0]
+        bytTmp = zlib.decompress(objBlk[(12 + varXlen):-8], -15)
+        varCrc, varSze = struct.unpack_from('<II', objBlk, (len(objBlk) - 8))
+        if (len(bytTmp) != varSze) or \
+                ((zlib.crc32(bytTmp) & 0xffffffff) != varCrc):
+            raise IOError('Corrupt BGZF block.')
+        lstRaw.append(bytTmp)
+    return b''.join(lstRaw)
+
+
+def fncBgzfBlkSze(objBuf, varPos):
+    """
+    Size of the BGZF block at the given position (bytes).
+
+    Returns None if the buffer does not contain the complete block header, and
+    raises an error if the data at the position are not a BGZF block.
+    """
+    if (len(objBuf) - varPos) < 12:
+        return None
+    if bytes(objBuf[varPos:(varPos + 4)]) != b'\x1f\x8b\x08\x04':
+        raise IOError('Not a BGZF block.')
+    varXlen = struct.unpack_from('<H', objBuf, (varPos + 10))[0]
+    if (len(objBuf) - varPos) < (12 + varXlen):
+        return None
+    # Search extra subfields for the block size ('BC'):
+    varTmp = varPos + 12
+    while varTmp < (varPos + 12 + varXlen):
+        varSubLen = struct.unpack_from('<H', objBuf, (varTmp + 2))[0]
+        if bytes(objBuf[varTmp:(varTmp + 2)]) == b'BC':
+            return struct.unpack_from('<H', objBuf, (varTmp + 4))[0] + 1
+        varTmp += 4 + varSubLen
+    raise IOError('Not a BGZF block.')
+
+
+def fncIsBgzf(strPth):
+    """Whether file is in the BGZF format (gzip file with block sizes)."""
+    with open(strPth, 'rb') as objFle:
+        bytTmp = objFle.read(1024)
+    try:
+        return fncBgzfBlkSze(bytTmp, 0) is not None
+    except (IOError, struct.error):
+        return False
+
+
+def fncParIter(fncTsk, itrArg, varPar, varNumTsk=None):
+    """
+    Apply function to each item on a thread pool, yielding results in order.
+
+    At most `varNumTsk` tasks (default: `2 * varPar`) are submitted at a time,
+    so that the memory usage is bounded (zlib releases the GIL, so that the
+    tasks run in parallel).
+    """
+    if varNumTsk is None:
+        varNumTsk = 2 * varPar
+    with ThreadPoolExecutor(max_workers=varPar) as objPool:
+        deqFtr = deque()
+        for objArg in itrArg:
+            deqFtr.append(objPool.submit(fncTsk, objArg))
+            if len(deqFtr) >= varNumTsk:
+                yield deqFtr.popleft().result()
+        while len(deqFtr) > 0:
+            yield deqFtr.popleft().result()
+
+
+def fncBgzfIterBlk(objFle, varChnk=varBgzfTsk):
+    """
+    Read BGZF file, yielding lists of compressed blocks (one per task).
+
+    The file is read `varChnk` bytes at a time, and the blocks are grouped
+    into tasks of at least `varChnk` bytes of uncompressed data (the
+    uncompressed size of each block is stored in its last four bytes).
+    """
+    bytBuf = b''
+    varPos = 0
+    lstBlk = []
+    varSze = 0
+    lgcEnd = False
+    while True:
+        varBlk = fncBgzfBlkSze(bytBuf, varPos)
+        if (varBlk is None) or ((varPos + varBlk) > len(bytBuf)):
+            if lgcEnd:
+                break
+            # Read more data (keep the incomplete block):
+            bytTmp = objFle.read(varChnk)
+            lgcEnd = (len(bytTmp) == 0)
+            bytBuf = bytBuf[varPos:] + bytTmp
+            varPos = 0
+            continue
+        lstBlk.append(bytBuf[varPos:(varPos + varBlk)])
+        varSze += struct.unpack_from('<I', bytBuf, (varPos + varBlk - 4))[0]
+        varPos += varBlk
+        if varSze >= varChnk:
+            yield lstBlk
+            lstBlk = []
+            varSze = 0
+    if varPos != len(bytBuf):
+        raise IOError('Truncated BGZF file.')
+    if len(lstBlk) > 0:
+        yield lstBlk
+
+
+def fncNiiChnk(varBytRd, varPar):
+    """
+    Chunk size and read-ahead for reading a file within a memory budget.
+
+    Parameters
+    ----------
+    varBytRd : float
+        Memory available for reading (and decompressing) the file [bytes].
+    varPar : int
+        Number of threads.
+
+    Returns
+    -------
+    varChnk : int
+        Amount of data read (and decompressed) at once [bytes], between one
+        BGZF block and `varBgzfTsk`.
+    varNumTsk : int
+        Maximum number of chunks that are decompressed ahead (at least one).
+
+    Notes
+    -----
+    Each chunk in flight holds up to three times its size (compressed data,
+    decompressed blocks, and the joined result), and one more chunk is held by
+    the read buffer and by the consumer.
+    """
+    varNumTsk = 2 * varPar
+    varChnk = varBytRd / (3.0 * (varNumTsk + 1))
+    if varChnk < varBgzfBlk:
+        varChnk = varBgzfBlk
+        varNumTsk = max(1, int(varBytRd // (3.0 * varChnk)) - 1)
+    return int(min(varChnk, varBgzfTsk)), int(varNumTsk)
+
+
+def fncNiiIter(strPth, varPar=None, varChnk=varBgzfTsk, varNumTsk=None):
+    """
+    Read (and decompress) file, yielding chunks of uncompressed data.
+
+    BGZF files are decompressed in parallel (`varPar` threads, default: number
+    of CPUs), other gzip files sequentially. The file is read in chunks of
+    about `varChnk` bytes (default: about 4 MB), and at most `varNumTsk`
+    chunks (default: `2 * varPar`) are decompressed ahead, see `fncNiiChnk`.
+    """
+    if varPar is None:
+        varPar = os.cpu_count() or 1
+
+    if strPth.endswith('.gz') and fncIsBgzf(strPth):
+        with open(strPth, 'rb') as objFle:
+            for bytTmp in fncParIter(fncBgzfDcmp,
+                                     fncBgzfIterBlk(objFle, varChnk=varChnk),
+                                     varPar, varNumTsk=varNumTsk):
+                yield bytTmp
+        return
+
+    if strPth.endswith('.gz'):
+        objFle = gzip.open(strPth, 'rb')
+    else:
+        objFle = open(strPth, 'rb')
+    with objFle:
+        while True:
+            bytTmp = objFle.read(varChnk)
+            if len(bytTmp) == 0:
+                break
+            yield bytTmp
+
+
+class BgzfWriter(io.RawIOBase):
+    """
+    Write-only file object, compressing the data in parallel (BGZF).
+
+    The data are split into tasks of constant size (so that all blocks except
+    the last one are full), which are compressed on a thread pool. At most
+    `2 * varPar` tasks are pending at a time, and the compressed tasks are
+    written to the output file in order. The file object does not support
+    seeking (except to the current position), and is used to stream data
+    into a BGZF file (e.g. by nibabel, see `fncSaveNii`). `close` writes the
+    remaining data and the end-of-file marker; `abort` discards them.
+    """
+
+    def __init__(self, objFle, varLvl=1, varPar=None):
+        super().__init__()
+        if varPar is None:
+            varPar = os.cpu_count() or 1
+        self._objFle = objFle
+        self._varLvl = varLvl
+        self._varPar = varPar
+        self._bytRem = bytearray()
+        self._varPos = 0
+        self._objPool = ThreadPoolExecutor(max_workers=varPar)
+        self._deqFtr = deque()
+
+    def writable(self):
+        return True
+
+    def seekable(self):
+        return False
+
+    def tell(self):
+        return self._varPos
+
+    def seek(self, varPos, varWhn=io.SEEK_SET):
+        # Only the current position can be "reached" (as required by nibabel,
+        # which seeks to the beginning of the file, and to the data offset):
+        if (varWhn == io.SEEK_CUR) and (varPos == 0):
+            return self._varPos
+        if (varWhn == io.SEEK_SET) and (varPos == self._varPos):
+            return self._varPos
+        raise io.UnsupportedOperation('BGZF output does not support seek.')
+
+    def _submit(self, bytRaw):
+        self._deqFtr.append(self._objPool.submit(fncBgzfCmp, bytRaw,
+                                                 self._varLvl))
+        while len(self._deqFtr) >= (2 * self._varPar):
+            self._objFle.write(self._deqFtr.popleft().result())
+
+    def write(self, objRaw):
+        objRaw = memoryview(objRaw).cast('B')
+        self._bytRem += objRaw
+        self._varPos += len(objRaw)
+        if len(self._bytRem) >= varBgzfTsk:
+            varNum = (len(self._bytRem) // varBgzfTsk) * varBgzfTsk
+            for varTmp in range(0, varNum, varBgzfTsk):
+                self._submit(bytes(self._bytRem[varTmp:(varTmp
+                                                        + varBgzfTsk)]))
+            del(self._bytRem[:varNum])
+        return len(objRaw)
+
+    def close(self):
+        if not self.closed:
+            try:
+                if len(self._bytRem) > 0:
+                    self._submit(bytes(self._bytRem))
+                    self._bytRem = bytearray()
+                while len(self._deqFtr) > 0:
+                    self._objFle.write(self._deqFtr.popleft().result())
+                self._objFle.write(bytBgzfEof)
+            finally:
+                self._objPool.shutdown()
+                super().close()
+
+    def abort(self):
+        """Discard pending data, and close the file object."""
+        if not self.closed:
+            self._objPool.shutdown(cancel_futures=True)
+            self._deqFtr.clear()
+            super().close()
+
+
+def fncBgzfSave(fncWrt, strPthOt, varLvl=1, varPar=None):
+    """
+    Save BGZF file, with data written into a file object by a function.
+
+    Parameters
+    ----------
+    fncWrt : function
+        Called with a `BgzfWriter` (write-only file object) as its only
+        argument, to which it writes the uncompressed data.
+    strPthOt : str
+        Output path. The file is written to a temporary file first, which is
+        renamed after completion (the temporary file is removed on error).
+    varLvl : int
+        Compression level (zlib, 1 to 9). The default (1) is the same as with
+        nibabel; higher levels result in slightly smaller files, but are
+        much slower.
+    varPar : int or None
+        Number of threads (default: number of CPUs).
+    """
+    strPthTmp = strPthOt + '.tmp'
+    try:
+        with open(strPthTmp, 'wb') as objFle:
+            objWrt = BgzfWriter(objFle, varLvl=varLvl, varPar=varPar)
+            try:
+                fncWrt(objWrt)
+            except BaseException:
+                objWrt.abort()
+                raise
+            objWrt.close()
+    except BaseException:
+        if os.path.isfile(strPthTmp):
+            os.remove(strPthTmp)
+        raise
+    os.replace(strPthTmp, strPthOt)
+
+
+def fncBgzfWrite(itrRaw, strPthOt, varLvl=1, varPar=None):
+    """
+    Compress data in parallel and save as BGZF file.
+
+    Parameters
+    ----------
+    itrRaw : iterable
+        Chunks of uncompressed data (bytes-like).
+    strPthOt : str
+        Output path (see `fncBgzfSave`).
+    varLvl : int
+        Compression level (zlib, 1 to 9, see `fncBgzfSave`).
+    varPar : int or None
+        Number of threads (default: number of CPUs).
+    """
+    def fncWrt(objWrt):
+        for objRaw in itrRaw:
+            objWrt.write(objRaw)
+
+    fncBgzfSave(fncWrt, strPthOt, varLvl=varLvl, varPar=varPar)
+
+
+def fncSaveNii(aryNii, aryAff, objHdr, strPathOt, varLvl=1, varPar=None):
+    """
+    Save nii file (BGZF-compressed in parallel if the path ends with '.gz').
+
+    Parameters
+    ----------
+    aryNii : np.array
+        Image data.
+    aryAff : np.array
+        Affine.
+    objHdr : header object or None
+        Header (the data type of the header is used, as with nibabel).
+    strPathOt : str
+        Output path (nii or nii.gz).
+    varLvl : int
+        Compression level (zlib, 1 to 9, see `fncBgzfWrite`).
+    varPar : int or None
+        Number of threads (default: number of CPUs).
+
+    Notes
+    -----
+    The header and the data are written by nibabel (i.e. with the same data
+    type conversion and scaling as `nb.save`) directly into the compressor
+    (see `BgzfWriter`), without an uncompressed copy of the image on disk.
+    """
+    objNii = nb.Nifti1Image(aryNii, aryAff, header=objHdr)
+
+    if not strPathOt.endswith('.gz'):
+        nb.save(objNii, strPathOt)
+        return
+
+    def fncWrt(objWrt):
+        objNii.to_file_map(nb.Nifti1Image.make_file_map({'image': objWrt}))
+
+    fncBgzfSave(fncWrt, strPathOt, varLvl=varLvl, varPar=varPar)
+
+
+def fncNiiUnzip(strPathIn, strPathOt, varPar=None):
+    """
+    Decompress nii.gz file (in parallel, if the file is in BGZF format).
+
+    The uncompressed file (nii) can be memory-mapped, so that parts of the
+    data can be read repeatedly without decompressing the file again.
+    """
+    strPthTmp = strPathOt + '.tmp'
+    try:
+        with open(strPthTmp, 'wb') as objFle:
+            for bytTmp in fncNiiIter(strPathIn, varPar=varPar):
+                objFle.write(bytTmp)
+    except BaseException:
+        if os.path.isfile(strPthTmp):
+            os.remove(strPthTmp)
+        raise
+    os.replace(strPthTmp, strPathOt)
+
+
+def fncNiiMmap(strPathOt, tplShp, aryAff, objHdr, dtype=np.float32):
+    """
+    Create nii file with empty data, and memory-map the data.
+
+    Parameters
+    ----------
+    strPathOt : str
+        Final output path (nii or nii.gz). The data are written to an
+        uncompressed temporary file next to it (see `fncNiiCommit`).
+    tplShp : tuple
+        Shape of the image.
+    aryAff : np.array
+        Affine.
+    objHdr : header object or None
+        Header (as with nibabel, the affine and shape are set, and the data
+        type is replaced by `dtype`, without scaling).
+    dtype : np.dtype
+        Data type of the image.
+
+    Returns
+    -------
+    aryOt : np.memmap
+        Data of the image (Fortran order, as with nibabel), initialised to
+        zero, e.g. to be filled slab by slab.
+    strPthTmp : str
+        Path of the temporary (uncompressed) nii file.
+    """
+    # Image with the final shape, without allocating the data (only the
+    # header is used):
+    objNii = nb.Nifti1Image(np.broadcast_to(np.zeros((), dtype=dtype),
+                                            tplShp),
+                            aryAff,
+                            header=objHdr)
+    objHdr = objNii.header
+    objHdr.set_data_dtype(dtype)
+    objHdr.set_slope_inter(None, None)
+    objHdr['vox_offset'] = 0
+
+    strPthTmp = strPathOt[:-3] if strPathOt.endswith('.gz') else strPathOt
+    strPthTmp = strPthTmp[:-4] + '.tmp.nii'
+    varByt = int(np.prod(tplShp)) * np.dtype(dtype).itemsize
+
+    with open(strPthTmp, 'wb') as objFle:
+        objHdr.write_to(objFle)
+        varOff = int(objHdr.get_data_offset())
+        objFle.write(b'\0' * max(0, (varOff - objFle.tell())))
+        # The file is extended without writing the data (sparse file):
+        objFle.truncate(varOff + varByt)
+
+    aryOt = np.memmap(strPthTmp,
+                      dtype=objHdr.get_data_dtype(),
+                      mode='r+',
+                      offset=varOff,
+                      shape=tplShp,
+                      order='F')
+
+    return aryOt, strPthTmp
+
+
+def fncNiiCommit(aryOt, strPthTmp, strPathOt, varLvl=1, varPar=None):
+    """
+    Finish nii file created with `fncNiiMmap`.
+
+    The memory map is flushed, and the temporary file is compressed (BGZF, in
+    parallel, see `fncBgzfWrite`) into the output file if the output path ends
+    with '.gz', or renamed otherwise. The memory map must not be used after
+    this function has been called.
+    """
+    aryOt.flush()
+    del(aryOt)
+    try:
+        if strPathOt.endswith('.gz'):
+            fncBgzfWrite(fncNiiIter(strPthTmp), strPathOt, varLvl=varLvl,
+                         varPar=varPar)
+        else:
+            os.replace(strPthTmp, strPathOt)
+    finally:
+        if os.path.isfile(strPthTmp):
+            os.remove(strPthTmp)
+
+
+def fncNiiInfo(objNii, dtype):
+    """
+    Properties of the data of a nii image, needed to choose a load strategy.
+
+    Returns
+    -------
+    dicInf : dict
+        Path of the file containing the data ('path'; differs from the
+        header file for img/hdr pairs), shape, on-disk data type
+        ('dtype_disk'), output data type ('dtype'), scaling ('slope',
+        'inter'; and with the data types used by nibabel, 'slope_raw',
+        'inter_raw'), offset of the data in the file (bytes), and number of
+        voxels.
+    """
+    # The array proxy holds the effective offset & scaling of the data:
+    objPrx = objNii.dataobj
+    tplShp = tuple(int(varTmp) for varTmp in objNii.shape)
+    dtypeDsk = objPrx.dtype
+    varSlp = float(objPrx.slope)
+    varInt = float(objPrx.inter)
+    lgcScl = (varSlp != 1.0) or (varInt != 0.0)
+
+    # If no data type is requested, the data type is the same as with
+    # nibabel (on-disk type, or float64 for scaled data):
+    if dtype is None:
+        dtype = np.float64 if lgcScl else dtypeDsk
+
+    return {'path': objNii.file_map['image'].filename,
+            'shape': tplShp,
+            'dtype_disk': np.dtype(dtypeDsk),
+            'dtype': np.dtype(dtype),
+            'slope': float(varSlp),
+            'inter': float(varInt),
+            'slope_raw': np.asanyarray(objPrx.slope),
+            'inter_raw': np.asanyarray(objPrx.inter),
+            'scaled': lgcScl,
+            'offset': int(objPrx.offset),
+            'voxels': int(np.prod(tplShp))}
+
+
+def fncNiiStrat(dicInf, varMemBdgt, lgcMmap):
+    """
+    Choose strategy for loading nii file, based on a memory budget.
+
+    Returns one of the following:
+
+        'memmap'    Uncompressed file without scaling, of the requested data
+                    type: the data are memory-mapped (no copy in memory).
+        'slab'      The data are read slab by slab (along the last axis) into
+                    an array in memory.
+        'slab_disk' As 'slab', but the output does not fit into the memory
+                    budget, and is placed in a memory-mapped temporary file.
+    """
+    lgcGz = dicInf['path'].endswith('.gz')
+    varByt = float(dicInf['voxels']) * float(dicInf['dtype'].itemsize)
+
+    if (lgcMmap and (not lgcGz) and (not dicInf['scaled'])
+            and (dicInf['dtype'] == dicInf['dtype_disk'])):
+        return 'memmap'
+
+    if (varByt / 1000000.0) <= (0.9 * varMemBdgt):
+        return 'slab'
+
+    return 'slab_disk'
+
+
+def fncNiiSlab(dicInf, varMemBdgt, varByt):
+    """
+    Number of elements along the last axis that are read at once.
+
+    The slab (raw data, scaled data, plus the converted copy) uses the memory
+    that remains after the output array, but at least one element along the
+    last axis is read at once.
+    """
+    tplShp = dicInf['shape']
+    varNumLst = tplShp[-1] if len(tplShp) > 0 else 1
+    varNumSlc = max(1, dicInf['voxels'] // max(1, varNumLst))
+    # Raw data, scaled data (float64, if scaled), and converted data:
+    varBytSlc = float(varNumSlc) * float(dicInf['dtype_disk'].itemsize
+                                         + (8 if dicInf['scaled'] else 0)
+                                         + dicInf['dtype'].itemsize)
+    varBytRem = (varMemBdgt * 1000000.0) - varByt
+    # Slabs larger than 256 MB do not speed up reading any further:
+    varBytRem = min(max(varBytRem, 0.0), 256000000.0)
+    return int(min(varNumLst, max(1, varBytRem // varBytSlc)))
+
+
+def fncNiiRead(dicInf, aryOut, varNumSlb, varPar=None, varChnk=varBgzfTsk,
+               varNumTsk=None):
+    """
+    Read data of nii file slab by slab into the (preallocated) output array.
+
+    The file is read sequentially in one pass (for gzip files, the file is
+    decompressed once, without seeking, see `fncNiiIter`, with chunk size
+    `varChnk` and read-ahead `varNumTsk`), and each slab is converted into
+    the output data type (and scaled) directly.
+    """
+    tplShp = dicInf['shape']
+    varNumSlc = dicInf['voxels'] // max(1, tplShp[-1])
+    dtypeDsk = dicInf['dtype_disk']
+
+    itrChnk = fncNiiIter(dicInf['path'], varPar=varPar, varChnk=varChnk,
+                         varNumTsk=varNumTsk)
+
+    # Current chunk of uncompressed data, and position within the chunk (the
+    # header is skipped):
+    lstChnk = [memoryview(b''), dicInf['offset']]
+
+    # Buffer for raw data of one slab:
+    bytBuf = bytearray(varNumSlc * varNumSlb * dtypeDsk.itemsize)
+
+    for idxStr in range(0, tplShp[-1], varNumSlb):
+        idxStp = min(tplShp[-1], (idxStr + varNumSlb))
+        varNumByt = (idxStp - idxStr) * varNumSlc * dtypeDsk.itemsize
+        objBuf = memoryview(bytBuf)[:varNumByt]
+
+        # Fill buffer from chunks:
+        varPos = 0
+        while varPos < varNumByt:
+            if lstChnk[1] >= len(lstChnk[0]):
+                lstChnk[1] -= len(lstChnk[0])
+                try:
+                    lstChnk[0] = memoryview(next(itrChnk))
+                except StopIteration:
+                    raise IOError('Unexpected end of nii file: '
+                                  + dicInf['path'])
+                continue
+            varTmp = min((varNumByt - varPos), (len(lstChnk[0]) - lstChnk[1]))
+            objBuf[varPos:(varPos + varTmp)] = \
+                lstChnk[0][lstChnk[1]:(lstChnk[1] + varTmp)]
+            varPos += varTmp
+            lstChnk[1] += varTmp
+
+        # Raw data of slab (nii data are saved in Fortran order):
+        aryRaw = np.frombuffer(objBuf, dtype=dtypeDsk).reshape(
+            (tplShp[:-1] + ((idxStp - idxStr),)), order='F')
+
+        # The scaling is applied as by nibabel (at float precision, before the
+        # conversion into the output data type), so that the result is the
+        # same as `np.asarray(objNii.dataobj).astype(dtype)`, also for integer
+        # output data types:
+        if dicInf['scaled']:
+            aryRaw = apply_read_scaling(aryRaw, dicInf['slope_raw'],
+                                        dicInf['inter_raw'])
+        aryOut[..., idxStr:idxStp] = aryRaw
+        del(aryRaw, objBuf)
+
+    itrChnk.close()
+
+
+def fncLoadNii(strPathIn, dtype=np.float32, varMemBdgt=None, lgcMmap=True,
+               dicStat=None, varPar=None):
+    """
+    Load nii file.
+
+    Parameters
+    ----------
+    strPathIn : str
+        Path to nii file to load (nii or nii.gz).
+    dtype : np.dtype or None
+        Data type of the output array. If None, the data type is the same as
+        with nibabel (on-disk data type, or float64 if the data are scaled).
+    varMemBdgt : float or None
+        Memory budget [MB]. If None, half of the available memory.
+    lgcMmap : bool
+        Whether uncompressed files may be memory-mapped (see notes).
+    dicStat : dict or None
+        If a dictionary is provided, the strategy ('strategy') and the peak
+        memory usage during loading ('peak_mb', None if not measured, see
+        notes) are saved in it.
+    varPar : int or None
+        Number of threads for the decompression of BGZF files (default:
+        number of CPUs).
+
+    Returns
+    -------
+    aryNii : np.array
+        Array containing nii data (Fortran order, as with nibabel).
+    objHdr : header object
+        Header of nii file.
+    aryAff : np.array
+        Array containing 'affine', i.e. information about spatial positioning
+        of nii data.
+
+    Notes
+    -----
+    The strategy is chosen based on the memory budget, not on the size of the
+    file (see `fncNiiStrat`). Uncompressed files without scaling are
+    memory-mapped if they already have the requested data type (copy on
+    write, i.e. changes to the array are not written to the file; the file
+    must not be overwritten while the array is in use). Otherwise, the file is
+    read slab by slab (along the last axis, i.e. volume by volume for 4D
+    files), and each slab is converted into the output data type, so that the
+    data are never held at float64 precision in memory (unless requested). If
+    the output array does not fit into the memory budget, it is placed in a
+    temporary file on disk (memory-mapped). Reading & decompressing the file
+    also stays within the memory budget (the size of each read and the number
+    of reads ahead of the slabs are derived from it, see `fncNiiChnk`). The
+    peak memory usage (of numpy arrays allocated while loading, measured with
+    tracemalloc) is reported, unless tracemalloc is already tracing (e.g. the
+    caller is measuring its own peak memory usage, which is not reset).
+    """
+    if varMemBdgt is None:
+        varMemBdgt = 0.5 * fncMemAvl()
+
+    # Peak memory usage is only measured if tracemalloc is started here (if the
+    # caller is tracing already, its peak measurement must not be reset):
+    lgcTrc = not tracemalloc.is_tracing()
+    if lgcTrc:
+        tracemalloc.start()
+
+    # Load nii file (this does not load the data into memory yet):
+    objNii = nb.load(strPathIn)
+    dicInf = fncNiiInfo(objNii, dtype)
+    strStrat = fncNiiStrat(dicInf, varMemBdgt, lgcMmap)
+
+    if strStrat == 'memmap':
+
+        aryNii = np.memmap(dicInf['path'],
+                           dtype=dicInf['dtype_disk'],
+                           mode='c',
+                           offset=dicInf['offset'],
+                           shape=dicInf['shape'],
+                           order='F')
+
+    else:
+
+        varByt = float(dicInf['voxels']) * float(dicInf['dtype'].itemsize)
+
+        if strStrat == 'slab':
+            aryNii = np.empty(dicInf['shape'], dtype=dicInf['dtype'],
+                              order='F')
+        else:
+            # The temporary file is deleted as soon as the array is not used
+            # anymore (the file remains accessible through the memory map):
+            with tempfile.NamedTemporaryFile(suffix='.npy') as objTmp:
+                aryNii = np.memmap(objTmp.name,
+                                   dtype=dicInf['dtype'],
+                                   mode='w+',
+                                   shape=dicInf['shape'],
+                                   order='F')
+            varByt = 0.0
+
+        # A quarter of the memory that remains after the output array is used
+        # for reading & decompressing the file, the rest for the slabs:
+        if varPar is None:
+            varPar = os.cpu_count() or 1
+        varChnk, varNumTsk = fncNiiChnk(
+            (0.25 * max(0.0, ((varMemBdgt * 1000000.0) - varByt))), varPar)
+        varByt += 3.0 * float(varChnk) * float(varNumTsk + 1)
+
+        fncNiiRead(dicInf, aryNii, fncNiiSlab(dicInf, varMemBdgt, varByt),
+                   varPar=varPar, varChnk=varChnk, varNumTsk=varNumTsk)
+
+    if lgcTrc:
+        varPeak = tracemalloc.get_traced_memory()[1] / 1000000.0
+        tracemalloc.stop()
+        print(('---------Loaded ' + os.path.basename(strPathIn) + ' ('
+               + strStrat + ', peak memory: ' + str(int(np.ceil(varPeak)))
+               + ' MB)'))
+    else:
+        varPeak = None
+        print(('---------Loaded ' + os.path.basename(strPathIn) + ' ('
+               + strStrat + ')'))
+
+    if dicStat is not None:
+        dicStat['strategy'] = strStrat
+        dicStat['peak_mb'] = varPeak
+
+    # Output nii data (as numpy array), header, and 'affine':
+    return aryNii, objNii.header, objNii.affine
@@ -38,6 +38,13 @@ pacman_wait=true
 
 # Number of parallel processes to use (for pRF finding):
 pacman_cpu="11"
+
+# Cache for the outputs of python stages (if the inputs and parameters of a
+# stage have not changed, its outputs are restored from the cache instead of
+# being recomputed). Set the path to an empty string to disable the cache.
+# Maximum size of the cache in MB (least recently used entries are deleted):
+pacman_cache_path="${pacman_data_path}cache/"
+pacman_cache_size="20000"
 #-------------------------------------------------------------------------------
 
 
@@ -52,6 +59,8 @@ export pacman_data_path
 export pacman_from_bids
 export pacman_wait
 export pacman_cpu
+export pacman_cache_path
+export pacman_cache_size
 export USER=john
 #-------------------------------------------------------------------------------
 
@@ -71,6 +80,8 @@ docker run -it --rm \
     -e pacman_from_bids \
     -e pacman_wait \
     -e pacman_cpu \
+    -e pacman_cache_path \
+    -e pacman_cache_size \
     -e USER \
     dockerimage_surface_jessie ${pacman_anly_path}${pacman_sub_id}/metascript_02.sh
 #-------------------------------------------------------------------------------
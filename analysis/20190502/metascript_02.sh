@@ -205,11 +205,7 @@ source ${strPathPrnt}03_intermediate_steps/n_02a_sh_fsl_updatefeatreg_comb.sh
 date
 
 echo "---Automatic: Create event related averages."
-python ${strPathPrnt}03_intermediate_steps/n_03a_py_evnt_rltd_avrgs.py
-date
-
-echo "---Automatic: Create event related averages."
-python ${strPathPrnt}03_intermediate_steps/n_03b_py_evnt_rltd_avrgs.py
+python ${strPathPrnt}03_intermediate_steps/n_03_py_evnt_rltd_avrgs.py
 date
 
 echo "---Automatic: Prepare depth-sampling of event related averages."